@@ -4,8 +4,10 @@ import time
 import threading
 import uuid
 import base64
+import hashlib
 import json
 import re
+import select
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import logging
@@ -15,11 +17,14 @@ from plexapi.myplex import MyPlexAccount, MyPlexPinLogin
 import subprocess
 from xml.etree import ElementTree as ET
 from flask import Flask, render_template, g, request, flash, redirect, url_for, jsonify, session
+from segment_planning import plan_segments
+from media_descriptor import parse_media_descriptor
 
 try:
     from plexapi.server import PlexServer
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    import psycopg2.extensions
+    from psycopg2.extras import RealDictCursor, Json, execute_batch
     from authlib.integrations.flask_client import OAuth
     from werkzeug.middleware.proxy_fix import ProxyFix
     import requests
@@ -93,7 +98,16 @@ DB_CONFIG = {
 
 # Worker session configuration
 WORKER_SESSION_TIMEOUT_SECONDS = 300  # 5 minutes - time before a worker is considered stale
-WORKER_PROTECTED_ENDPOINTS = ['request_job', 'update_job']  # Endpoints that require session validation
+WORKER_PROTECTED_ENDPOINTS = ['request_job', 'update_job', 'api_node_command', 'worker_heartbeat', 'api_media_descriptor']  # Endpoints that require session validation
+MAX_JOB_LEASE_SECONDS = 600  # Upper bound for how long a worker may hold a job it has not started yet
+MAX_SEGMENT_ATTEMPTS = 3  # A segment of a segmented encode is retried this often before the whole job fails
+MAX_JOB_WAIT_SECONDS = 60  # Upper bound for how long /api/request_job holds a long-poll request open
+MAX_COMMAND_WAIT_SECONDS = 60  # Upper bound for how long /api/nodes/<hostname>/command holds a request open
+# Every parked long-poll request holds one of the server's threads (see gunicorn.conf.py, which sizes the
+# thread pool from this value). At most this many requests wait at the same time; the others are answered
+# right away, so threads stay free for the UI, job updates and heartbeats. Set it to the number of worker slots in the fleet.
+LONG_POLL_MAX_WAITERS = int(os.environ.get("LONG_POLL_MAX_WAITERS", "16"))
+LONG_POLL_RETRY_SECONDS = 30  # How long a worker waits before it asks again when no waiter place was free
 
 # Symbolic link warning message (used by media scanners)
 SYMLINK_WARNING = "This is a symbolic link. Transcoding will increase file size as it creates a real file."
@@ -190,6 +204,10 @@ def setup_auth(app):
                     elif request.method == 'GET':
                         hostname = request.args.get('hostname')
                         session_token = request.args.get('session_token')
+                    # Routes that name the node in the URL act on that node, so the session must belong to it
+                    url_hostname = (request.view_args or {}).get('hostname')
+                    if url_hostname and hostname != url_hostname:
+                        return jsonify(error="Session does not belong to the node in the URL"), 403
                     
                     # Validate session token
                     if not hostname or not session_token:
@@ -289,7 +307,7 @@ print(f"\nLibrarrarian Web Dashboard v{get_project_version()}\n")
 # ===========================
 # Database Migrations
 # ===========================
-TARGET_SCHEMA_VERSION = 18
+TARGET_SCHEMA_VERSION = 37
 
 MIGRATIONS = {
     # Version 2: Add uptime tracking
@@ -425,6 +443,220 @@ MIGRATIONS = {
     18: [
         "INSERT INTO worker_settings (setting_name, setting_value) VALUES ('arr_rename_delay_seconds', '60') ON CONFLICT (setting_name) DO NOTHING;",
     ],
+    # Version 19: Store the real encode speed reported by ffmpeg's -progress output
+    19: [
+        "ALTER TABLE nodes ADD COLUMN IF NOT EXISTS speed REAL;",
+    ],
+    # Version 20: Workers send a trimmed ffmpeg log excerpt, plus the size and checksum of the full log
+    20: [
+        "ALTER TABLE failed_files ADD COLUMN IF NOT EXISTS log_size BIGINT;",
+        "ALTER TABLE failed_files ADD COLUMN IF NOT EXISTS log_checksum VARCHAR(64);",
+    ],
+    # Version 21: Cache worker hardware capabilities and allow the dashboard to request a re-probe
+    21: [
+        "ALTER TABLE nodes ADD COLUMN IF NOT EXISTS capabilities JSONB;",
+        "ALTER TABLE nodes ADD COLUMN IF NOT EXISTS hardware_refresh_requested BOOLEAN DEFAULT false;",
+    ],
+    # Version 22: Multi-slot workers. Per-node options survive worker restarts (unlike the nodes row),
+    # and each concurrent job slot reports progress into its own sub-record.
+    22: [
+        """
+        CREATE TABLE IF NOT EXISTS node_options (
+            hostname VARCHAR(255) PRIMARY KEY,
+            max_slots INTEGER,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        f"GRANT ALL PRIVILEGES ON TABLE node_options TO {DB_CONFIG['user']};",
+        """
+        CREATE TABLE IF NOT EXISTS node_slots (
+            hostname VARCHAR(255) NOT NULL,
+            slot INTEGER NOT NULL,
+            status VARCHAR(50),
+            job_id INTEGER,
+            current_file TEXT,
+            progress REAL,
+            fps REAL,
+            speed REAL,
+            total_duration REAL,
+            job_start_time TIMESTAMP WITH TIME ZONE,
+            last_heartbeat TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (hostname, slot)
+        );
+        """,
+        f"GRANT ALL PRIVILEGES ON TABLE node_slots TO {DB_CONFIG['user']};",
+    ],
+    # Version 23: Job leases. A pipelined worker reserves its next job while the current one finishes.
+    23: [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITH TIME ZONE;",
+    ],
+    # Version 24: Segmented encoding. A 'transcode_segmented' job is split into keyframe-aligned
+    # time ranges that several workers encode in parallel before one worker joins them.
+    24: [
+        """
+        CREATE TABLE IF NOT EXISTS job_segments (
+            id SERIAL PRIMARY KEY,
+            job_id INTEGER NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+            segment_index INTEGER NOT NULL,
+            start_time REAL NOT NULL,
+            end_time REAL NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            assigned_to VARCHAR(255),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            output_size BIGINT,
+            error TEXT,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (job_id, segment_index)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_job_segments_status ON job_segments (status);",
+        f"GRANT ALL PRIVILEGES ON TABLE job_segments TO {DB_CONFIG['user']};",
+        f"GRANT USAGE, SELECT ON SEQUENCE job_segments_id_seq TO {DB_CONFIG['user']};",
+        "INSERT INTO worker_settings (setting_name, setting_value) VALUES ('segment_duration_minutes', '10') ON CONFLICT (setting_name) DO NOTHING;",
+    ],
+    # Version 25: Checkpointed encodes that a restarted worker can resume (disabled by default)
+    25: [
+        "INSERT INTO worker_settings (setting_name, setting_value) VALUES ('checkpoint_segment_minutes', '0') ON CONFLICT (setting_name) DO NOTHING;",
+    ],
+    # Version 26: Media descriptor computed by the scanner's ffprobe and passed to workers with the job
+    26: [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS media_info JSONB;",
+    ],
+    # Version 27: Settings version. A trigger bumps it whenever a worker setting changes, so workers
+    # can fetch the settings conditionally and skip the fetch entirely when the version is unchanged.
+    27: [
+        """
+        CREATE TABLE IF NOT EXISTS settings_version (
+            id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            version BIGINT NOT NULL DEFAULT 1
+        );
+        """,
+        "INSERT INTO settings_version (id, version) VALUES (1, 1) ON CONFLICT (id) DO NOTHING;",
+        f"GRANT ALL PRIVILEGES ON TABLE settings_version TO {DB_CONFIG['user']};",
+        """
+        CREATE OR REPLACE FUNCTION bump_settings_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE settings_version SET version = version + 1 WHERE id = 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS worker_settings_changed ON worker_settings;",
+        """
+        CREATE TRIGGER worker_settings_changed
+        AFTER UPDATE ON worker_settings
+        FOR EACH ROW WHEN (OLD.setting_value IS DISTINCT FROM NEW.setting_value)
+        EXECUTE FUNCTION bump_settings_version();
+        """,
+        "DROP TRIGGER IF EXISTS worker_settings_added_or_removed ON worker_settings;",
+        """
+        CREATE TRIGGER worker_settings_added_or_removed
+        AFTER INSERT OR DELETE ON worker_settings
+        FOR EACH ROW EXECUTE FUNCTION bump_settings_version();
+        """,
+    ],
+    # Version 28: Notify the dashboard whenever a job or segment becomes pending, which wakes up
+    # workers that are long-polling /api/request_job. NOTIFY collapses duplicates within a transaction.
+    28: [
+        """
+        CREATE OR REPLACE FUNCTION notify_job_available() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('job_available', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS jobs_available ON jobs;",
+        """
+        CREATE TRIGGER jobs_available
+        AFTER INSERT OR UPDATE OF status ON jobs
+        FOR EACH ROW WHEN (NEW.status = 'pending')
+        EXECUTE FUNCTION notify_job_available();
+        """,
+        "DROP TRIGGER IF EXISTS job_segments_available ON job_segments;",
+        """
+        CREATE TRIGGER job_segments_available
+        AFTER INSERT OR UPDATE OF status ON job_segments
+        FOR EACH ROW WHEN (NEW.status = 'pending')
+        EXECUTE FUNCTION notify_job_available();
+        """,
+    ],
+    # Version 29: Notify the dashboard whenever a node's command or options change, which wakes up
+    # the worker's command stream (/api/nodes/<hostname>/command) instead of waiting for its next poll.
+    29: [
+        """
+        CREATE OR REPLACE FUNCTION notify_node_command() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('node_command', NEW.hostname);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS nodes_command_added ON nodes;",
+        """
+        CREATE TRIGGER nodes_command_added
+        AFTER INSERT ON nodes
+        FOR EACH ROW EXECUTE FUNCTION notify_node_command();
+        """,
+        "DROP TRIGGER IF EXISTS nodes_command_changed ON nodes;",
+        """
+        CREATE TRIGGER nodes_command_changed
+        AFTER UPDATE OF command, hardware_refresh_requested ON nodes
+        FOR EACH ROW WHEN (OLD.command IS DISTINCT FROM NEW.command OR OLD.hardware_refresh_requested IS DISTINCT FROM NEW.hardware_refresh_requested)
+        EXECUTE FUNCTION notify_node_command();
+        """,
+        "DROP TRIGGER IF EXISTS node_options_changed ON node_options;",
+        """
+        CREATE TRIGGER node_options_changed
+        AFTER INSERT OR UPDATE ON node_options
+        FOR EACH ROW EXECUTE FUNCTION notify_node_command();
+        """,
+    ],
+    # Version 30: Idempotency keys of applied job updates, so workers can safely retry /api/update_job
+    30: [
+        """
+        CREATE TABLE IF NOT EXISTS job_updates (
+            idempotency_key VARCHAR(128) PRIMARY KEY,
+            job_id INTEGER NOT NULL,
+            status VARCHAR(20),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_job_updates_created_at ON job_updates (created_at);",
+        f"GRANT ALL PRIVILEGES ON TABLE job_updates TO {DB_CONFIG['user']};",
+    ],
+    # Version 31: The last encoder benchmark report of each node (transcode.py --benchmark --benchmark-post)
+    31: [
+        "ALTER TABLE node_options ADD COLUMN IF NOT EXISTS benchmark JSONB;",
+    ],
+    # Version 32: Optional sample encodes that skip files whose predicted saving is too small
+    32: [
+        "INSERT INTO worker_settings (setting_name, setting_value) VALUES ('sample_encode_enabled', 'false') ON CONFLICT (setting_name) DO NOTHING;",
+        "INSERT INTO worker_settings (setting_name, setting_value) VALUES ('min_savings_percent', '10') ON CONFLICT (setting_name) DO NOTHING;",
+    ],
+    # Version 33: Abort encodes whose output is projected not to beat the original
+    33: [
+        "INSERT INTO worker_settings (setting_name, setting_value) VALUES ('size_guard_percent', '0') ON CONFLICT (setting_name) DO NOTHING;",
+    ],
+    # Version 34: Per-GPU usage (active sessions, fps) reported by multi-GPU workers
+    34: [
+        "ALTER TABLE nodes ADD COLUMN IF NOT EXISTS devices JSONB;",
+    ],
+    # Version 35: Codec family (HEVC or AV1) and speed tier, chosen independently of the hardware acceleration mode
+    35: [
+        "INSERT INTO worker_settings (setting_name, setting_value) VALUES ('codec_family', 'hevc') ON CONFLICT (setting_name) DO NOTHING;",
+        "INSERT INTO worker_settings (setting_name, setting_value) VALUES ('speed_tier', 'balanced') ON CONFLICT (setting_name) DO NOTHING;",
+    ],
+    # Version 36: Per-node CPU resource profile for encodes (threads, affinity, nice/ionice, cpu.max)
+    36: [
+        "ALTER TABLE node_options ADD COLUMN IF NOT EXISTS resources JSONB;",
+    ],
+    # Version 37: Predicted size of files skipped or aborted for a low saving. They were never replaced,
+    # so their estimated size is not a new size.
+    37: [
+        "ALTER TABLE encoded_files ADD COLUMN IF NOT EXISTS predicted_size BIGINT;",
+        "UPDATE encoded_files SET predicted_size = new_size, new_size = NULL WHERE status IN ('skipped_low_gain', 'aborted_low_gain') AND new_size IS NOT NULL;",
+    ],
 }
 
 def run_migrations():
@@ -517,6 +749,13 @@ def close_db(error):
         g.db.close()
 
 
+def release_db():
+    """Closes the request's database connection early. get_db() opens a new one if it is needed again."""
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
+
 def initialize_database_if_needed():
     """
     Checks if the database is initialized. If not, runs the full init_db() process.
@@ -752,12 +991,27 @@ def get_cluster_status():
                     node['uptime_str'] = "N/A"
                 # Remove the raw timedelta object as it's not JSON serializable
                 node.pop('uptime', None)
+
+            # Attach the per-slot progress of multi-slot workers
+            cur.execute("""
+                SELECT hostname, slot, status, job_id, current_file, progress, fps, speed
+                FROM node_slots
+                WHERE hostname = ANY(%s)
+                ORDER BY hostname, slot
+            """, ([node['hostname'] for node in nodes],))
+            slots_by_node = {}
+            for slot in cur.fetchall():
+                slot['percent'] = int(slot.get('progress') or 0)
+                slots_by_node.setdefault(slot['hostname'], []).append(slot)
+            for node in nodes:
+                node['slots'] = slots_by_node.get(node['hostname'], [])
             
             # Get total failure count (failed_files + stuck jobs)
             cur.execute("SELECT COUNT(*) as cnt FROM failed_files")
             failures = cur.fetchone()['cnt']
             
             # Count stuck jobs: jobs in 'encoding' status where worker is online and processing higher job IDs
+            # (jobs that are still active in one of a multi-slot worker's slots are not stuck)
             cur.execute("""
                 SELECT COUNT(*) as cnt FROM jobs
                 WHERE status = 'encoding'
@@ -773,6 +1027,11 @@ def get_cluster_status():
                     AND j2.status = 'encoding'
                     AND j2.id > jobs.id
                 )
+                AND NOT EXISTS (
+                    SELECT 1 FROM node_slots
+                    WHERE node_slots.hostname = jobs.assigned_to
+                    AND node_slots.job_id = jobs.id
+                )
             """)
             stuck_count = cur.fetchone()['cnt']
             failures += stuck_count
@@ -807,7 +1066,7 @@ def get_failed_files_list():
     try:
         with db.cursor(cursor_factory=RealDictCursor) as cur:
             # Get regular failed files
-            cur.execute("SELECT id, filename, reason, failed_at AS reported_at, log, 'failed_file' as type FROM failed_files ORDER BY failed_at DESC")
+            cur.execute("SELECT id, filename, reason, failed_at AS reported_at, log, log_size, log_checksum, 'failed_file' as type FROM failed_files ORDER BY failed_at DESC")
             files = cur.fetchall()
             
             # Get stuck jobs (jobs in 'encoding' status where worker is online and processing higher job IDs)
@@ -833,6 +1092,11 @@ def get_failed_files_list():
                     AND j2.status = 'encoding'
                     AND j2.id > jobs.id
                 )
+                AND NOT EXISTS (
+                    SELECT 1 FROM node_slots
+                    WHERE node_slots.hostname = jobs.assigned_to
+                    AND node_slots.job_id = jobs.id
+                )
                 ORDER BY jobs.updated_at DESC
             """)
             stuck_jobs = cur.fetchall()
@@ -961,6 +1225,20 @@ def get_worker_settings():
         db_error = f"Database query failed: {e}"
     return settings, db_error
 
+def get_settings_version():
+    """Returns the current version of the worker settings, or None if it cannot be read."""
+    db = get_db()
+    if db is None:
+        return None
+    try:
+        with db.cursor() as cur:
+            cur.execute("SELECT version FROM settings_version WHERE id = 1")
+            row = cur.fetchone()
+            return row[0] if row else None
+    except Exception:
+        db.rollback()
+        return None
+
 def update_worker_setting(key, value):
     """Updates a specific worker setting in the database."""
     db = get_db()
@@ -1132,8 +1410,12 @@ def dashboard():
         if 'progress' in node:
             node['percent'] = int(node['progress'] or 0)
         
-        # Re-implement Speed and Codec for the UI
-        node['speed'] = round(node.get('fps', 0) / 24, 1) if node.get('fps') else 0.0
+        # Speed comes from ffmpeg's progress output. Older workers don't report it,
+        # so fall back to the previous fps-based estimate for them.
+        if node.get('speed'):
+            node['speed'] = round(node['speed'], 2)
+        else:
+            node['speed'] = round(node.get('fps', 0) / 24, 1) if node.get('fps') else 0.0
         node['codec'] = 'hevc'
 
     return render_template(
@@ -1163,6 +1445,12 @@ def register_worker():
     hostname = data.get('hostname')
     session_token = data.get('session_token')
     version = data.get('version', 'unknown')
+    capabilities = data.get('capabilities')
+    # Jobs and segments whose results are still spooled on the worker finished there; it replays them after registering
+    pending_results = data.get('pending_results') or []
+    spooled_jobs = [int(r['job_id']) for r in pending_results if r.get('segment_index') is None]
+    spooled_segment_jobs = [int(r['job_id']) for r in pending_results if r.get('segment_index') is not None]
+    spooled_segment_indexes = [int(r['segment_index']) for r in pending_results if r.get('segment_index') is not None]
     
     if not hostname or not session_token:
         return jsonify({"error": "hostname and session_token are required"}), 400
@@ -1204,15 +1492,30 @@ def register_worker():
             # If the session token matches or there's no token, update it
             cur.execute("""
                 UPDATE nodes 
-                SET session_token = %s, version = %s, last_heartbeat = NOW(), connected_at = NOW(), status = 'booting'
+                SET session_token = %s, version = %s, capabilities = %s, hardware_refresh_requested = false,
+                    last_heartbeat = NOW(), connected_at = NOW(), status = 'booting'
                 WHERE hostname = %s
-            """, (session_token, version, hostname))
+            """, (session_token, version, Json(capabilities) if capabilities else None, hostname))
         else:
             # New worker - insert a new record
             cur.execute("""
-                INSERT INTO nodes (hostname, session_token, version, status, last_heartbeat, connected_at)
-                VALUES (%s, %s, %s, 'booting', NOW(), NOW())
-            """, (hostname, session_token, version))
+                INSERT INTO nodes (hostname, session_token, version, capabilities, status, last_heartbeat, connected_at)
+                VALUES (%s, %s, %s, %s, 'booting', NOW(), NOW())
+            """, (hostname, session_token, version, Json(capabilities) if capabilities else None))
+
+        # A new session means the worker restarted, so anything still assigned to it was interrupted.
+        # Queue those jobs again; checkpointed encodes resume from their last finished segment.
+        cur.execute("""
+            UPDATE jobs SET status = 'pending', assigned_to = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE assigned_to = %s AND status IN ('encoding', 'leased') AND id <> ALL(%s::int[])
+        """, (hostname, spooled_jobs))
+        if cur.rowcount > 0:
+            print(f"[{datetime.now()}] Re-queued {cur.rowcount} interrupted job(s) from worker '{hostname}'")
+        cur.execute("""
+            UPDATE job_segments SET status = 'pending', assigned_to = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE assigned_to = %s AND status = 'encoding'
+            AND (job_id, segment_index) NOT IN (SELECT * FROM unnest(%s::int[], %s::int[]))
+        """, (hostname, spooled_segment_jobs, spooled_segment_indexes))
         
         conn.commit()
         print(f"[{datetime.now()}] Worker '{hostname}' registered successfully")
@@ -1225,6 +1528,91 @@ def register_worker():
     finally:
         cur.close()
 
+@app.route('/api/worker/heartbeat', methods=['POST'])
+def worker_heartbeat():
+    """
+    Batched node state endpoint for workers that have no database access of their own.
+    A single request can carry the node heartbeat ('node'), slot heartbeats ('slots'), a new
+    slot count ('slot_count'), the hardware capabilities ('capabilities'), or 'clear' when the
+    worker shuts down. All writes happen in one transaction, and the response carries the
+    node's command and options, so the worker needs no separate command lookup.
+    """
+    data = request.json
+    hostname = data.get('hostname')
+
+    conn = get_db()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        if data.get('clear'):
+            cur.execute("DELETE FROM node_slots WHERE hostname = %s", (hostname,))
+            cur.execute("DELETE FROM nodes WHERE hostname = %s", (hostname,))
+            conn.commit()
+            return jsonify({"success": True})
+
+        if data.get('slot_count') is not None:
+            slot_count = int(data['slot_count'])
+            cur.execute("DELETE FROM node_slots WHERE hostname = %s AND slot >= %s", (hostname, slot_count if slot_count > 1 else 0))
+
+        slots = data.get('slots') or []
+        if slots:
+            execute_batch(cur, """
+                INSERT INTO node_slots (hostname, slot, status, job_id, current_file, progress, fps, speed, total_duration, job_start_time, last_heartbeat)
+                VALUES (%(hostname)s, %(slot)s, %(status)s, %(job_id)s, %(current_file)s, %(progress)s, %(fps)s, %(speed)s, %(total_duration)s, %(job_start_time)s, NOW())
+                ON CONFLICT (hostname, slot) DO UPDATE SET
+                    status = EXCLUDED.status,
+                    job_id = EXCLUDED.job_id,
+                    current_file = EXCLUDED.current_file,
+                    progress = EXCLUDED.progress,
+                    fps = EXCLUDED.fps,
+                    speed = EXCLUDED.speed,
+                    total_duration = EXCLUDED.total_duration,
+                    job_start_time = EXCLUDED.job_start_time,
+                    last_heartbeat = EXCLUDED.last_heartbeat
+            """, [{
+                "hostname": hostname, "slot": slot.get('slot'), "status": slot.get('status'), "job_id": slot.get('job_id'),
+                "current_file": slot.get('current_file'), "progress": slot.get('progress'), "fps": slot.get('fps'),
+                "speed": slot.get('speed'), "total_duration": slot.get('total_duration'), "job_start_time": slot.get('job_start_time'),
+            } for slot in slots])
+
+        node = data.get('node')
+        if node:
+            # session_token is left untouched; it is only set by /api/register_worker
+            cur.execute("""
+                UPDATE nodes SET
+                    last_heartbeat = NOW(), status = %s, version = %s, current_file = %s, progress = %s, fps = %s,
+                    version_mismatch = %s, total_duration = %s, job_start_time = %s, speed = %s
+                WHERE hostname = %s
+            """, (node.get('status'), node.get('version'), node.get('current_file'), node.get('progress'), node.get('fps'),
+                  bool(node.get('version_mismatch')), node.get('total_duration'), node.get('job_start_time'), node.get('speed'), hostname))
+        else:
+            cur.execute("UPDATE nodes SET last_heartbeat = NOW() WHERE hostname = %s", (hostname,))
+
+        if data.get('capabilities') is not None:
+            cur.execute("UPDATE nodes SET capabilities = %s WHERE hostname = %s", (Json(data['capabilities']), hostname))
+        if data.get('devices') is not None:
+            cur.execute("UPDATE nodes SET devices = %s WHERE hostname = %s", (Json(data['devices']), hostname))
+
+        cur.execute("""
+            SELECT n.command, o.max_slots, o.resources, n.hardware_refresh_requested FROM nodes n
+            LEFT JOIN node_options o ON o.hostname = n.hostname
+            WHERE n.hostname = %s
+        """, (hostname,))
+        control = cur.fetchone() or {'command': 'idle', 'max_slots': None, 'resources': None, 'hardware_refresh_requested': False}
+        if control['hardware_refresh_requested']:
+            # The request is handed to the worker exactly once
+            cur.execute("UPDATE nodes SET hardware_refresh_requested = false WHERE hostname = %s", (hostname,))
+        conn.commit()
+        return jsonify(control)
+    except Exception as e:
+        conn.rollback()
+        print(f"[{datetime.now()}] Worker heartbeat error for '{hostname}': {e}")
+        return jsonify({"error": f"Heartbeat failed: {str(e)}"}), 500
+    finally:
+        cur.close()
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Handles user login for both OIDC and the local fallback mechanism."""
@@ -1621,11 +2009,18 @@ def options():
         'worker_poll_interval': request.form.get('worker_poll_interval', '30'),
         'arr_rename_delay_seconds': request.form.get('arr_rename_delay_seconds', '60'),
         'min_length': request.form.get('min_length', '0.5'),
+        'segment_duration_minutes': request.form.get('segment_duration_minutes', '10'),
+        'checkpoint_segment_minutes': request.form.get('checkpoint_segment_minutes', '0'),
+        'sample_encode_enabled': 'true' if 'sample_encode_enabled' in request.form else 'false',
+        'min_savings_percent': request.form.get('min_savings_percent', '10'),
+        'size_guard_percent': request.form.get('size_guard_percent', '0'),
         'backup_directory': request.form.get('backup_directory', ''),
         'backup_time': request.form.get('backup_time', '02:00'),
         'backup_enabled': 'true' if 'backup_enabled' in request.form else 'false',
         'backup_retention_days': retention_days_str,
         'hardware_acceleration': request.form.get('hardware_acceleration', 'auto'),
+        'codec_family': request.form.get('codec_family', 'hevc'),
+        'speed_tier': request.form.get('speed_tier', 'balanced'),
         'keep_original': 'true' if 'keep_original' in request.form else 'false',
         'allow_hevc': 'true' if 'allow_hevc' in request.form else 'false',
         'allow_av1': 'true' if 'allow_av1' in request.form else 'false',
@@ -1745,9 +2140,31 @@ def options():
 
     return redirect(url_for('dashboard', _anchor='options-tab-pane'))
 
+@app.route('/api/media_descriptor', methods=['POST'])
+def api_media_descriptor():
+    """
+    Parses the JSON output of 'ffprobe -show_streams -show_format' uploaded by a worker into a media
+    descriptor. Workers use it for jobs that were queued without one, so the descriptor is always
+    computed by the same code as at scan time.
+    """
+    probe = (request.get_json(silent=True) or {}).get('probe')
+    if not isinstance(probe, dict):
+        return jsonify(error="Expected the ffprobe JSON output in 'probe'"), 400
+    return jsonify(media_info=parse_media_descriptor(probe))
+
 @app.route('/api/settings', methods=['GET'])
 def api_settings():
-    """Returns all worker settings as JSON."""
+    """
+    Returns all worker settings as JSON. The response carries an ETag based on the settings version,
+    and a request with a matching If-None-Match header gets an empty 304 response.
+    """
+    settings_version = get_settings_version()
+    etag = f"settings-{settings_version}"
+    if settings_version is not None and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
     settings, db_error = get_worker_settings()
     if db_error:
         return jsonify(settings={}, error=db_error), 500
@@ -1763,7 +2180,10 @@ def api_settings():
             # Fallback if structure is different
             flat_settings[key] = value_dict
     
-    return jsonify(settings=flat_settings, dashboard_version=get_project_version())
+    response = jsonify(settings=flat_settings, dashboard_version=get_project_version(), settings_version=settings_version)
+    if settings_version is not None:
+        response.set_etag(etag)
+    return response
 
 @app.route('/api/backup/now', methods=['POST'])
 def api_backup_now():
@@ -1881,12 +2301,18 @@ def api_clear_jobs():
         with db.cursor() as cur:
             if force:
                 # Force clear: Remove ALL jobs regardless of status
+                cur.execute("SELECT id FROM jobs WHERE job_type = 'transcode_segmented'")
+                directories = segment_directories(cur, [row[0] for row in cur.fetchall()])
                 cur.execute("DELETE FROM jobs;")
                 message = "All jobs forcefully cleared from queue."
             else:
                 # Normal clear: Remove pending jobs and internal jobs
+                cur.execute("SELECT id FROM jobs WHERE status = 'pending' AND job_type = 'transcode_segmented'")
+                directories = segment_directories(cur, [row[0] for row in cur.fetchall()])
                 cur.execute("DELETE FROM jobs WHERE status = 'pending' OR job_type IN ('Rename Job', 'Quality Mismatch');")
                 message = "Job queue cleared successfully."
+            # Queued after the delete, so the cleanup jobs themselves are not cleared
+            queue_segment_cleanup(cur, directories)
         db.commit()
         return jsonify(success=True, message=message)
     except Exception as e:
@@ -1899,8 +2325,10 @@ def api_delete_job(job_id):
     try:
         db = get_db()
         with db.cursor() as cur:
+            directories = segment_directories(cur, [job_id])
             cur.execute("DELETE FROM jobs WHERE id = %s", (job_id,))
             rowcount = cur.rowcount
+            queue_segment_cleanup(cur, directories)
         db.commit()
         if rowcount == 0:
             return jsonify(success=False, error="Job not found."), 404
@@ -1920,6 +2348,13 @@ def api_requeue_job(job_id):
                 (job_id,)
             )
             rowcount = cur.rowcount
+            # A segmented job that already has encoded segments only needs its unfinished segments again
+            cur.execute("""
+                UPDATE job_segments SET status = 'pending', assigned_to = NULL, attempts = 0, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = %s AND status <> 'completed'
+            """, (job_id,))
+            if cur.rowcount > 0:
+                cur.execute("UPDATE jobs SET status = 'segmenting' WHERE id = %s", (job_id,))
         db.commit()
         if rowcount == 0:
             return jsonify(success=False, error="Job not found."), 404
@@ -1928,6 +2363,25 @@ def api_requeue_job(job_id):
         print(f"Error re-queuing job {job_id}: {e}")
         return jsonify(success=False, error=str(e)), 500
 
+@app.route('/api/jobs/segment/<int:job_id>', methods=['POST'])
+def api_segment_job(job_id):
+    """Turns a pending transcode job into a 'transcode_segmented' job that several workers encode together."""
+    try:
+        db = get_db()
+        with db.cursor() as cur:
+            cur.execute(
+                "UPDATE jobs SET job_type = 'transcode_segmented', updated_at = CURRENT_TIMESTAMP WHERE id = %s AND job_type = 'transcode' AND status = 'pending'",
+                (job_id,)
+            )
+            rowcount = cur.rowcount
+        db.commit()
+        if rowcount == 0:
+            return jsonify(success=False, error="Only pending transcode jobs can be split into segments."), 400
+        return jsonify(success=True, message=f"Job {job_id} will be encoded in segments across all workers.")
+    except Exception as e:
+        print(f"Error converting job {job_id} to a segmented job: {e}")
+        return jsonify(success=False, error=str(e)), 500
+
 @app.route('/api/jobs', methods=['GET'])
 def api_jobs():
     """Returns a paginated and optionally filtered list of the current job queue as JSON."""
@@ -1978,16 +2432,21 @@ def api_jobs():
                 SELECT jobs.*,
                        EXTRACT(EPOCH FROM (NOW() - jobs.updated_at)) / 60 AS age_minutes,
                        EXTRACT(EPOCH FROM (NOW() - nodes.last_heartbeat)) / 60 AS minutes_since_heartbeat,
-                       (SELECT MAX(id) FROM jobs AS j2 WHERE j2.assigned_to = jobs.assigned_to AND j2.status = 'encoding' AND j2.id > jobs.id) AS higher_job_id_by_same_worker
+                       (SELECT MAX(id) FROM jobs AS j2 WHERE j2.assigned_to = jobs.assigned_to AND j2.status = 'encoding' AND j2.id > jobs.id) AS higher_job_id_by_same_worker,
+                       EXISTS (SELECT 1 FROM node_slots WHERE node_slots.hostname = jobs.assigned_to AND node_slots.job_id = jobs.id) AS active_in_slot,
+                       (SELECT COUNT(*) FROM job_segments WHERE job_segments.job_id = jobs.id) AS segments_total,
+                       (SELECT COUNT(*) FROM job_segments WHERE job_segments.job_id = jobs.id AND job_segments.status = 'completed') AS segments_completed
                 FROM jobs
                 LEFT JOIN nodes ON jobs.assigned_to = nodes.hostname
                 {where_sql}
                 ORDER BY
                     CASE jobs.status
                         WHEN 'encoding' THEN 1
-                        WHEN 'pending' THEN 2
-                        WHEN 'failed' THEN 3
-                        ELSE 4
+                        WHEN 'segmenting' THEN 1
+                        WHEN 'leased' THEN 2
+                        WHEN 'pending' THEN 3
+                        WHEN 'failed' THEN 4
+                        ELSE 5
                     END,
                     jobs.created_at DESC
                 LIMIT %s OFFSET %s
@@ -2003,7 +2462,8 @@ def api_jobs():
                     job['assigned_to'] and 
                     job['minutes_since_heartbeat'] is not None and 
                     job['minutes_since_heartbeat'] < 10 and  # Worker is still online
-                    job['higher_job_id_by_same_worker'] is not None  # Worker is processing higher job IDs
+                    job['higher_job_id_by_same_worker'] is not None and  # Worker is processing higher job IDs
+                    not job['active_in_slot']  # Multi-slot workers run several jobs at once
                 )
             
             # Query for the total number of jobs to calculate total pages (respecting filters)
@@ -2054,8 +2514,12 @@ def api_status():
         # Add the 'percent' key for the client-side rendering
         node['percent'] = int(node.get('progress') or 0)
 
-        # Re-implement Speed and Codec for the UI
-        node['speed'] = round(node.get('fps', 0) / 24, 1) if node.get('fps') else 0.0
+        # Speed comes from ffmpeg's progress output. Older workers don't report it,
+        # so fall back to the previous fps-based estimate for them.
+        if node.get('speed'):
+            node['speed'] = round(node['speed'], 2)
+        else:
+            node['speed'] = round(node.get('fps', 0) / 24, 1) if node.get('fps') else 0.0
         node['codec'] = 'hevc'
         
         # Calculate estimated finish time
@@ -2151,6 +2615,202 @@ def api_resume_node(hostname):
         return jsonify(success=False, error=error), 500
     return jsonify(success=True, message=f"Resume command sent to node '{hostname}'.")
 
+@app.route('/api/nodes/<hostname>/quit', methods=['POST'])
+def api_quit_node(hostname):
+    """API endpoint to send a 'quit' command to a node, which stops its encodes and exits the worker."""
+    success, error = set_node_status(hostname, 'quit')
+    if not success:
+        return jsonify(success=False, error=error), 500
+    return jsonify(success=True, message=f"Quit command sent to node '{hostname}'.")
+
+@app.route('/api/nodes/<hostname>/command', methods=['GET'])
+def api_node_command(hostname):
+    """
+    Command stream for workers. Returns the node's command, slot limit and hardware refresh flag
+    together with a token. When 'since' matches the current token, the request is held open for
+    up to 'wait' seconds until the node's command or options change (long-poll).
+    """
+    since = request.args.get('since')
+    try:
+        wait_seconds = max(0.0, min(float(request.args.get('wait') or 0), MAX_COMMAND_WAIT_SECONDS))
+    except (ValueError, TypeError):
+        wait_seconds = 0.0
+    # The command stream shares the long-poll waiter budget with job requests. Without a free place
+    # the worker is told to come back later instead of polling again right away.
+    waiting = wait_seconds > 0 and acquire_long_poll_waiter()
+    if not waiting:
+        wait_seconds = 0.0
+    deadline = time.monotonic() + wait_seconds
+
+    try:
+        while True:
+            generation = node_command_generation
+            db = get_db()
+            if db is None:
+                return jsonify(error="Cannot connect to the PostgreSQL database."), 500
+            with db.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT n.command, o.max_slots, o.resources, n.hardware_refresh_requested FROM nodes n
+                    LEFT JOIN node_options o ON o.hostname = n.hostname
+                    WHERE n.hostname = %s
+                """, (hostname,))
+                control = cur.fetchone() or {'command': 'idle', 'max_slots': None, 'resources': None, 'hardware_refresh_requested': False}
+            db.commit() # Don't hold a transaction open while waiting
+            resources_hash = hashlib.sha1(json.dumps(control['resources'], sort_keys=True).encode()).hexdigest()[:12]
+            control['token'] = f"{control['command']}:{control['max_slots']}:{resources_hash}:{bool(control['hardware_refresh_requested'])}"
+            if control['token'] != since:
+                return jsonify(control)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if not waiting and since:
+                    control['retry_after'] = LONG_POLL_RETRY_SECONDS
+                return jsonify(control)
+            release_db() # Don't hold a database connection while waiting
+            if not wait_for_node_command(generation, remaining):
+                return jsonify(control)
+    except Exception as e:
+        if g.get('db') is not None:
+            g.db.rollback()
+        return jsonify(error=f"Database query failed: {e}"), 500
+    finally:
+        if waiting:
+            long_poll_waiters.release()
+
+@app.route('/api/nodes/<hostname>/refresh_hardware', methods=['POST'])
+def api_refresh_node_hardware(hostname):
+    """API endpoint to ask a node to re-probe its hardware capabilities."""
+    db = get_db()
+    if db is None:
+        return jsonify(success=False, error="Cannot connect to the PostgreSQL database."), 500
+    try:
+        with db.cursor() as cur:
+            cur.execute("UPDATE nodes SET hardware_refresh_requested = true WHERE hostname = %s", (hostname,))
+            updated = cur.rowcount
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        return jsonify(success=False, error=f"Database query failed: {e}"), 500
+    if not updated:
+        return jsonify(success=False, error=f"Node '{hostname}' not found."), 404
+    return jsonify(success=True, message=f"Hardware re-detection requested for node '{hostname}'.")
+
+@app.route('/api/nodes/<hostname>/options', methods=['GET'])
+def api_get_node_options(hostname):
+    """Returns the per-node options for a worker."""
+    db = get_db()
+    if db is None:
+        return jsonify(success=False, error="Cannot connect to the PostgreSQL database."), 500
+    try:
+        with db.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT max_slots, benchmark, resources FROM node_options WHERE hostname = %s", (hostname,))
+            options = cur.fetchone() or {'max_slots': None, 'benchmark': None, 'resources': None}
+    except Exception as e:
+        return jsonify(success=False, error=f"Database query failed: {e}"), 500
+    return jsonify(success=True, options=options)
+
+IONICE_CLASSES = ('best-effort', 'idle')
+
+def parse_resource_profile(data):
+    """
+    Validates the CPU resource profile from the node options dialog. Empty fields are left out;
+    returns None if no field is set. Raises ValueError with a message for the user.
+    """
+    profile = {}
+    for key, label, low, high in (('threads', 'Threads', 1, 256), ('frame_threads', 'Frame threads', 1, 16), ('nice', 'Nice', 1, 19)):
+        value = data.get(key)
+        if value in (None, ''):
+            continue
+        try:
+            value = int(value)
+        except (ValueError, TypeError):
+            raise ValueError(f"{label} must be a whole number.")
+        if not low <= value <= high:
+            raise ValueError(f"{label} must be between {low} and {high}.")
+        profile[key] = value
+    pools = str(data.get('pools') or '').strip()
+    if pools:
+        # x265 pool syntax: a thread count per NUMA node, '+' for all, '-' for none, or 'none'
+        if not re.fullmatch(r'none|[0-9+\-*]+(,[0-9+\-*]+)*', pools):
+            raise ValueError("x265 pools must look like '8', '+', '-,+' or 'none'.")
+        profile['pools'] = pools
+    cpuset = str(data.get('cpuset') or '').replace(' ', '')
+    if cpuset:
+        if not re.fullmatch(r'\d+(-\d+)?(,\d+(-\d+)?)*', cpuset):
+            raise ValueError("CPU affinity must be a CPU list such as '0-3,8-11'.")
+        profile['cpuset'] = cpuset
+    ionice = data.get('ionice') or ''
+    if ionice:
+        if ionice not in IONICE_CLASSES:
+            raise ValueError("I/O priority must be 'best-effort' or 'idle'.")
+        profile['ionice'] = ionice
+    cpu_limit = data.get('cpu_limit')
+    if cpu_limit not in (None, ''):
+        try:
+            cpu_limit = float(cpu_limit)
+        except (ValueError, TypeError):
+            raise ValueError("CPU limit must be a number of CPUs.")
+        if not 0.1 <= cpu_limit <= 1024:
+            raise ValueError("CPU limit must be between 0.1 and 1024 CPUs.")
+        profile['cpu_limit'] = cpu_limit
+    return profile or None
+
+@app.route('/api/nodes/<hostname>/options', methods=['POST'])
+def api_save_node_options(hostname):
+    """
+    Saves the per-node options for a worker. An empty max_slots falls back to the worker's WORKER_SLOTS,
+    an empty resource profile lets encodes use the whole machine.
+    """
+    data = request.json or {}
+    max_slots = data.get('max_slots')
+    if max_slots in (None, ''):
+        max_slots = None
+    else:
+        try:
+            max_slots = max(1, min(16, int(max_slots)))
+        except (ValueError, TypeError):
+            return jsonify(success=False, error="max_slots must be a number between 1 and 16."), 400
+    try:
+        resources = parse_resource_profile(data.get('resources') or {})
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+
+    db = get_db()
+    if db is None:
+        return jsonify(success=False, error="Cannot connect to the PostgreSQL database."), 500
+    try:
+        with db.cursor() as cur:
+            cur.execute("""
+                INSERT INTO node_options (hostname, max_slots, resources, updated_at) VALUES (%s, %s, %s, NOW())
+                ON CONFLICT (hostname) DO UPDATE SET max_slots = EXCLUDED.max_slots, resources = EXCLUDED.resources, updated_at = NOW();
+            """, (hostname, max_slots, Json(resources) if resources else None))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        return jsonify(success=False, error=f"Database query failed: {e}"), 500
+    return jsonify(success=True, message=f"Options saved for node '{hostname}'.")
+
+@app.route('/api/nodes/<hostname>/benchmark', methods=['POST'])
+def api_save_node_benchmark(hostname):
+    """Stores the encoder benchmark report a worker produced with 'transcode.py --benchmark --benchmark-post'."""
+    report = request.json
+    if not isinstance(report, dict) or not isinstance(report.get('results'), list):
+        return jsonify(success=False, error="A benchmark report with a 'results' list is required."), 400
+
+    db = get_db()
+    if db is None:
+        return jsonify(success=False, error="Cannot connect to the PostgreSQL database."), 500
+    try:
+        with db.cursor() as cur:
+            cur.execute("""
+                INSERT INTO node_options (hostname, benchmark, updated_at) VALUES (%s, %s, NOW())
+                ON CONFLICT (hostname) DO UPDATE SET benchmark = EXCLUDED.benchmark, updated_at = NOW();
+            """, (hostname, Json(report)))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        return jsonify(success=False, error=f"Database query failed: {e}"), 500
+    return jsonify(success=True, message=f"Benchmark stored for node '{hostname}'.")
+
 @app.route('/api/nodes/start-all', methods=['POST'])
 def api_start_all_nodes():
     """API endpoint to start all active nodes."""
@@ -2236,14 +2896,28 @@ def api_history():
     
     history, db_error = get_history(limit=limit)
     for item in history:
-        # Format datetime and sizes for display
-        item['encoded_at'] = item['encoded_at'].strftime('%Y-%m-%d %H:%M:%S')
-        item['original_size_gb'] = round(item['original_size'] / (1024**3), 2)
-        item['new_size_gb'] = round(item['new_size'] / (1024**3), 2)
-        item['reduction_percent'] = round((1 - item['new_size'] / item['original_size']) * 100, 1) if item['original_size'] > 0 else 0
-        item['codec'] = 'hevc' # Add the missing codec key
+        format_history_item(item)
     return jsonify(history=history, db_error=db_error)
 
+def format_history_item(item):
+    """Formats the datetime and sizes of a history entry for display."""
+    def size_gb(size):
+        return round(size / (1024**3), 2) if size is not None else None
+
+    def reduction(size):
+        if size is None:
+            return None
+        return round((1 - size / item['original_size']) * 100, 1) if item['original_size'] else 0
+
+    item['encoded_at'] = item['encoded_at'].strftime('%Y-%m-%d %H:%M:%S')
+    item['original_size_gb'] = size_gb(item['original_size'])
+    # Files that were skipped or aborted were never replaced and only have a predicted size
+    item['new_size_gb'] = size_gb(item['new_size'])
+    item['reduction_percent'] = reduction(item['new_size'])
+    item['predicted_size_gb'] = size_gb(item.get('predicted_size'))
+    item['predicted_reduction_percent'] = reduction(item.get('predicted_size'))
+    item['codec'] = 'hevc' # Add the missing codec key
+
 @app.route('/api/history/clear', methods=['POST'])
 def clear_history():
     """Truncates the encoded_files table to clear all history."""
@@ -2321,11 +2995,7 @@ def api_stats():
 
         # Process history for display
         for item in history:
-            item['encoded_at'] = item['encoded_at'].strftime('%Y-%m-%d %H:%M:%S')
-            item['original_size_gb'] = round(item['original_size'] / (1024**3), 2)
-            item['new_size_gb'] = round(item['new_size'] / (1024**3), 2)
-            item['reduction_percent'] = round((1 - item['new_size'] / item['original_size']) * 100, 1) if item['original_size'] > 0 else 0
-            item['codec'] = 'hevc' # Add the missing codec key
+            format_history_item(item)
 
     except Exception as e:
         db_error = f"Database query failed: {e}"
@@ -3408,6 +4078,11 @@ def run_lidarr_rename_scan():
             if scanner_lock.locked():
                 scanner_lock.release()
 
+def probe_media_descriptor(filepath):
+    """Probes a file once with ffprobe and returns its media descriptor."""
+    ffprobe_cmd = ["ffprobe", "-v", "error", "-show_streams", "-show_format", "-of", "json", filepath]
+    return parse_media_descriptor(json.loads(subprocess.check_output(ffprobe_cmd, text=True)))
+
 def run_internal_scan(force_scan=False):
     """
     The core logic for scanning local directories.
@@ -3488,9 +4163,9 @@ def run_internal_scan(force_scan=False):
                             # Check if file is a symbolic link
                             is_symlink = os.path.islink(filepath)
                             
-                            # Use ffprobe to get the video codec
-                            ffprobe_cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=codec_name", "-of", "default=noprint_wrappers=1:nokey=1", filepath]
-                            codec = subprocess.check_output(ffprobe_cmd, text=True).strip().lower()
+                            # Probe the file once. The descriptor is stored with the job so the worker doesn't probe it again.
+                            media_info = probe_media_descriptor(filepath)
+                            codec = media_info['codec']
                             
                             print(f"  - Checking: {os.path.basename(filepath)} (Codec: {codec or 'N/A'}{', Symlink' if is_symlink else ''})")
                             if codec and codec not in skip_codecs:
@@ -3498,16 +4173,16 @@ def run_internal_scan(force_scan=False):
                                     # Add symbolic links with 'awaiting_approval' status and metadata warning
                                     print(f"    -> Adding symbolic link to queue with approval required (codec: {codec}).")
                                     metadata = json.dumps({"is_symlink": True, "warning": SYMLINK_WARNING})
-                                    cur.execute("INSERT INTO jobs (filepath, job_type, status, metadata) VALUES (%s, 'transcode', 'awaiting_approval', %s) ON CONFLICT (filepath) DO NOTHING", (filepath, metadata))
+                                    cur.execute("INSERT INTO jobs (filepath, job_type, status, metadata, media_info) VALUES (%s, 'transcode', 'awaiting_approval', %s, %s) ON CONFLICT (filepath) DO NOTHING", (filepath, metadata, Json(media_info)))
                                     if cur.rowcount > 0:
                                         new_files_found += 1
                                 else:
                                     # Add regular files as pending
                                     print(f"    -> Adding file to queue (codec: {codec}).")
-                                    cur.execute("INSERT INTO jobs (filepath, job_type, status) VALUES (%s, 'transcode', 'pending') ON CONFLICT (filepath) DO NOTHING", (filepath,))
+                                    cur.execute("INSERT INTO jobs (filepath, job_type, status, media_info) VALUES (%s, 'transcode', 'pending', %s) ON CONFLICT (filepath) DO NOTHING", (filepath, Json(media_info)))
                                     if cur.rowcount > 0:
                                         new_files_found += 1
-                        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+                        except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
                             print(f"    -> Could not probe file '{filepath}'. Error: {e}")
 
             conn.commit()
@@ -4208,7 +4883,7 @@ def api_export_data():
                 export_data["jobs"].append(job_entry)
             
             # Export encoded files history
-            cur.execute("SELECT filename, original_size, new_size, encoded_by, encoded_at, status FROM encoded_files")
+            cur.execute("SELECT filename, original_size, new_size, predicted_size, encoded_by, encoded_at, status FROM encoded_files")
             for row in cur.fetchall():
                 file_entry = dict(row)
                 file_entry['encoded_at'] = row['encoded_at'].isoformat() if row['encoded_at'] else None
@@ -4251,6 +4926,87 @@ def toggle_pause_queue():
     else:
         return jsonify(success=False, error=error), 500
 
+# Workers keep the encoded segments of a segmented job in this hidden directory next to the source
+SEGMENT_DIR_PREFIX = ".librarrarian_segments_"
+
+def segment_directories(cur, job_ids):
+    """
+    Returns the segment directories of the segmented jobs in job_ids that were split into segments.
+    Must run before the jobs are deleted, as their segments go with them.
+    """
+    if not job_ids:
+        return []
+    # A plain cursor in the same transaction, whatever cursor factory the caller uses
+    with cur.connection.cursor() as plain_cur:
+        plain_cur.execute("""
+            SELECT id, filepath FROM jobs
+            WHERE id = ANY(%s) AND job_type = 'transcode_segmented' AND EXISTS (SELECT 1 FROM job_segments WHERE job_segments.job_id = jobs.id)
+        """, (list(job_ids),))
+        rows = plain_cur.fetchall()
+    return [os.path.join(os.path.dirname(filepath), f"{SEGMENT_DIR_PREFIX}{job_id}") for job_id, filepath in rows]
+
+def queue_segment_cleanup(cur, directories):
+    """Queues a 'segment_cleanup' job per segment directory, so a worker removes it from the media share."""
+    for directory in directories:
+        cur.execute("INSERT INTO jobs (filepath, job_type, status) VALUES (%s, 'segment_cleanup', 'pending')", (directory,))
+
+def fail_segmented_job(cur, job_id):
+    """
+    Removes the segments of a segmented job that failed for good. Their files are deleted by a cleanup
+    job, and re-queueing the job encodes the file from the start instead of reusing a partial set.
+    """
+    directories = segment_directories(cur, [job_id])
+    cur.execute("DELETE FROM job_segments WHERE job_id = %s", (job_id,))
+    queue_segment_cleanup(cur, directories)
+
+def claim_segment(cur, worker_hostname):
+    """Claims the oldest pending segment of a segmented job. Returns the worker's job payload or None."""
+    cur.execute("""
+        SELECT s.job_id, s.segment_index, s.start_time, s.end_time, j.filepath, j.media_info,
+               s.segment_index = (SELECT MAX(segment_index) FROM job_segments AS s2 WHERE s2.job_id = s.job_id) AS is_last
+        FROM job_segments AS s
+        JOIN jobs AS j ON j.id = s.job_id
+        WHERE s.status = 'pending' AND j.status = 'segmenting'
+        ORDER BY j.created_at, s.segment_index
+        LIMIT 1
+        FOR UPDATE OF s SKIP LOCKED
+    """)
+    segment = cur.fetchone()
+    if not segment:
+        return None
+    cur.execute("""
+        UPDATE job_segments SET status = 'encoding', assigned_to = %s, attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE job_id = %s AND segment_index = %s
+    """, (worker_hostname, segment['job_id'], segment['segment_index']))
+    return {
+        "job_id": segment['job_id'],
+        "filepath": segment['filepath'],
+        "job_type": "transcode_segment",
+        "media_info": segment['media_info'],
+        "segment": {
+            "index": segment['segment_index'],
+            "start": segment['start_time'],
+            "end": segment['end_time'],
+            "is_last": segment['is_last'],
+        },
+    }
+
+def build_job_payload(cur, job):
+    """Builds the job description sent to a worker, including the phase of segmented jobs."""
+    payload = {"job_id": job['id'], "filepath": job['filepath'], "job_type": job['job_type']}
+    if job.get('media_info'):
+        payload["media_info"] = job['media_info']
+    if job['job_type'] == 'transcode_segmented':
+        cur.execute("SELECT segment_index, start_time, end_time FROM job_segments WHERE job_id = %s ORDER BY segment_index", (job['id'],))
+        segments = cur.fetchall()
+        if segments:
+            # All segments are encoded (see update_job), so the job is ready to be joined
+            payload["phase"] = "concat"
+            payload["segments"] = [{"index": s['segment_index'], "start": s['start_time'], "end": s['end_time']} for s in segments]
+        else:
+            payload["phase"] = "plan"
+    return payload
+
 @app.route('/api/request_job', methods=['POST'])
 def request_job():
     """Endpoint for workers to request a new job."""
@@ -4269,29 +5025,182 @@ def request_job():
         print(f"[{datetime.now()}] Job request from {worker_hostname} denied: Queue is paused.")
         return jsonify({}) # Return empty response as if no jobs are available
 
-    conn = get_db()
+    # A pipelined worker can lease its next job while the current one is finishing (lease_seconds),
+    # and later start it by sending the leased job's id back (leased_job_id).
+    leased_job_id = request.json.get('leased_job_id')
+    try:
+        lease_seconds = min(int(request.json.get('lease_seconds') or 0), MAX_JOB_LEASE_SECONDS)
+    except (ValueError, TypeError):
+        lease_seconds = 0
+
+    # Workers skip their settings fetch when this matches the version of their local copy
+    settings_version = get_settings_version()
+
+    # With 'wait', an empty queue holds the request open until a job becomes available (long-poll)
+    try:
+        wait_seconds = max(0.0, min(float(request.json.get('wait') or 0), MAX_JOB_WAIT_SECONDS))
+    except (ValueError, TypeError):
+        wait_seconds = 0.0
+    waiting = wait_seconds > 0 and acquire_long_poll_waiter()
+    if not waiting:
+        wait_seconds = 0.0 # All waiter places are taken, answer right away
+    deadline = time.monotonic() + wait_seconds
+
+    try:
+        while True:
+            generation = job_available_generation
+            payload = claim_next_job(get_db(), worker_hostname, leased_job_id, lease_seconds)
+            if payload:
+                return jsonify({**payload, "settings_version": settings_version})
+            leased_job_id = None # A lease can only be started once
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return jsonify({}) # No pending jobs
+            release_db() # Don't hold a database connection while waiting
+            if not wait_for_job(generation, remaining):
+                return jsonify({})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if waiting:
+            long_poll_waiters.release()
+
+def claim_next_job(conn, worker_hostname, leased_job_id=None, lease_seconds=0):
+    """
+    Claims the next job or segment for a worker in a single transaction.
+    Returns the job payload for the worker, or None if nothing is available.
+    """
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
     try:
         cur.execute("BEGIN;") # Start a transaction
+        # Leases that were never started (worker stopped or crashed) go back to the queue
+        cur.execute("UPDATE jobs SET status = 'pending', assigned_to = NULL, lease_expires_at = NULL WHERE status = 'leased' AND lease_expires_at < NOW()")
+
+        if leased_job_id:
+            cur.execute("""
+                UPDATE jobs SET status = 'encoding', lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND status = 'leased' AND assigned_to = %s
+                RETURNING id, filepath, job_type, media_info
+            """, (leased_job_id, worker_hostname))
+            job = cur.fetchone()
+            if job:
+                payload = build_job_payload(cur, job)
+                conn.commit()
+                return payload
+            # The lease has expired and the job went back to the queue. Fall through and claim the next job.
+
+        # Segments of a segmented job come first, so long files are finished by all workers together.
+        # Segments are never leased; a pipelined worker picks them up when it starts its next job.
+        if lease_seconds <= 0:
+            segment = claim_segment(cur, worker_hostname)
+            if segment:
+                conn.commit()
+                return segment
+
         # This query now explicitly excludes internal job types that are not meant for workers.
-        cur.execute("SELECT id, filepath, job_type FROM jobs WHERE status = 'pending' AND job_type NOT IN ('Rename Job', 'Quality Mismatch') ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED")
+        cur.execute("SELECT id, filepath, job_type, media_info FROM jobs WHERE status = 'pending' AND job_type NOT IN ('Rename Job', 'Quality Mismatch') ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED")
         job = cur.fetchone()
 
-        if job:
+        if job and lease_seconds > 0:
+            cur.execute(
+                "UPDATE jobs SET status = 'leased', assigned_to = %s, lease_expires_at = NOW() + make_interval(secs => %s), updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                (worker_hostname, lease_seconds, job['id'])
+            )
+            payload = build_job_payload(cur, job)
+            conn.commit()
+            return {**payload, "lease_seconds": lease_seconds}
+        elif job:
             cur.execute("UPDATE jobs SET status = 'encoding', assigned_to = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (worker_hostname, job['id']))
+            payload = build_job_payload(cur, job)
             conn.commit()
             # Return the full job details to the worker
-            return jsonify({"job_id": job['id'], "filepath": job['filepath'], "job_type": job['job_type']})
+            return payload
         else:
             conn.commit() # release lock
-            return jsonify({}) # No pending jobs
-    except Exception as e:
+            return None
+    except Exception:
         conn.rollback()
-        return jsonify({"error": str(e)}), 500
+        raise
     finally:
         cur.close()
 
+# --- Long-Poll Waiters ---
+# Job requests and node command streams share one budget of parked requests (LONG_POLL_MAX_WAITERS).
+long_poll_waiters = threading.BoundedSemaphore(LONG_POLL_MAX_WAITERS) if LONG_POLL_MAX_WAITERS > 0 else None
+
+def acquire_long_poll_waiter():
+    """Takes one of the long-poll waiter places without blocking. Returns False if all are taken."""
+    return long_poll_waiters is not None and long_poll_waiters.acquire(blocking=False)
+
+# --- Job Availability Notifications ---
+# Long-polling job requests wait on this condition. notification_listener_thread() advances the generation
+# whenever PostgreSQL reports that a job or segment became pending (see migration v28).
+job_available = threading.Condition()
+job_available_generation = 0
+
+def wait_for_job(generation, timeout):
+    """Waits until a job may have become available since 'generation'. Returns False on timeout."""
+    with job_available:
+        return job_available.wait_for(lambda: job_available_generation != generation, timeout)
+
+def signal_job_available():
+    global job_available_generation
+    with job_available:
+        job_available_generation += 1
+        job_available.notify_all()
+
+# --- Node Command Notifications ---
+# Workers long-poll /api/nodes/<hostname>/command. The generation advances whenever any node's
+# command or options change (see migration v29); each waiting request then re-reads its own node.
+node_command_changed = threading.Condition()
+node_command_generation = 0
+
+def wait_for_node_command(generation, timeout):
+    """Waits until a node command may have changed since 'generation'. Returns False on timeout."""
+    with node_command_changed:
+        return node_command_changed.wait_for(lambda: node_command_generation != generation, timeout)
+
+def signal_node_command():
+    global node_command_generation
+    with node_command_changed:
+        node_command_generation += 1
+        node_command_changed.notify_all()
+
+def notification_listener_thread():
+    """Listens for notifications from PostgreSQL and wakes up waiting job requests and command streams."""
+    db_ready_event.wait()
+    print("Database notification listener is now active.")
+
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**DB_CONFIG)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute("LISTEN job_available;")
+                cur.execute("LISTEN node_command;")
+            # Anything may have changed while the listener was disconnected
+            signal_node_command()
+            while True:
+                # Wake up regularly so expired leases are picked up by waiting requests too
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    signal_job_available()
+                    continue
+                conn.poll()
+                channels = {notify.channel for notify in conn.notifies}
+                conn.notifies.clear()
+                if 'job_available' in channels:
+                    signal_job_available()
+                if 'node_command' in channels:
+                    signal_node_command()
+        except Exception as e:
+            print(f"[{datetime.now()}] Error in notification_listener_thread: {e}")
+            time.sleep(10)
+        finally:
+            if conn is not None:
+                conn.close()
+
 def trigger_arr_rescan_and_rename(filepath, settings):
     """
     Triggers a rescan in Sonarr/Radarr for the file's parent series/movie,
@@ -4401,11 +5310,26 @@ def trigger_arr_rescan_and_rename(filepath, settings):
 def update_job(job_id):
     """Endpoint for workers to update the status of a job."""
     data = request.json
-    status = data.get('status')  # 'completed' or 'failed'
+    status = data.get('status')  # 'completed', 'failed', 'interrupted', 'skipped_low_gain' or 'aborted_low_gain'
 
     conn = get_db()
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
+    # Workers retry updates whose response got lost. The key is recorded in the same transaction
+    # as the update itself, so a retry of an update that was already applied is acknowledged without
+    # being applied again (a completed job is already gone from the queue by then).
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key:
+        cur.execute(
+            "INSERT INTO job_updates (idempotency_key, job_id, status) VALUES (%s, %s, %s) ON CONFLICT (idempotency_key) DO NOTHING",
+            (idempotency_key[:128], job_id, status)
+        )
+        if cur.rowcount == 0:
+            conn.rollback()
+            cur.close()
+            return jsonify({"message": f"Update for job {job_id} was already applied.", "duplicate": True})
+        cur.execute("DELETE FROM job_updates WHERE created_at < NOW() - INTERVAL '7 days'")
+
     # Fetch job details to know its type
     cur.execute("SELECT * FROM jobs WHERE id = %s", (job_id,))
     job = cur.fetchone()
@@ -4413,8 +5337,43 @@ def update_job(job_id):
     if not job:
         return jsonify({"error": "Job not found"}), 404
 
+    if job['job_type'] == 'transcode_segmented' and data.get('segment_index') is not None:
+        message = update_job_segment(cur, job, int(data['segment_index']), status, data)
+        conn.commit()
+        cur.close()
+        return jsonify({"message": message})
+
+    if job['job_type'] == 'transcode_segmented' and status == 'completed' and 'keyframes' in data:
+        # First phase of a segmented job: split the file at the keyframes reported by the worker
+        settings, _ = get_worker_settings()
+        try:
+            segment_seconds = max(60.0, float(settings.get('segment_duration_minutes', {}).get('setting_value', '10')) * 60)
+        except (ValueError, TypeError):
+            segment_seconds = 600.0
+        segments = plan_segments(data.get('keyframes') or [], float(data.get('duration') or 0), segment_seconds)
+        for index, (start, end) in enumerate(segments):
+            cur.execute(
+                "INSERT INTO job_segments (job_id, segment_index, start_time, end_time) VALUES (%s, %s, %s, %s) ON CONFLICT (job_id, segment_index) DO NOTHING",
+                (job_id, index, start, end)
+            )
+        cur.execute("UPDATE jobs SET status = 'segmenting', assigned_to = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+        conn.commit()
+        cur.close()
+        return jsonify({"message": f"Job {job_id} split into {len(segments)} segments."})
+
+    if job['job_type'] == 'transcode_segmented' and status == 'failed' and data.get('missing_segments'):
+        # Segment files disappeared before they could be joined: encode just those segments again
+        cur.execute(
+            "UPDATE job_segments SET status = 'pending', assigned_to = NULL, attempts = 0, updated_at = CURRENT_TIMESTAMP WHERE job_id = %s AND segment_index = ANY(%s)",
+            (job_id, data['missing_segments'])
+        )
+        cur.execute("UPDATE jobs SET status = 'segmenting', assigned_to = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+        conn.commit()
+        cur.close()
+        return jsonify({"message": f"Job {job_id}: re-queued {len(data['missing_segments'])} missing segments."})
+
     if status == 'completed':
-        if job['job_type'] == 'transcode':
+        if job['job_type'] in ('transcode', 'transcode_segmented'):
             # For transcodes, move to encoded_files history
             cur.execute(
                 "INSERT INTO encoded_files (job_id, filename, original_size, new_size, encoded_by, status) VALUES (%s, %s, %s, %s, %s, 'completed')",
@@ -4468,16 +5427,84 @@ def update_job(job_id):
         cur.execute("DELETE FROM jobs WHERE id = %s", (job_id,))
         message = f"Job {job_id} ({job['job_type']}) completed and removed from queue."
 
+    elif status in ('skipped_low_gain', 'aborted_low_gain'):
+        # Sample encodes predicted too small a saving, or the encode was abandoned once its output was
+        # projected not to beat the original. The original is untouched, so new_size stays empty; the history
+        # entry (with the predicted size) keeps the scanners from queueing the file again.
+        cur.execute(
+            "INSERT INTO encoded_files (job_id, filename, original_size, predicted_size, encoded_by, status) VALUES (%s, %s, %s, %s, %s, %s)",
+            (job_id, job['filepath'], data.get('original_size'), data.get('predicted_size'), job['assigned_to'], status)
+        )
+        cur.execute("DELETE FROM jobs WHERE id = %s", (job_id,))
+        message = f"Job {job_id} ({job['job_type']}) {'skipped' if status == 'skipped_low_gain' else 'aborted'}: {data.get('reason')}."
+
+    elif status == 'interrupted':
+        # The worker was told to quit mid-job: put the job back in the queue for the next worker
+        cur.execute(
+            "UPDATE jobs SET status = CASE WHEN job_type = 'transcode_segmented' AND EXISTS (SELECT 1 FROM job_segments WHERE job_id = %s AND status <> 'completed') THEN 'segmenting' ELSE 'pending' END, assigned_to = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+            (job_id, job_id)
+        )
+        message = f"Job {job_id} ({job['job_type']}) was interrupted and returned to the queue."
+
     elif status == 'failed':
         # For any failed job, log it and mark as failed in the queue
-        cur.execute("INSERT INTO failed_files (filename, reason, log) VALUES (%s, %s, %s)", (job['filepath'], data.get('reason'), data.get('log')))
+        cur.execute(
+            "INSERT INTO failed_files (filename, reason, log, log_size, log_checksum) VALUES (%s, %s, %s, %s, %s)",
+            (job['filepath'], data.get('reason'), data.get('log'), data.get('log_size'), data.get('log_checksum'))
+        )
         cur.execute("UPDATE jobs SET status = 'failed', updated_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+        if job['job_type'] == 'transcode_segmented':
+            fail_segmented_job(cur, job_id)
         message = f"Job {job_id} ({job['job_type']}) failed and logged."
 
     conn.commit()
     cur.close()
     return jsonify({"message": message})
 
+def update_job_segment(cur, job, segment_index, status, data):
+    """Records the result of one segment of a segmented job. Returns a status message."""
+    job_id = job['id']
+    if status == 'completed':
+        cur.execute(
+            "UPDATE job_segments SET status = 'completed', output_size = %s, error = NULL, updated_at = CURRENT_TIMESTAMP WHERE job_id = %s AND segment_index = %s",
+            (data.get('output_size'), job_id, segment_index)
+        )
+        cur.execute("SELECT COUNT(*) FILTER (WHERE status <> 'completed') AS remaining FROM job_segments WHERE job_id = %s", (job_id,))
+        if cur.fetchone()['remaining'] == 0:
+            # Every segment is encoded: queue the job again so one worker joins them
+            cur.execute("UPDATE jobs SET status = 'pending', assigned_to = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND status = 'segmenting'", (job_id,))
+            return f"Job {job_id}: all segments encoded, queued for joining."
+        return f"Job {job_id}: segment {segment_index} completed."
+
+    if status == 'interrupted':
+        # Interruptions by a node command don't count as a failed attempt
+        cur.execute(
+            "UPDATE job_segments SET status = 'pending', assigned_to = NULL, attempts = GREATEST(attempts - 1, 0), updated_at = CURRENT_TIMESTAMP WHERE job_id = %s AND segment_index = %s",
+            (job_id, segment_index)
+        )
+        return f"Job {job_id}: segment {segment_index} was interrupted and returned to the queue."
+
+    cur.execute("SELECT attempts FROM job_segments WHERE job_id = %s AND segment_index = %s", (job_id, segment_index))
+    segment = cur.fetchone()
+    if segment and segment['attempts'] < MAX_SEGMENT_ATTEMPTS:
+        cur.execute(
+            "UPDATE job_segments SET status = 'pending', assigned_to = NULL, error = %s, updated_at = CURRENT_TIMESTAMP WHERE job_id = %s AND segment_index = %s",
+            (data.get('reason'), job_id, segment_index)
+        )
+        return f"Job {job_id}: segment {segment_index} failed and will be retried."
+
+    cur.execute(
+        "UPDATE job_segments SET status = 'failed', error = %s, updated_at = CURRENT_TIMESTAMP WHERE job_id = %s AND segment_index = %s",
+        (data.get('reason'), job_id, segment_index)
+    )
+    cur.execute(
+        "INSERT INTO failed_files (filename, reason, log, log_size, log_checksum) VALUES (%s, %s, %s, %s, %s)",
+        (job['filepath'], data.get('reason'), data.get('log'), data.get('log_size'), data.get('log_checksum'))
+    )
+    cur.execute("UPDATE jobs SET status = 'failed', updated_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+    fail_segmented_job(cur, job_id)
+    return f"Job {job_id}: segment {segment_index} failed {MAX_SEGMENT_ATTEMPTS} times, job failed and logged."
+
 
 # --- Background Threads ---
 
@@ -4916,6 +5943,8 @@ arr_job_processor = threading.Thread(target=arr_job_processor_thread, daemon=Tru
 arr_job_processor.start()
 backup_thread = threading.Thread(target=database_backup_thread, daemon=True)
 backup_thread.start()
+notification_listener = threading.Thread(target=notification_listener_thread, daemon=True)
+notification_listener.start()
 
 if __name__ == '__main__':
     # For local development, run migrations then start the app
@@ -0,0 +1,13 @@
+# Gunicorn settings for the dashboard.
+import os
+
+bind = "0.0.0.0:5000"
+# A single process keeps the background threads unique
+workers = 1
+worker_class = "gthread"
+# Parked long-poll requests from workers (at most LONG_POLL_MAX_WAITERS) each hold a thread,
+# so the pool grows with the fleet and keeps DASHBOARD_REQUEST_THREADS free for everything else.
+threads = int(os.environ.get("LONG_POLL_MAX_WAITERS", "16")) + int(os.environ.get("DASHBOARD_REQUEST_THREADS", "16"))
+loglevel = "info"
+errorlog = "-"
+capture_output = True
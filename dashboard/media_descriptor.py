@@ -0,0 +1,52 @@
+"""
+The media descriptor stored with a job: codec, resolution, pixel format and bit depth, duration,
+bitrate, HDR format and stream counts, parsed from one 'ffprobe -show_streams -show_format' run.
+The scanner computes it at scan time, and workers upload their own probe to /api/media_descriptor
+for jobs without one, so this is the only implementation. Kept free of Flask and database imports
+so it can be unit tested without a running dashboard.
+"""
+import re
+
+HDR_TRANSFERS = {'smpte2084': 'hdr10', 'arib-std-b67': 'hlg'}
+# Pixel formats carry their bit depth as a suffix: yuv420p10le, p010le, yuv444p12be
+PIX_FMT_BIT_DEPTH = re.compile(r'(\d{2})(?:le|be)$')
+
+def _number(value, cast=float):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+def bit_depth(video):
+    """Returns the bit depth of a video stream from ffprobe, or None if it has no pixel format."""
+    bits = _number(video.get('bits_per_raw_sample'), int)
+    if bits:
+        return bits
+    pix_fmt = video.get('pix_fmt')
+    if not pix_fmt:
+        return None
+    match = PIX_FMT_BIT_DEPTH.search(pix_fmt)
+    return int(match.group(1)) if match else 8
+
+def parse_media_descriptor(probe):
+    """Turns the JSON output of 'ffprobe -show_streams -show_format' into a media descriptor."""
+    streams = probe.get('streams', [])
+    fmt = probe.get('format', {})
+    video = next((st for st in streams if st.get('codec_type') == 'video' and not st.get('disposition', {}).get('attached_pic')), {})
+
+    hdr = HDR_TRANSFERS.get(video.get('color_transfer'))
+    if any(side_data.get('side_data_type') == 'DOVI configuration record' for side_data in video.get('side_data_list', [])):
+        hdr = 'dolby_vision'
+    return {
+        "codec": (video.get('codec_name') or '').lower(),
+        "width": _number(video.get('width'), int),
+        "height": _number(video.get('height'), int),
+        "pix_fmt": video.get('pix_fmt'),
+        "bit_depth": bit_depth(video),
+        "duration": _number(fmt.get('duration')),
+        "bitrate": _number(fmt.get('bit_rate'), int),
+        "hdr": hdr,
+        "video_streams": sum(1 for st in streams if st.get('codec_type') == 'video'),
+        "audio_streams": sum(1 for st in streams if st.get('codec_type') == 'audio'),
+        "subtitle_streams": sum(1 for st in streams if st.get('codec_type') == 'subtitle'),
+    }
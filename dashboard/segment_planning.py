@@ -0,0 +1,15 @@
+"""
+Segment planning for segmented encoding. Kept free of Flask and database imports so it can be
+unit tested without a running dashboard.
+"""
+
+def plan_segments(keyframes, duration, segment_seconds):
+    """
+    Splits a file into time ranges of roughly segment_seconds that each start on a keyframe.
+    A short remainder at the end is merged into the last segment.
+    """
+    cuts = [0.0]
+    for keyframe in sorted(keyframes):
+        if keyframe - cuts[-1] >= segment_seconds and duration - keyframe >= segment_seconds / 2:
+            cuts.append(keyframe)
+    return list(zip(cuts, cuts[1:] + [duration]))
@@ -439,8 +439,26 @@ function resumeScanUI(scanType, scanSource) {
     startProgressPolling(scanType, scanSource);
 }
 
+// Renders the per-slot progress of a multi-slot worker
+function createSlotRows(slots) {
+    return slots.map(slot => `
+        <div class="mb-2">
+            <div class="d-flex justify-content-between small">
+                <span style="font-family: monospace;">Slot ${slot.slot + 1}: ${slot.percent > 0 ? escapeHtml(slot.current_file || 'N/A') : 'Idle'}</span>
+                ${slot.percent > 0 ? `<span>FPS: ${slot.fps || 'N/A'} | Speed: ${slot.speed ? slot.speed.toFixed(2) : 'N/A'}x</span>` : ''}
+            </div>
+            <div class="progress" role="progressbar" style="height: 1.1rem;">
+                <div class="progress-bar ${slot.percent > 0 ? 'progress-bar-striped progress-bar-animated' : ''} text-bg-teal" style="width: ${slot.percent}%">
+                    ${slot.percent > 0 ? `<b>${slot.percent}%</b>` : ''}
+                </div>
+            </div>
+        </div>
+    `).join('');
+}
+
 // Function to create an HTML element for a single node
 function createNodeCard(node) {
+    const hasSlots = node.slots && node.slots.length > 1;
     const isIdle = node.status === 'idle' || node.percent === 0;
     const isPaused = node.command === 'paused';
     const pauseButtonIcon = isPaused ? 'play' : 'pause';
@@ -469,7 +487,7 @@ function createNodeCard(node) {
             </div>
         </div>
         <div class="card-body">
-            ${node.percent > 0 ? `
+            ${hasSlots ? createSlotRows(node.slots) : node.percent > 0 ? `
                 <p class="card-text text-body-secondary mb-2" style="font-family: monospace;">${node.current_file || 'N/A'}</p>
                 <div class="progress" role="progressbar">
                     <div class="progress-bar progress-bar-striped progress-bar-animated text-bg-teal" style="width: ${node.percent}%">
@@ -485,9 +503,14 @@ function createNodeCard(node) {
         <div class="card-footer d-flex justify-content-between align-items-center bg-transparent">
             <div>
                 <span class="badge badge-outline-secondary">Uptime: ${node.uptime_str || 'N/A'}</span>
+                ${(node.devices || []).map(device => `
+                    <span class="badge badge-outline-info ms-1" title="${escapeHtml(device.device)}">${escapeHtml(device.name)}: ${device.sessions} active, ${device.fps} fps</span>
+                `).join('')}
             </div>
             <div>
-            ${node.percent > 0 ? `
+            ${hasSlots ? `
+                <span class="badge badge-outline-secondary">${node.slots.filter(slot => slot.percent > 0).length} of ${node.slots.length} slots busy</span>
+            ` : node.percent > 0 ? `
                 <span class="badge badge-outline-secondary me-2">FPS: ${node.fps || 'N/A'}</span>
                 <span class="badge badge-outline-secondary me-2">Speed: ${node.speed}x</span>
                 <span class="badge badge-outline-teal me-2">Codec: ${node.codec}</span>
@@ -500,6 +523,9 @@ function createNodeCard(node) {
     </div>`;
 }
 
+// Latest node data from /api/status, keyed by hostname (used by the node options modal)
+let latestNodes = {};
+
 // Main function to fetch data and update the DOM
 async function updateStatus() {
     try {
@@ -551,6 +577,7 @@ async function updateStatus() {
         }
 
         // Update nodes list
+        latestNodes = Object.fromEntries((data.nodes || []).map(node => [node.hostname, node]));
         const nodesContainer = document.getElementById('nodes-container');
         if (data.nodes && data.nodes.length > 0) {
             nodesContainer.innerHTML = data.nodes.map(createNodeCard).join('');
@@ -630,7 +657,10 @@ if (viewErrorsBtn) {
                             <td>${actionsHtml}</td>
                         </tr>
                         <tr class="collapse" id="collapse-log-${index}">
-                            <td colspan="4"><pre class="bg-dark text-white-50 p-3 rounded" style="max-height: 300px; overflow-y: auto;">${file.log || 'No log available.'}</pre></td>
+                            <td colspan="4">
+                                <pre class="bg-dark text-white-50 p-3 rounded" style="max-height: 300px; overflow-y: auto;">${file.log || 'No log available.'}</pre>
+                                ${file.log_size ? `<small class="text-muted">Full log: ${file.log_size} bytes, SHA-256 ${file.log_checksum || 'N/A'}</small>` : ''}
+                            </td>
                         </tr>
                     `;
                 }).join('');
@@ -881,6 +911,13 @@ function getJobActionButtons(job) {
         // Worker offline: show force remove
         return `<button class="btn btn-xs btn-outline-danger" onclick="deleteJob(${job.id})" title="Force Remove Stuck Job">Force Remove</button>`;
     }
+    if (job.job_type === 'transcode' && job.status === 'pending') {
+        // Pending transcodes can be split into segments that all workers encode together
+        return `<div class="btn-group btn-group-sm" role="group">
+            <button class="btn btn-xs btn-outline-primary" onclick="segmentJob(${job.id})" title="Encode in segments across all workers"><span class="mdi mdi-call-split"></span> Split</button>
+            <button class="btn btn-xs btn-outline-danger" onclick="deleteJob(${job.id})" title="Delete Job">&times;</button>
+        </div>`;
+    }
     if (['pending', 'awaiting_approval', 'failed'].includes(job.status)) {
         // Regular deletable jobs
         return `<button class="btn btn-xs btn-outline-danger" onclick="deleteJob(${job.id})" title="Delete Job">&times;</button>`;
@@ -940,6 +977,10 @@ async function updateJobQueue(page = 1) {
                         `<span class="badge badge-outline-primary"><span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span> Encoding</span>` :
                     job.status === 'awaiting_approval' ?
                         `<span class="badge badge-outline-warning">Awaiting Approval</span>` :
+                    job.status === 'segmenting' ?
+                        `<span class="badge badge-outline-primary"><span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span> Segments ${job.segments_completed}/${job.segments_total}</span>` :
+                    job.status === 'leased' ?
+                        `<span class="badge badge-outline-info" title="Reserved by a worker that is finishing its current job">Up Next</span>` :
                     job.status === 'pending' ?
                         `<span class="badge badge-outline-secondary">Pending</span>` :
                     job.status === 'failed' ?
@@ -1172,6 +1213,12 @@ function renderHistoryTable() {
                 <td><span class="badge badge-outline-secondary">${item.codec}</span></td>
                 ${item.status === 'encoding' ? `
                     <td colspan="2" class="text-center"><span class="badge badge-outline-primary">In Progress</span></td>
+                ` : item.status === 'skipped_low_gain' ? `
+                    <td>${item.original_size_gb} → ~${item.predicted_size_gb}</td>
+                    <td><span class="badge badge-outline-warning" title="Skipped: sample encodes predicted too small a saving. The file was left unchanged.">Skipped (~${item.predicted_reduction_percent}%)</span></td>
+                ` : item.status === 'aborted_low_gain' ? `
+                    <td>${item.original_size_gb} → ~${item.predicted_size_gb}</td>
+                    <td><span class="badge badge-outline-warning" title="Aborted: the output was projected not to beat the original by the minimum saving. The file was left unchanged.">Aborted (~${item.predicted_reduction_percent}%)</span></td>
                 ` : `
                     <td>${item.original_size_gb} → ${item.new_size_gb}</td>
                     <td><span class="badge badge-outline-success">${item.reduction_percent}%</span></td>
@@ -1562,13 +1609,118 @@ async function pauseAllNodes() {
     }
 }
 
-// Placeholder for future per-node options
+// Per-node options
 let nodeOptionsModal = null;
+function renderNodeCapabilities(capabilities) {
+    if (!capabilities) {
+        return '<span class="text-muted">Not reported.</span>';
+    }
+    const devices = capabilities.devices || {};
+    const hevcEncoders = (capabilities.encoders || []).filter(name => name.includes('hevc') || name.includes('265') || name.includes('av1'));
+    return `
+        <div><strong>FFmpeg:</strong> ${capabilities.ffmpeg ? 'Available' : 'Not found'}</div>
+        <div><strong>HW Accels:</strong> ${escapeHtml((capabilities.hwaccels || []).join(', ') || 'None')}</div>
+        <div><strong>Encoders:</strong> ${escapeHtml(hevcEncoders.join(', ') || 'None')}</div>
+        <div><strong>Render Nodes:</strong> ${escapeHtml((devices.render_nodes || []).join(', ') || 'None')}</div>
+        <div><strong>NVIDIA:</strong> ${devices.nvidia ? 'Yes' : 'No'}</div>
+        <div class="text-muted">Probed: ${escapeHtml(capabilities.probed_at || 'N/A')}</div>
+    `;
+}
+
+function renderNodeBenchmark(benchmark) {
+    if (!benchmark || !benchmark.results || benchmark.results.length === 0) {
+        return '<span class="text-muted">No benchmark reported. Run <code>transcode.py --benchmark --benchmark-post</code> on the node.</span>';
+    }
+    const rows = benchmark.results.map(result => `
+        <tr>
+            <td>${escapeHtml(result.encoder)}</td>
+            <td>${escapeHtml(result.resolution)}</td>
+            ${result.error
+                ? `<td colspan="3" class="text-danger">${escapeHtml(result.error)}</td>`
+                : `<td>${result.fps}</td><td>${result.speed}x</td><td>${result.bitrate_kbps}</td>`}
+        </tr>`).join('');
+    return `
+        <table class="table table-sm mb-1">
+            <thead><tr><th>Encoder</th><th>Clip</th><th>FPS</th><th>Speed</th><th>kbps</th></tr></thead>
+            <tbody>${rows}</tbody>
+        </table>
+        <div class="text-muted">Benchmarked: ${escapeHtml(benchmark.created_at || 'N/A')} (${escapeHtml(String(benchmark.clip_seconds))}s clips, CQ ${escapeHtml(String(benchmark.cq))})</div>
+    `;
+}
+
+async function refreshNodeHardware(hostname) {
+    try {
+        const response = await fetch(`/api/nodes/${hostname}/refresh_hardware`, { method: 'POST' });
+        const result = await response.json();
+        alert(result.success ? result.message : `Failed to request hardware re-detection: ${result.error || 'Unknown error'}`);
+    } catch (error) {
+        console.error('Error requesting hardware re-detection:', error);
+    }
+}
+
+// Node option fields of the CPU resource profile, keyed by the profile's field names
+const NODE_RESOURCE_FIELDS = {
+    threads: 'node-res-threads',
+    cpu_limit: 'node-res-cpu-limit',
+    pools: 'node-res-pools',
+    frame_threads: 'node-res-frame-threads',
+    cpuset: 'node-res-cpuset',
+    nice: 'node-res-nice',
+    ionice: 'node-res-ionice',
+};
+
+async function loadNodeOptions(hostname) {
+    const slotsInput = document.getElementById('node-max-slots');
+    const benchmarkDiv = document.getElementById('node-benchmark');
+    slotsInput.value = '';
+    Object.values(NODE_RESOURCE_FIELDS).forEach(id => { document.getElementById(id).value = ''; });
+    benchmarkDiv.innerHTML = renderNodeBenchmark(null);
+    try {
+        const response = await fetch(`/api/nodes/${hostname}/options`);
+        const result = await response.json();
+        if (result.success && result.options.max_slots) {
+            slotsInput.value = result.options.max_slots;
+        }
+        if (result.success) {
+            benchmarkDiv.innerHTML = renderNodeBenchmark(result.options.benchmark);
+            const resources = result.options.resources || {};
+            Object.entries(NODE_RESOURCE_FIELDS).forEach(([key, id]) => {
+                document.getElementById(id).value = resources[key] ?? '';
+            });
+        }
+    } catch (error) {
+        console.error('Error loading node options:', error);
+    }
+}
+
+async function saveNodeOptions(hostname) {
+    const maxSlots = document.getElementById('node-max-slots').value;
+    const resources = Object.fromEntries(
+        Object.entries(NODE_RESOURCE_FIELDS).map(([key, id]) => [key, document.getElementById(id).value.trim()])
+    );
+    try {
+        const response = await fetch(`/api/nodes/${hostname}/options`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ max_slots: maxSlots, resources: resources })
+        });
+        const result = await response.json();
+        alert(result.success ? result.message : `Failed to save node options: ${result.error || 'Unknown error'}`);
+    } catch (error) {
+        console.error('Error saving node options:', error);
+    }
+}
+
 function showNodeOptions(hostname) {
     if (!nodeOptionsModal) {
         nodeOptionsModal = new bootstrap.Modal(document.getElementById('nodeOptionsModal'));
     }
     document.getElementById('nodeOptionsModalTitle').innerText = `Options for ${hostname}`;
+    const node = latestNodes[hostname] || {};
+    document.getElementById('node-capabilities').innerHTML = renderNodeCapabilities(node.capabilities);
+    document.getElementById('refresh-node-hardware-btn').onclick = () => refreshNodeHardware(hostname);
+    document.getElementById('save-node-options-btn').onclick = () => saveNodeOptions(hostname);
+    loadNodeOptions(hostname);
     const quitBtn = document.getElementById('quit-node-btn');
     // Re-assign the onclick event to the button for the specific hostname
     quitBtn.onclick = () => quitNode(hostname);
@@ -3136,6 +3288,24 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    window.segmentJob = async function(jobId) {
+        if (!confirm(`Split job ${jobId} into segments? Every available worker will encode a part of the file, and one worker joins the parts at the end.`)) {
+            return;
+        }
+        try {
+            const response = await fetch(`/api/jobs/segment/${jobId}`, { method: 'POST' });
+            if (response.ok) {
+                updateJobQueue(jobQueueCurrentPage); // Refresh the queue
+            } else {
+                const data = await response.json();
+                alert(`Error: ${data.error || 'Failed to split job'}`);
+            }
+        } catch (error) {
+            console.error('Error splitting job:', error);
+            alert('An error occurred while trying to split the job.');
+        }
+    }
+
     window.requeueJob = async function(jobId) {
         if (!confirm(`Are you sure you want to re-add job ${jobId} to the queue? This will reset it to pending status.`)) {
             return;
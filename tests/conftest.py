@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The worker and dashboard are plain scripts rather than installed packages, so their
+# directories are put on the import path for the tests.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "worker"))
+sys.path.insert(0, os.path.join(ROOT, "dashboard"))
+
+@pytest.fixture
+def capabilities(monkeypatch):
+    """Replaces the worker's hardware probe with an empty capability descriptor the test fills in."""
+    import transcode
+    descriptor = {"ffmpeg": True, "hwaccels": [], "encoders": [], "devices": {"render_nodes": [], "nvidia": False, "cuda": []}}
+    monkeypatch.setattr(transcode, "_hw_capabilities", descriptor)
+    return descriptor
@@ -0,0 +1,55 @@
+import signal
+
+from transcode import ActiveEncodes
+
+class FakeProcess:
+    def __init__(self):
+        self.signals = []
+        self.terminated = False
+
+    def send_signal(self, sig):
+        self.signals.append(sig)
+
+    def terminate(self):
+        self.terminated = True
+
+def test_pause_and_resume():
+    encodes, process = ActiveEncodes(), FakeProcess()
+    encodes.register(process)
+    encodes.apply('paused')
+    encodes.apply('paused')
+    encodes.apply('running')
+    assert process.signals == [signal.SIGSTOP, signal.SIGCONT]
+    assert not process.terminated
+    assert not encodes.consume_interrupted()
+
+def test_stop_terminates_the_running_encode():
+    encodes, process = ActiveEncodes(), FakeProcess()
+    encodes.register(process)
+    encodes.apply('idle')
+    assert process.terminated
+    assert encodes.consume_interrupted()
+    assert not encodes.consume_interrupted()
+
+def test_stopping_a_paused_encode_resumes_it_first():
+    encodes, process = ActiveEncodes(), FakeProcess()
+    encodes.register(process)
+    encodes.apply('paused')
+    encodes.apply('quit')
+    assert process.signals == [signal.SIGSTOP, signal.SIGCONT]
+    assert process.terminated
+
+def test_encode_started_while_stopped_is_terminated_until_the_node_runs_again():
+    encodes = ActiveEncodes()
+    encodes.apply('idle')
+    late = FakeProcess()
+    encodes.register(late)
+    assert late.terminated
+    encodes.unregister()
+    assert encodes.consume_interrupted()
+
+    encodes.apply('running')
+    process = FakeProcess()
+    encodes.register(process)
+    assert not process.terminated
+    assert not encodes.consume_interrupted()
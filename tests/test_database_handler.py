@@ -0,0 +1,57 @@
+import psycopg2
+import pytest
+from psycopg2 import pool as pg_pool
+
+import transcode
+from transcode import DatabaseHandler
+
+class FakeConnection:
+    closed = 0
+
+    def __init__(self):
+        self.prepared = set()
+
+class FakePool:
+    """Hands out connections like ThreadedConnectionPool, which raises PoolError when exhausted."""
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.maxconn = maxconn
+        self.used = 0
+
+    def getconn(self):
+        if self.used >= self.maxconn:
+            raise pg_pool.PoolError("connection pool exhausted")
+        self.used += 1
+        return FakeConnection()
+
+    def putconn(self, conn, close=False):
+        self.used -= 1
+
+@pytest.fixture(autouse=True)
+def fake_pool(monkeypatch):
+    monkeypatch.setattr(pg_pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(transcode, "DB_POOL_WAIT_SECONDS", 0.05)
+
+def test_exhausted_pool_raises_pool_error_after_waiting():
+    db = DatabaseHandler({}, max_connections=2)
+    first, second = db._get_conn(), db._get_conn()
+    with pytest.raises(pg_pool.PoolError):
+        db._get_conn()
+    db._put_conn(first)
+    db._put_conn(second)
+    db._put_conn(db._get_conn())
+
+def test_node_control_keeps_the_last_known_values_while_the_database_is_down(monkeypatch):
+    db = DatabaseHandler({}, max_connections=1)
+    monkeypatch.setattr(db, "_execute", lambda name, params, fetch=False: ('pause', 2, {"nice": 10}))
+    assert db.get_node_control("node") == ('pause', 2, {"nice": 10})
+
+    def unreachable(name, params, fetch=False):
+        raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    monkeypatch.setattr(db, "_execute", unreachable)
+    assert db.get_node_control("node") == ('pause', 2, {"nice": 10})
+    assert db.get_node_command("node") == 'pause'
+
+def test_node_control_defaults_to_idle_for_an_unknown_node(monkeypatch):
+    db = DatabaseHandler({}, max_connections=1)
+    monkeypatch.setattr(db, "_execute", lambda name, params, fetch=False: None)
+    assert db.get_node_control("node") == ('idle', None, None)
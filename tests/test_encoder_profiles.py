@@ -0,0 +1,55 @@
+import pytest
+
+from transcode import ENCODER_PROFILES, SPEED_TIERS, get_hw_config, map_cq
+
+@pytest.mark.parametrize("family", sorted(ENCODER_PROFILES))
+@pytest.mark.parametrize("mode", ["nvidia", "qsv", "vaapi", "cpu"])
+def test_every_profile_has_a_preset_for_every_tier(family, mode):
+    presets = ENCODER_PROFILES[family][mode]["presets"]
+    if presets is not None:
+        assert set(presets) == set(SPEED_TIERS)
+
+@pytest.mark.parametrize("family, mode, tier, codec, preset", [
+    ("hevc", "cpu", "balanced", "libx265", "medium"),
+    ("hevc", "nvidia", "quality", "hevc_nvenc", "p6"),
+    ("av1", "cpu", "fast", "libsvtav1", "10"),
+    ("av1", "qsv", "quality", "av1_qsv", "slower"),
+    ("av1", "vaapi", "fast", "av1_vaapi", None),
+])
+def test_hw_config_uses_the_profile_of_the_family_and_tier(family, mode, tier, codec, preset):
+    hw_config = get_hw_config(mode, family=family, tier=tier)
+    assert hw_config["codec"] == codec
+    assert hw_config["preset"] == preset
+
+def test_unknown_values_fall_back_to_the_defaults():
+    hw_config = get_hw_config("amd", family="vp9", tier="ludicrous")
+    assert (hw_config["mode"], hw_config["family"], hw_config["tier"]) == ("cpu", "hevc", "balanced")
+    assert hw_config["hw_pre_args"] == []
+
+def test_nvidia_config_pins_the_cuda_device():
+    hw_config = get_hw_config("nvidia", cuda_device=1)
+    assert hw_config["device"] == "cuda:1"
+    assert hw_config["hw_pre_args"][-2:] == ["-hwaccel_device", "1"]
+    assert hw_config["extra"][-2:] == ["-gpu", "1"]
+    # The device options must not leak into the shared profile
+    assert "-gpu" not in ENCODER_PROFILES["hevc"]["nvidia"]["extra"]
+
+def test_vaapi_config_uses_the_render_node():
+    hw_config = get_hw_config("vaapi", device_path="/dev/dri/renderD129")
+    assert hw_config["device"] == "/dev/dri/renderD129"
+    assert hw_config["hw_pre_args"][:2] == ["-vaapi_device", "/dev/dri/renderD129"]
+
+@pytest.mark.parametrize("family, mode, cq, expected", [
+    ("hevc", "cpu", 24, 24),
+    ("hevc", "nvidia", "28", 28),
+    ("av1", "cpu", 24, 30),
+    ("av1", "nvidia", 24, 26),
+    ("av1", "vaapi", 24, 104),
+    ("av1", "vaapi", 70, 255),
+    ("hevc", "cpu", -5, 0),
+])
+def test_map_cq_converts_to_the_encoder_scale(family, mode, cq, expected):
+    assert map_cq(get_hw_config(mode, family=family), cq) == expected
+
+def test_map_cq_passes_invalid_values_through():
+    assert map_cq(get_hw_config("cpu"), "auto") == "auto"
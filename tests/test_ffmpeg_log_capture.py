@@ -0,0 +1,47 @@
+import gzip
+import hashlib
+import io
+
+from transcode import FFmpegLogCapture
+
+def capture(text, **kwargs):
+    kwargs.setdefault("spill_dir", None)
+    log = FFmpegLogCapture(io.StringIO(text), **kwargs).start()
+    log.join()
+    return log
+
+def test_keeps_head_and_tail_and_counts_the_rest():
+    lines = [f"line {i}\n" for i in range(100)]
+    log = capture("".join(lines), head_lines=3, tail_lines=5)
+    assert log.head == lines[:3]
+    assert list(log.tail) == lines[-5:]
+    assert log.total_lines == 100
+    assert log.text() == "".join(lines[:3]) + "\n... [92 lines omitted] ...\n\n" + "".join(lines[-5:])
+
+def test_short_log_is_kept_whole():
+    text = "a\nb\nc\n"
+    log = capture(text, head_lines=2, tail_lines=5)
+    assert log.text() == text
+
+def test_checksum_and_size_cover_the_full_log():
+    text = "".join(f"frame {i} é\n" for i in range(50))
+    log = capture(text, head_lines=1, tail_lines=1)
+    assert log.total_bytes == len(text.encode("utf-8"))
+    assert log.checksum == hashlib.sha256(text.encode("utf-8")).hexdigest()
+    details = log.details()
+    assert details["log_size"] == log.total_bytes
+    assert details["log_checksum"] == log.checksum
+    assert "log_file" not in details
+
+def test_picks_up_the_input_duration():
+    log = capture("Input #0, matroska\n  Duration: 01:02:03.50, start: 0.000000\n")
+    assert log.duration == 3723.5
+
+def test_spills_the_full_log(tmp_path):
+    text = "".join(f"line {i}\n" for i in range(20))
+    log = capture(text, head_lines=1, tail_lines=1, spill_dir=str(tmp_path), name="job 1/movie.mkv")
+    assert log.details()["log_file"] == log.spill_path
+    with gzip.open(log.spill_path, "rt", encoding="utf-8") as f:
+        assert f.read() == text
+    log.discard_spill()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,55 @@
+from transcode import FFmpegProgressParser
+
+def feed_block(parser, lines):
+    results = [parser.feed(line) for line in lines]
+    assert all(result is None for result in results[:-1])
+    return results[-1]
+
+def test_parses_a_progress_block():
+    progress = feed_block(FFmpegProgressParser(), [
+        "frame=1200\n", "fps=48.5\n", "bitrate=2450.3kbits/s\n", "total_size=10485760\n",
+        "out_time_us=50000000\n", "speed=1.94x\n", "progress=continue\n",
+    ])
+    assert progress.frame == 1200
+    assert progress.fps == 48.5
+    assert progress.bitrate_kbps == 2450.3
+    assert progress.total_size == 10485760
+    assert progress.out_time_seconds == 50.0
+    assert progress.speed == 1.94
+    assert not progress.finished
+
+def test_not_available_values_are_none():
+    progress = feed_block(FFmpegProgressParser(), [
+        "frame=0\n", "fps=0.00\n", "bitrate=N/A\n", "total_size=N/A\n",
+        "out_time_us=N/A\n", "speed=N/A\n", "progress=continue\n",
+    ])
+    assert progress.frame == 0
+    assert progress.bitrate_kbps is None
+    assert progress.total_size is None
+    assert progress.out_time_seconds is None
+    assert progress.speed is None
+
+def test_negative_out_time_is_ignored():
+    progress = feed_block(FFmpegProgressParser(), ["out_time_us=-9223372036854775807\n", "progress=continue\n"])
+    assert progress.out_time_seconds is None
+
+def test_speed_with_leading_spaces():
+    progress = feed_block(FFmpegProgressParser(), ["speed=   1.5x\n", "progress=continue\n"])
+    assert progress.speed == 1.5
+
+def test_end_block_is_finished():
+    progress = feed_block(FFmpegProgressParser(), ["frame=10\n", "progress=end\n"])
+    assert progress.finished
+
+def test_fields_do_not_leak_into_the_next_block():
+    parser = FFmpegProgressParser()
+    feed_block(parser, ["frame=10\n", "speed=2.0x\n", "progress=continue\n"])
+    progress = feed_block(parser, ["frame=20\n", "progress=continue\n"])
+    assert progress.frame == 20
+    assert progress.speed is None
+
+def test_lines_without_a_value_are_skipped():
+    parser = FFmpegProgressParser()
+    assert parser.feed("\n") is None
+    assert parser.feed("garbage\n") is None
+    assert feed_block(parser, ["frame=5\n", "progress=continue\n"]).frame == 5
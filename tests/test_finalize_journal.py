@@ -0,0 +1,106 @@
+import transcode
+from transcode import FinalizeIntent, FinalizeJournal, FinalizeStage
+
+def make_record(key, job_id, created_at, intent):
+    return {"key": key, "job_id": job_id, "status": None, "details": None, "created_at": created_at, "intent": intent.to_record()}
+
+def test_records_are_replayed_oldest_first(tmp_path):
+    journal = FinalizeJournal(tmp_path / "finalize")
+    intent = FinalizeIntent(tmp_path / "a.mkv", tmp_path / "a.tmp.mkv", tmp_path / "a.mkv", cleanup_dirs=[tmp_path / "work"])
+    journal.write(make_record("b", 2, "2026-01-02T00:00:00+00:00", intent))
+    journal.write(make_record("a", 1, "2026-01-01T00:00:00+00:00", intent))
+    # A restarted worker reads the same directory
+    journal = FinalizeJournal(tmp_path / "finalize")
+    assert [record["key"] for record in journal.records()] == ["a", "b"]
+    assert journal.pending_jobs() == [{"job_id": 1, "segment_index": None}, {"job_id": 2, "segment_index": None}]
+    assert journal.work_dirs() == [str(tmp_path / "work")] * 2
+
+def test_rewriting_a_record_replaces_it(tmp_path):
+    journal = FinalizeJournal(tmp_path)
+    intent = FinalizeIntent(tmp_path / "a.mkv", tmp_path / "a.tmp.mkv", tmp_path / "a.mkv")
+    record = make_record("a", 1, "2026-01-01T00:00:00+00:00", intent)
+    journal.write(record)
+    intent.stage = 'cleanup'
+    record["intent"] = intent.to_record()
+    journal.write(record)
+    assert [record["intent"]["stage"] for record in journal.records()] == ['cleanup']
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a.json"]
+
+def test_removed_and_unreadable_records_are_skipped(tmp_path):
+    journal = FinalizeJournal(tmp_path)
+    intent = FinalizeIntent(tmp_path / "a.mkv", tmp_path / "a.tmp.mkv", tmp_path / "a.mkv")
+    journal.write(make_record("a", 1, "2026-01-01T00:00:00+00:00", intent))
+    journal.remove("a")
+    journal.remove("a")
+    (tmp_path / "torn.json").write_text('{"key": "torn"')
+    assert journal.records() == []
+
+def test_disabled_journal_keeps_nothing(tmp_path):
+    journal = FinalizeJournal(None)
+    journal.write({"key": "a"})
+    assert journal.records() == []
+    assert journal.work_dirs() == []
+
+def test_journaled_intent_resumes_at_its_stage(tmp_path):
+    journal = FinalizeJournal(tmp_path / "finalize")
+    original = tmp_path / "movie.mkv"
+    temp_output = tmp_path / "movie.tmp.mkv"
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    staged_output = scratch / "movie.mkv"
+    original.write_bytes(b"original")
+    staged_output.write_bytes(b"encoded")
+
+    intent = FinalizeIntent(original, temp_output, original, keep_original=True, backup_directory=str(tmp_path / "backup"),
+                            staged_output=staged_output, cleanup_dirs=[scratch])
+    record = make_record("a", 1, "2026-01-01T00:00:00+00:00", intent)
+    journal.write(record)
+    # The worker crashed after the copy step was journaled
+    intent.stage = 'replace'
+    temp_output.write_bytes(b"encoded")
+    record["intent"] = intent.to_record()
+    journal.write(record)
+
+    resumed = FinalizeIntent.from_record(journal.records()[0]["intent"])
+    assert resumed.stage == 'replace'
+    assert not resumed.encode_lost()
+    resumed.run()
+    assert original.read_bytes() == b"encoded"
+    assert (tmp_path / "backup" / "movie.mkv").read_bytes() == b"original"
+    assert not temp_output.exists()
+    assert not scratch.exists()
+
+def test_intent_without_its_encode_is_lost(tmp_path):
+    intent = FinalizeIntent(tmp_path / "a.mkv", tmp_path / "a.tmp.mkv", tmp_path / "b.mkv", staged_output=tmp_path / "scratch.mkv")
+    assert intent.encode_lost()
+    intent.stage = 'replace'
+    assert intent.encode_lost()
+    intent.stage = 'cleanup'
+    assert not intent.encode_lost()
+
+class FakeSpool:
+    def __init__(self):
+        self.results = []
+
+    def submit(self, job_id, status, details=None, key=None):
+        self.results.append((job_id, status))
+
+    def has_pending(self):
+        return False
+
+def test_job_submitted_after_stop_is_finished_inline(tmp_path, monkeypatch):
+    spool = FakeSpool()
+    monkeypatch.setattr(transcode, "RESULT_SPOOL", spool)
+    journal = FinalizeJournal(tmp_path / "finalize")
+    stage = FinalizeStage(journal=journal).start()
+    stage.submit(1, True, {}, None)
+    stage.stop(timeout=10)
+
+    original = tmp_path / "movie.mkv"
+    temp_output = tmp_path / "movie.tmp.mkv"
+    original.write_bytes(b"original")
+    temp_output.write_bytes(b"encoded")
+    stage.submit(2, True, {}, FinalizeIntent(original, temp_output, original))
+    assert spool.results == [(1, "completed"), (2, "completed")]
+    assert original.read_bytes() == b"encoded"
+    assert journal.records() == []
@@ -0,0 +1,71 @@
+import threading
+
+from transcode import GpuDevices, get_hw_config
+
+def in_thread(target):
+    """Runs target on its own thread, like a job slot, and returns its result."""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(target()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+def test_cpu_encodes_lease_no_device(capabilities):
+    devices = GpuDevices()
+    hw_config = get_hw_config("cpu")
+    assert devices.acquire(hw_config) is hw_config
+    assert devices.usage() == []
+
+def test_slots_are_spread_over_the_gpus(capabilities):
+    capabilities["devices"]["cuda"] = ["RTX 4000", "RTX 2000"]
+    devices = GpuDevices()
+    hw_config = get_hw_config("nvidia")
+    acquired, release = threading.Barrier(3), threading.Event()
+
+    def slot():
+        bound = devices.acquire(hw_config)
+        acquired.wait()
+        release.wait()
+        devices.release()
+        return bound["device"]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slot())) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    acquired.wait()
+    usage = {entry["device"]: entry["sessions"] for entry in devices.usage()}
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == ["cuda:0", "cuda:1"]
+    assert usage == {"cuda:0": 1, "cuda:1": 1}
+    assert {entry["device"]: entry["sessions"] for entry in devices.usage()} == {"cuda:0": 0, "cuda:1": 0}
+
+def test_lease_binds_the_hw_config_to_the_device(capabilities):
+    capabilities["devices"]["render_nodes"] = ["/dev/dri/renderD128", "/dev/dri/renderD129"]
+    devices = GpuDevices()
+    first = devices.acquire(get_hw_config("vaapi", family="av1", tier="fast"))
+    second = in_thread(lambda: devices.acquire(get_hw_config("vaapi", family="av1", tier="fast")))
+    assert (first["device"], second["device"]) == ("/dev/dri/renderD128", "/dev/dri/renderD129")
+    assert (second["family"], second["tier"]) == ("av1", "fast")
+    assert second["hw_pre_args"][:2] == ["-vaapi_device", "/dev/dri/renderD129"]
+
+def test_a_slot_holds_one_lease_at_a_time(capabilities):
+    capabilities["devices"]["cuda"] = ["RTX 4000", "RTX 2000"]
+    devices = GpuDevices()
+    devices.acquire(get_hw_config("nvidia"))
+    devices.acquire(get_hw_config("nvidia"))
+    devices.update_fps(120.04)
+    assert [(entry["device"], entry["sessions"], entry["fps"]) for entry in devices.usage() if entry["sessions"]] == [("cuda:0", 1, 120.0)]
+    devices.release()
+    assert all(entry["sessions"] == 0 for entry in devices.usage())
+
+def test_cuda_device_is_passed_to_ffmpeg(capabilities):
+    capabilities["devices"]["cuda"] = ["RTX 4000", "RTX 2000"]
+    devices = GpuDevices()
+    in_thread(lambda: devices.acquire(get_hw_config("nvidia")))
+    hw_config = devices.acquire(get_hw_config("nvidia"))
+    # The lease of the finished thread is still counted, so this slot gets the other GPU
+    assert hw_config["device"] == "cuda:1"
+    assert hw_config["extra"][-2:] == ["-gpu", "1"]
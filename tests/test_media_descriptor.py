@@ -0,0 +1,50 @@
+from media_descriptor import parse_media_descriptor
+
+def probe(video, streams=(), duration="5400.5", bit_rate="8000000"):
+    return {"streams": [{"codec_type": "video", **video}, *streams], "format": {"duration": duration, "bit_rate": bit_rate}}
+
+def test_sdr_8_bit_h264():
+    descriptor = parse_media_descriptor(probe(
+        {"codec_name": "H264", "width": 1920, "height": 1080, "pix_fmt": "yuv420p"},
+        streams=[{"codec_type": "audio"}, {"codec_type": "audio"}, {"codec_type": "subtitle"}],
+    ))
+    assert descriptor == {
+        "codec": "h264", "width": 1920, "height": 1080, "pix_fmt": "yuv420p", "bit_depth": 8,
+        "duration": 5400.5, "bitrate": 8000000, "hdr": None,
+        "video_streams": 1, "audio_streams": 2, "subtitle_streams": 1,
+    }
+
+def test_hdr10_10_bit_hevc():
+    descriptor = parse_media_descriptor(probe({"codec_name": "hevc", "pix_fmt": "yuv420p10le", "color_transfer": "smpte2084"}))
+    assert descriptor["hdr"] == "hdr10"
+    assert descriptor["bit_depth"] == 10
+
+def test_hlg():
+    assert parse_media_descriptor(probe({"codec_name": "hevc", "pix_fmt": "yuv420p10le", "color_transfer": "arib-std-b67"}))["hdr"] == "hlg"
+
+def test_dolby_vision_wins_over_the_transfer_function():
+    descriptor = parse_media_descriptor(probe({
+        "codec_name": "hevc", "pix_fmt": "yuv420p10le", "color_transfer": "smpte2084",
+        "side_data_list": [{"side_data_type": "DOVI configuration record"}],
+    }))
+    assert descriptor["hdr"] == "dolby_vision"
+
+def test_bit_depth_from_the_pixel_format_or_raw_sample_size():
+    assert parse_media_descriptor(probe({"pix_fmt": "p010le"}))["bit_depth"] == 10
+    assert parse_media_descriptor(probe({"pix_fmt": "yuv444p12be"}))["bit_depth"] == 12
+    assert parse_media_descriptor(probe({"pix_fmt": "yuv420p", "bits_per_raw_sample": "10"}))["bit_depth"] == 10
+    assert parse_media_descriptor(probe({}))["bit_depth"] is None
+
+def test_cover_art_is_not_the_video_stream():
+    descriptor = parse_media_descriptor({"streams": [
+        {"codec_type": "video", "codec_name": "mjpeg", "disposition": {"attached_pic": 1}},
+        {"codec_type": "video", "codec_name": "hevc", "width": 3840},
+    ], "format": {}})
+    assert (descriptor["codec"], descriptor["width"]) == ("hevc", 3840)
+    assert descriptor["duration"] is None
+
+def test_missing_values_are_none():
+    descriptor = parse_media_descriptor({})
+    assert descriptor["codec"] == ""
+    assert descriptor["width"] is None
+    assert descriptor["video_streams"] == 0
@@ -0,0 +1,62 @@
+import os
+import shutil
+
+import pytest
+
+from transcode import NodeResources, get_hw_config
+
+FFMPEG = ["ffmpeg", "-i", "in.mkv", "out.mkv"]
+
+@pytest.fixture
+def resources(monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda tool: f"/usr/bin/{tool}")
+    resources = NodeResources()
+    monkeypatch.setattr(resources, "_configure_cgroup", lambda cpu_limit: None)
+    return resources
+
+def test_empty_profile_leaves_the_command_alone(resources):
+    resources.update({})
+    assert resources.wrap(FFMPEG) == FFMPEG
+    assert resources.encoder_args(get_hw_config("cpu")) == []
+
+def test_wrap_prefixes_nice_ionice_and_taskset(resources):
+    resources.update({"nice": 10, "ionice": "idle", "cpuset": "0-3"})
+    assert resources.wrap(FFMPEG) == ["nice", "-n", "10", "ionice", "-c", "3", "taskset", "-c", "0-3"] + FFMPEG
+
+def test_wrap_skips_unset_and_unknown_options(resources):
+    resources.update({"ionice": "realtime", "cpuset": "2,4"})
+    assert resources.wrap(FFMPEG) == ["taskset", "-c", "2,4"] + FFMPEG
+
+def test_missing_tools_disable_the_prefix(resources, monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda tool: None if tool == "taskset" else f"/usr/bin/{tool}")
+    resources.update({"nice": 5, "cpuset": "0-3"})
+    assert resources.wrap(FFMPEG) == FFMPEG
+
+def test_x265_thread_options(resources):
+    resources.update({"threads": 8, "pools": "4", "frame_threads": 2})
+    assert resources.encoder_args(get_hw_config("cpu")) == ["-threads", "8", "-x265-params", "pools=4:frame-threads=2"]
+
+def test_svtav1_thread_options(resources):
+    resources.update({"threads": 6})
+    assert resources.encoder_args(get_hw_config("cpu", family="av1")) == ["-threads", "6", "-svtav1-params", "lp=6"]
+
+def test_hardware_encoders_get_no_thread_options(resources):
+    resources.update({"threads": 8, "pools": "4"})
+    assert resources.encoder_args(get_hw_config("nvidia")) == []
+
+def test_the_worker_itself_is_never_attached_to_the_cpu_limit(tmp_path):
+    resources = NodeResources()
+    resources._cgroup = tmp_path
+    (tmp_path / "cgroup.procs").write_text("")
+    resources.attach(os.getpid())
+    assert (tmp_path / "cgroup.procs").read_text() == ""
+    resources.attach(12345)
+    assert (tmp_path / "cgroup.procs").read_text() == "12345"
+
+def test_cpu_limit_is_written_to_cpu_max(tmp_path, monkeypatch):
+    resources = NodeResources()
+    monkeypatch.setattr(resources, "_create_cgroup", lambda: tmp_path)
+    resources.update({"cpu_limit": 2.5})
+    assert (tmp_path / "cpu.max").read_text() == "250000 100000"
+    resources.update({})
+    assert (tmp_path / "cpu.max").read_text() == "max 100000"
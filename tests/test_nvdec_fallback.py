@@ -0,0 +1,40 @@
+import pytest
+
+from transcode import get_hw_config, hw_config_for_source
+
+@pytest.mark.parametrize("codec, pix_fmt", [
+    ("h264", "yuv420p"),
+    ("hevc", "yuv420p10le"),
+    ("hevc", "p010le"),
+    ("vp9", "yuv420p10le"),
+    ("mpeg2video", "yuv420p"),
+    ("hevc", None),
+])
+def test_sources_nvdec_can_decode_stay_on_the_gpu(codec, pix_fmt):
+    hw_config = get_hw_config("nvidia", cuda_device=0)
+    assert hw_config_for_source(hw_config, {"codec": codec, "pix_fmt": pix_fmt}) is hw_config
+    assert "-hwaccel_output_format" in hw_config["hw_pre_args"]
+
+@pytest.mark.parametrize("codec, pix_fmt", [
+    ("h264", "yuv420p10le"), # 10-bit H.264 is not supported by NVDEC
+    ("hevc", "yuv444p"),
+    ("mpeg2video", "yuv422p"),
+    ("prores", "yuv422p10le"),
+    (None, None),
+])
+def test_other_sources_are_decoded_on_the_cpu(codec, pix_fmt):
+    hw_config = get_hw_config("nvidia", cuda_device=1)
+    software = hw_config_for_source(hw_config, {"codec": codec, "pix_fmt": pix_fmt})
+    assert software["hw_pre_args"] == []
+    # Only the decode side changes; the encode still runs on the same GPU
+    assert software["codec"] == "hevc_nvenc"
+    assert software["extra"] == hw_config["extra"]
+    assert hw_config["hw_pre_args"]
+
+def test_missing_descriptor_falls_back_to_the_cpu():
+    assert hw_config_for_source(get_hw_config("nvidia"), None)["hw_pre_args"] == []
+
+@pytest.mark.parametrize("mode", ["qsv", "vaapi", "cpu"])
+def test_other_modes_are_left_alone(mode):
+    hw_config = get_hw_config(mode)
+    assert hw_config_for_source(hw_config, {"codec": "prores", "pix_fmt": "yuv422p10le"}) is hw_config
@@ -0,0 +1,121 @@
+import json
+
+import pytest
+import requests
+
+import transcode
+from transcode import JobUpdateRejected, ResultSpool
+
+class FakeDashboard:
+    """Records the job updates that reach the dashboard; updates fail while it is offline."""
+    def __init__(self):
+        self.online = True
+        self.rejected_jobs = set()
+        self.updates = []
+
+    def update_job_status(self, job_id, status, details=None, idempotency_key=None):
+        if not self.online:
+            return False
+        if job_id in self.rejected_jobs:
+            raise JobUpdateRejected("HTTP 422: invalid status")
+        self.updates.append((job_id, status, idempotency_key))
+        return True
+
+@pytest.fixture
+def dashboard(monkeypatch):
+    dashboard = FakeDashboard()
+    monkeypatch.setattr(transcode, "update_job_status", dashboard.update_job_status)
+    return dashboard
+
+def test_delivered_results_remove_the_journal(tmp_path, dashboard):
+    spool = ResultSpool(tmp_path / "results.jsonl")
+    spool.submit(1, "completed", {"new_size": 10}, key="a")
+    assert dashboard.updates == [(1, "completed", "a")]
+    assert not spool.has_pending()
+
+def test_undelivered_results_are_replayed_in_order(tmp_path, dashboard):
+    spool = ResultSpool(tmp_path / "results.jsonl")
+    dashboard.online = False
+    spool.submit(1, "completed", key="a")
+    spool.submit(2, "failed", key="b")
+    assert [entry["key"] for entry in spool.pending()] == ["a", "b"]
+    assert spool.pending_jobs() == [{"job_id": 1, "segment_index": None}, {"job_id": 2, "segment_index": None}]
+
+    dashboard.online = True
+    assert spool.replay() == 0
+    assert dashboard.updates == [(1, "completed", "a"), (2, "failed", "b")]
+    assert not spool.has_pending()
+
+def test_a_restarted_worker_replays_the_journal(tmp_path, dashboard):
+    path = tmp_path / "results.jsonl"
+    dashboard.online = False
+    ResultSpool(path).submit(1, "completed", key="a")
+
+    dashboard.online = True
+    assert ResultSpool(path).replay() == 0
+    assert dashboard.updates == [(1, "completed", "a")]
+
+def test_acknowledged_and_torn_lines_are_not_replayed(tmp_path, dashboard):
+    path = tmp_path / "results.jsonl"
+    path.write_text('{"key": "a", "job_id": 1, "status": "completed"}\n{"ack": "a"}\n{"key": "b", "job_id": 2, "status": "comp')
+    spool = ResultSpool(path)
+    assert spool.pending() == []
+    dashboard.online = False
+    spool.submit(3, "completed", key="c")
+    assert [entry["key"] for entry in spool.pending()] == ["c"]
+
+def test_segment_results_name_their_segment(tmp_path, dashboard):
+    spool = ResultSpool(tmp_path / "results.jsonl")
+    dashboard.online = False
+    spool.submit(4, "completed", {"segment_index": 2}, key="a")
+    assert spool.pending_jobs() == [{"job_id": 4, "segment_index": 2}]
+
+def test_disabled_spool_sends_directly(dashboard):
+    spool = ResultSpool(None)
+    spool.submit(1, "completed", key="a")
+    assert dashboard.updates == [(1, "completed", "a")]
+    assert spool.pending() == []
+    assert spool.replay() == 0
+
+def test_rejected_result_does_not_block_the_ones_behind_it(tmp_path, dashboard):
+    spool = ResultSpool(tmp_path / "results.jsonl")
+    dashboard.online = False
+    spool.submit(1, "completed", key="a")
+    spool.submit(2, "completed", key="b")
+
+    dashboard.online = True
+    dashboard.rejected_jobs.add(1)
+    assert spool.replay() == 0
+    assert dashboard.updates == [(2, "completed", "b")]
+    assert not spool.has_pending()
+    rejected = [json.loads(line) for line in (tmp_path / "results.rejected.jsonl").read_text().splitlines()]
+    assert [(entry["key"], entry["job_id"]) for entry in rejected] == [("a", 1)]
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = "error"
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error")
+
+class FakeClient:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def request(self, method, path, **kwargs):
+        return FakeResponse(self.status_code)
+
+@pytest.mark.parametrize("status_code, expected", [(200, True), (404, True), (408, False), (429, False), (500, False), (503, False)])
+def test_update_job_status_reports_whether_to_send_again(monkeypatch, status_code, expected):
+    monkeypatch.setattr(transcode, "SESSION_TOKEN", "token")
+    monkeypatch.setattr(transcode, "DASHBOARD", FakeClient(status_code))
+    assert transcode.update_job_status(1, "completed") is expected
+
+@pytest.mark.parametrize("status_code", [400, 403, 409, 422])
+def test_update_job_status_raises_when_rejected_for_good(monkeypatch, status_code):
+    monkeypatch.setattr(transcode, "SESSION_TOKEN", "token")
+    monkeypatch.setattr(transcode, "DASHBOARD", FakeClient(status_code))
+    with pytest.raises(JobUpdateRejected):
+        transcode.update_job_status(1, "completed")
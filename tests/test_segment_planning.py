@@ -0,0 +1,42 @@
+import re
+
+from segment_planning import plan_segments
+from transcode import SEGMENT_DIR_PATTERN, join_segments_command, segment_directory, segment_path
+
+def test_segments_start_on_keyframes():
+    keyframes = [0.0, 2.0, 55.0, 61.0, 119.0, 125.0, 190.0]
+    assert plan_segments(keyframes, 240.0, 60) == [(0.0, 61.0), (61.0, 125.0), (125.0, 190.0), (190.0, 240.0)]
+
+def test_segments_cover_the_whole_file_without_gaps():
+    keyframes = [i * 2.5 for i in range(400)]
+    segments = plan_segments(keyframes, 1000.0, 120)
+    assert segments[0][0] == 0.0
+    assert segments[-1][1] == 1000.0
+    assert all(end == start for (_, end), (start, _) in zip(segments, segments[1:]))
+
+def test_short_remainder_is_merged_into_the_last_segment():
+    keyframes = [60.0, 120.0, 150.0]
+    # 150 would leave only 20 seconds at the end, less than half a segment
+    assert plan_segments(keyframes, 170.0, 60) == [(0.0, 60.0), (60.0, 120.0), (120.0, 170.0)]
+
+def test_unsorted_keyframes_are_sorted():
+    assert plan_segments([120.0, 60.0], 180.0, 60) == [(0.0, 60.0), (60.0, 120.0), (120.0, 180.0)]
+
+def test_file_shorter_than_a_segment_is_one_segment():
+    assert plan_segments([0.0, 10.0, 20.0], 30.0, 60) == [(0.0, 30.0)]
+    assert plan_segments([], 30.0, 60) == [(0.0, 30.0)]
+
+def test_segment_directory_matches_the_cleanup_pattern(tmp_path):
+    directory = segment_directory(tmp_path / "movie.mkv", 42)
+    assert directory.parent == tmp_path
+    assert SEGMENT_DIR_PATTERN.fullmatch(directory.name)
+    assert not SEGMENT_DIR_PATTERN.fullmatch(".librarrarian_segments_42/..")
+    assert not SEGMENT_DIR_PATTERN.fullmatch("movies")
+
+def test_join_command_lists_the_segments_in_order(tmp_path):
+    command = join_segments_command(tmp_path, [0, 1, 2], tmp_path / "movie.mkv", tmp_path / "movie.tmp.mkv")
+    concat_list = (tmp_path / "segments.txt").read_text()
+    assert concat_list == "".join(f"file '{segment_path(tmp_path, index).name}'\n" for index in range(3))
+    assert re.fullmatch(r"(file 'segment_\d{5}\.seg'\n){3}", concat_list)
+    assert command[-1] == str(tmp_path / "movie.tmp.mkv")
+    assert ["-c", "copy"] == command[-3:-1]
@@ -0,0 +1,61 @@
+import pytest
+
+import transcode
+
+class FakeResponse:
+    def __init__(self, status_code, data=None, etag=None):
+        self.status_code = status_code
+        self._data = data
+        self.headers = {"ETag": etag} if etag else {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._data
+
+class FakeDashboard:
+    """Stands in for the worker's dashboard client and records the request headers."""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.headers = []
+
+    def request(self, method, path, name=None, headers=None, **kwargs):
+        self.headers.append(dict(headers or {}))
+        return self.responses.pop(0)
+
+@pytest.fixture(autouse=True)
+def empty_snapshot(monkeypatch):
+    monkeypatch.setattr(transcode, "_settings_snapshot", {"etag": None, "version": None, "settings": {}, "dashboard_version": None})
+    monkeypatch.setattr(transcode, "SESSION_TOKEN", "token")
+
+def test_first_fetch_stores_the_snapshot(monkeypatch):
+    dashboard = FakeDashboard([FakeResponse(200, {"settings": {"cpu_cq_hd": "24"}, "dashboard_version": "1.0", "settings_version": 7}, etag='"settings-7"')])
+    monkeypatch.setattr(transcode, "DASHBOARD", dashboard)
+    assert transcode.get_dashboard_settings() == ({"cpu_cq_hd": "24"}, "1.0")
+    assert dashboard.headers == [{}]
+    assert transcode.settings_snapshot_is_current(7)
+    assert not transcode.settings_snapshot_is_current(8)
+    assert not transcode.settings_snapshot_is_current(None)
+
+def test_not_modified_returns_the_stored_snapshot(monkeypatch):
+    dashboard = FakeDashboard([
+        FakeResponse(200, {"settings": {"cpu_cq_hd": "24"}, "dashboard_version": "1.0", "settings_version": 7}, etag='"settings-7"'),
+        FakeResponse(304),
+    ])
+    monkeypatch.setattr(transcode, "DASHBOARD", dashboard)
+    settings, _ = transcode.get_dashboard_settings()
+    settings["cpu_cq_hd"] = "99" # Callers must not be able to change the stored snapshot
+    assert transcode.get_dashboard_settings() == ({"cpu_cq_hd": "24"}, "1.0")
+    assert dashboard.headers[1] == {"If-None-Match": '"settings-7"'}
+
+def test_changed_settings_replace_the_snapshot(monkeypatch):
+    dashboard = FakeDashboard([
+        FakeResponse(200, {"settings": {"cpu_cq_hd": "24"}, "dashboard_version": "1.0", "settings_version": 7}, etag='"settings-7"'),
+        FakeResponse(200, {"settings": {"cpu_cq_hd": "26"}, "dashboard_version": "1.0", "settings_version": 8}, etag='"settings-8"'),
+    ])
+    monkeypatch.setattr(transcode, "DASHBOARD", dashboard)
+    transcode.get_dashboard_settings()
+    assert transcode.get_dashboard_settings() == ({"cpu_cq_hd": "26"}, "1.0")
+    assert transcode.settings_snapshot_is_current(8)
+    assert not transcode.settings_snapshot_is_current(7)
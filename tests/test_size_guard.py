@@ -0,0 +1,44 @@
+from transcode import FFmpegProgress, SizeGuard
+
+GB = 1024 ** 3
+
+def sample(out_time_seconds, total_size):
+    return FFmpegProgress(out_time_seconds=out_time_seconds, total_size=total_size)
+
+def test_disabled_without_a_check_percent_or_duration():
+    assert SizeGuard.from_settings({"size_guard_percent": "0", "min_savings_percent": "10"}, GB, 3600) is None
+    assert SizeGuard.from_settings({"size_guard_percent": "20", "min_savings_percent": "10"}, GB, 0) is None
+    assert SizeGuard.from_settings({"size_guard_percent": "twenty"}, GB, 3600) is None
+    assert SizeGuard.from_settings({}, GB, 3600) is None
+
+def test_waits_for_the_check_fraction():
+    guard = SizeGuard.from_settings({"size_guard_percent": "20", "min_savings_percent": "10"}, 10 * GB, 1000)
+    # 10% in and already as big as the original would be, but too early to judge
+    assert not guard.check(sample(100, 10 * GB))
+    assert guard.projected_size is None
+
+def test_trips_when_the_projection_misses_the_minimum_saving():
+    guard = SizeGuard.from_settings({"size_guard_percent": "20", "min_savings_percent": "10"}, 10 * GB, 1000)
+    # 25% encoded into 2.4 GB projects 9.6 GB, which saves only 4%
+    assert guard.check(sample(250, round(2.4 * GB)))
+    assert guard.tripped
+    assert round(guard.savings_percent(guard.projected_size)) == 4
+
+def test_keeps_going_while_the_projection_beats_the_minimum_saving():
+    guard = SizeGuard.from_settings({"size_guard_percent": "20", "min_savings_percent": "10"}, 10 * GB, 1000)
+    # 50% encoded into 2 GB projects 4 GB, a 60% saving
+    assert not guard.check(sample(500, 2 * GB))
+    assert guard.projected_size == 4 * GB
+    assert not guard.tripped
+
+def test_ignores_samples_without_a_size_or_time():
+    guard = SizeGuard.from_settings({"size_guard_percent": "20", "min_savings_percent": "10"}, 10 * GB, 1000)
+    assert not guard.check(sample(None, 9 * GB))
+    assert not guard.check(sample(500, None))
+
+def test_check_percent_is_capped_at_the_whole_file():
+    guard = SizeGuard.from_settings({"size_guard_percent": "150", "min_savings_percent": "0"}, 10 * GB, 1000)
+    assert guard.check_fraction == 1
+    # ffmpeg can report slightly more time than the probed duration
+    assert guard.check(sample(1010, 11 * GB))
+    assert guard.projected_size == 11 * GB
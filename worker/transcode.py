@@ -1,30 +1,48 @@
 #!/usr/bin/env python3
 import os
 import sys
+import errno
 import time
 import shutil
 import argparse
+import contextlib
 import subprocess
 import socket
+import signal
 import threading
+import queue
 import json
+import random
+import uuid
 import secrets
+import hashlib
+import gzip
+import tempfile
+import glob
 from pathlib import Path
 import re
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Optional
 from datetime import datetime, timezone
 import requests
+from requests.adapters import HTTPAdapter
 
-# Check for Postgres Driver
+# The Postgres driver is only needed when node state is written to the database directly
+# (WORKER_STATE_BACKEND=database). Workers in 'api' mode talk to the dashboard only.
 try:
     import psycopg2
+    import psycopg2.extensions
+    from psycopg2 import pool as pg_pool
 except ImportError:
-    print("❌ Error: Missing PostgreSQL driver.")
-    print("   Please run: pip3 install psycopg2-binary")
-    sys.exit(1)
+    psycopg2 = None
 
 # ===========================
 # Global Settings
 # ===========================
+# GPU indexes passed to ffmpeg (-hwaccel_device, -gpu) are matched to nvidia-smi, which lists devices in
+# PCI bus order. CUDA defaults to fastest-first, so pin the order before ffmpeg or nvidia-smi ever runs.
+os.environ.setdefault('CUDA_DEVICE_ORDER', 'PCI_BUS_ID')
 DASHBOARD_URL = os.environ.get('DASHBOARD_URL', 'http://localhost:5000')
 DB_HOST = os.environ.get("DB_HOST", "192.168.10.120")
 
@@ -87,136 +105,1219 @@ DB_CONFIG = {
     "password": os.environ.get("DB_PASSWORD"),
     "dbname": os.environ.get("DB_NAME", "librarrarian")
 }
+# Where node state (heartbeats, slots, commands) goes: 'database' writes to PostgreSQL directly,
+# 'api' sends it to the dashboard's /api/worker/heartbeat endpoint and needs no database access at all
+WORKER_STATE_BACKEND = os.environ.get("WORKER_STATE_BACKEND", "database" if psycopg2 is not None else "api").lower()
+# Seconds between batched heartbeat requests in 'api' mode
+HEARTBEAT_BATCH_INTERVAL = float(os.environ.get("HEARTBEAT_BATCH_INTERVAL", "2"))
+# Number of jobs this worker runs concurrently. Can be overridden per node from the dashboard.
+WORKER_SLOTS = int(os.environ.get("WORKER_SLOTS", "1"))
+MAX_WORKER_SLOTS = 16
+# Maximum number of pooled connections this worker keeps open to PostgreSQL. Each slot needs one for
+# its encode loop and one for its progress reporter, plus the main loop and the finalize stage.
+# Connections are only opened when needed, so the default is sized for the slot limit.
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", str(2 * MAX_WORKER_SLOTS + 2)))
+# Seconds a database call waits for a free pooled connection before giving up
+DB_POOL_WAIT_SECONDS = 10
+# Seconds before the end of an encode at which the worker leases its next job (0 disables pipelining)
+PIPELINE_PREFETCH_SECONDS = float(os.environ.get("PIPELINE_PREFETCH_SECONDS", "30"))
+# How long a leased job stays reserved for this worker before the dashboard hands it to another node
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "120"))
+# Seconds a job request waits on the dashboard for a job to arrive when the queue is empty (0 disables long-polling)
+JOB_LONG_POLL_SECONDS = float(os.environ.get("JOB_LONG_POLL_SECONDS", "25"))
+# Maximum number of finished jobs waiting for file replacement and status reporting
+FINALIZE_QUEUE_SIZE = int(os.environ.get("FINALIZE_QUEUE_SIZE", "4"))
+# How often a finished job's file operations are retried after an error (full share, stale NFS handle)
+# before the job is reported as failed. Retries start after a minute and back off to 30 minutes.
+FINALIZE_RETRY_ATTEMPTS = int(os.environ.get("FINALIZE_RETRY_ATTEMPTS", "8"))
+FINALIZE_RETRY_SECONDS = 60
+FINALIZE_RETRY_MAX_SECONDS = 1800
+# How long a request to the dashboard's command stream is held open waiting for a node command (0 = poll the database only)
+COMMAND_STREAM_WAIT_SECONDS = float(os.environ.get("COMMAND_STREAM_WAIT_SECONDS", "25"))
+# Minimum number of seconds between progress heartbeats written during an encode
+PROGRESS_REPORT_INTERVAL = float(os.environ.get("PROGRESS_REPORT_INTERVAL", "2"))
+# Number of ffmpeg log lines kept from the start (stream mapping, early errors) and the end of each encode
+FFMPEG_LOG_HEAD_LINES = int(os.environ.get("FFMPEG_LOG_HEAD_LINES", "200"))
+FFMPEG_LOG_TAIL_LINES = int(os.environ.get("FFMPEG_LOG_TAIL_LINES", "300"))
+# Optional directory where the complete ffmpeg log of every encode is written as a .log.gz file
+FFMPEG_LOG_SPILL_DIR = os.environ.get("FFMPEG_LOG_SPILL_DIR", "")
+# Optional local directory where sources are staged and encoded before the result is copied back to the share
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", "")
+# Maximum amount of scratch space (in GB) used by staged jobs at the same time (0 = limited by free disk space only)
+SCRATCH_BUDGET_GB = float(os.environ.get("SCRATCH_BUDGET_GB", "0"))
+# Whether the next job's source is staged while the current one encodes
+SCRATCH_PREFETCH = os.environ.get("SCRATCH_PREFETCH", "true").lower() == "true"
+SCRATCH_COPY_CHUNK_BYTES = 16 * 1024 * 1024
+# Source codecs the NVIDIA GPUs of this node decode in hardware. AV1 needs an RTX 30 series or newer GPU.
+NVDEC_CODECS = {codec.strip().lower() for codec in os.environ.get("NVDEC_CODECS", "h264,hevc,mpeg1video,mpeg2video,vc1,vp8,vp9").split(",") if codec.strip()}
+# Number of times a failed dashboard API call is retried, and the base delay (seconds) of the exponential backoff
+API_RETRIES = int(os.environ.get("API_RETRIES", "3"))
+API_RETRY_BACKOFF = float(os.environ.get("API_RETRY_BACKOFF", "1"))
+# Job results are worth more than any other call, so job status updates are retried for longer
+JOB_UPDATE_RETRIES = int(os.environ.get("JOB_UPDATE_RETRIES", "8"))
+# How often the dashboard API latency summary is written to the log
+API_METRICS_LOG_SECONDS = 3600
+# Local journal where job results are kept until the dashboard has accepted them (empty = disabled).
+# Mount it on a volume to keep undelivered results when the container is recreated.
+RESULT_SPOOL_PATH = os.environ.get("RESULT_SPOOL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool", "results.jsonl"))
+# Seconds between attempts to deliver spooled results while the dashboard is unreachable
+RESULT_REPLAY_INTERVAL = 60
+# Local directory where the file operations of finished jobs (scratch copy-back, original backup or
+# deletion, temp file rename) are recorded until they are done, so a restarted worker finishes
+# them instead of leaving half-moved files behind (empty = disabled). Keep it on the same volume as the spool.
+FINALIZE_JOURNAL_DIR = os.environ.get("FINALIZE_JOURNAL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool", "finalize"))
+
+# ===========================
+# Dashboard API Client
+# ===========================
+
+class DashboardClient:
+    """
+    Shared HTTP client for every call to the dashboard API. A single requests.Session keeps
+    connections alive between calls (one pool sized for all slot threads), failed calls are
+    retried with exponential backoff and full jitter, and the latency of every call is recorded
+    per endpoint. Calls that are not idempotent are only retried when the connection could not
+    be opened, so the dashboard never sees them twice.
+    """
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    MAX_BACKOFF_SECONDS = 30
+
+    def __init__(self, base_url, api_key=None, retries=API_RETRIES, backoff=API_RETRY_BACKOFF):
+        self.base_url = base_url.rstrip('/')
+        self.retries = max(0, retries)
+        self.backoff = max(0.0, backoff)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2 * MAX_WORKER_SLOTS + 4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key:
+            self.session.headers['X-API-Key'] = api_key
+        self._metrics_lock = threading.Lock()
+        self._metrics = {}
+
+    def _record(self, name, started, failed=False, retried=False):
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._metrics_lock:
+            metrics = self._metrics.setdefault(name, {"calls": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0})
+            metrics["calls"] += 1
+            metrics["errors"] += failed
+            metrics["retries"] += retried
+            metrics["total_ms"] += elapsed_ms
+            metrics["max_ms"] = max(metrics["max_ms"], elapsed_ms)
+
+    def metrics(self):
+        """Returns a snapshot of the per-endpoint call counters and latencies."""
+        with self._metrics_lock:
+            return {name: dict(metrics) for name, metrics in self._metrics.items()}
+
+    def log_metrics(self):
+        for name, metrics in sorted(self.metrics().items()):
+            print(f"[{datetime.now()}] Dashboard API {name}: {metrics['calls']} calls, {metrics['errors']} errors, {metrics['retries']} retries, "
+                  f"avg {metrics['total_ms'] / max(metrics['calls'], 1):.0f} ms, max {metrics['max_ms']:.0f} ms")
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.MAX_BACKOFF_SECONDS, self.backoff * 2 ** attempt))
+
+    def request(self, method, path, name=None, idempotent=True, retries=None, **kwargs):
+        """
+        Sends a request to the dashboard and returns the response. Raises the last
+        requests exception when every attempt failed to get a response at all.
+        """
+        name = name or path
+        attempts = 1 + (self.retries if retries is None else max(0, retries))
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            except requests.exceptions.RequestException as e:
+                retry = not last_attempt and (idempotent or isinstance(e, requests.exceptions.ConnectTimeout))
+                self._record(name, started, failed=True, retried=retry)
+                if not retry:
+                    raise
+                delay = self._delay(attempt)
+                print(f"[{datetime.now()}] API Error: {name} failed ({e}). Retrying in {delay:.1f}s...")
+                if STOP_EVENT.wait(delay):
+                    raise
+                continue
+            retry = idempotent and not last_attempt and response.status_code in self.RETRY_STATUS_CODES
+            self._record(name, started, failed=response.status_code >= 500, retried=retry)
+            if not retry:
+                return response
+            delay = self._delay(attempt)
+            print(f"[{datetime.now()}] API Error: {name} returned HTTP {response.status_code}. Retrying in {delay:.1f}s...")
+            if STOP_EVENT.wait(delay):
+                return response
+        return response
+
+DASHBOARD = DashboardClient(DASHBOARD_URL, API_KEY)
 
 # ===========================
 # Database Layer
 # ===========================
 
+if psycopg2 is not None:
+    class _PreparedConnection(psycopg2.extensions.connection):
+        """A psycopg2 connection that remembers which statements were prepared on it."""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+
 class DatabaseHandler:
-    def __init__(self, conn_params):
+    # Server-side prepared statements. Each one is PREPAREd lazily the first time it is
+    # used on a pooled connection, so every later call is a single EXECUTE round trip.
+    PREPARED_STATEMENTS = {
+        "heartbeat_upsert": """
+            INSERT INTO nodes (hostname, last_heartbeat, status, version, current_file, progress, fps, version_mismatch, total_duration, job_start_time, speed)
+            VALUES ($1, NOW(), $2, $3, $4, $5, $6, $7, $8, $9, $10)
+            ON CONFLICT (hostname) DO UPDATE SET
+                last_heartbeat = EXCLUDED.last_heartbeat,
+                status = EXCLUDED.status,
+                version = EXCLUDED.version,
+                current_file = EXCLUDED.current_file,
+                progress = EXCLUDED.progress,
+                fps = EXCLUDED.fps,
+                version_mismatch = EXCLUDED.version_mismatch,
+                total_duration = EXCLUDED.total_duration,
+                job_start_time = EXCLUDED.job_start_time,
+                speed = EXCLUDED.speed
+        """,
+        "heartbeat_touch": """
+            UPDATE nodes SET last_heartbeat = NOW() WHERE hostname = $1
+        """,
+        "node_control": """
+            SELECT n.command, o.max_slots, o.resources FROM nodes n
+            LEFT JOIN node_options o ON o.hostname = n.hostname
+            WHERE n.hostname = $1
+        """,
+        "slot_heartbeat_upsert": """
+            WITH slot_upsert AS (
+                INSERT INTO node_slots (hostname, slot, status, job_id, current_file, progress, fps, speed, total_duration, job_start_time, last_heartbeat)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, NOW())
+                ON CONFLICT (hostname, slot) DO UPDATE SET
+                    status = EXCLUDED.status,
+                    job_id = EXCLUDED.job_id,
+                    current_file = EXCLUDED.current_file,
+                    progress = EXCLUDED.progress,
+                    fps = EXCLUDED.fps,
+                    speed = EXCLUDED.speed,
+                    total_duration = EXCLUDED.total_duration,
+                    job_start_time = EXCLUDED.job_start_time,
+                    last_heartbeat = EXCLUDED.last_heartbeat
+            )
+            UPDATE nodes SET last_heartbeat = NOW() WHERE hostname = $1
+        """,
+        "slots_trim": "DELETE FROM node_slots WHERE hostname = $1 AND slot >= $2",
+        "node_hw_refresh": """
+            UPDATE nodes SET hardware_refresh_requested = false
+            WHERE hostname = $1 AND hardware_refresh_requested
+            RETURNING hostname
+        """,
+        "node_capabilities": "UPDATE nodes SET capabilities = $2::jsonb WHERE hostname = $1",
+        "node_devices": "UPDATE nodes SET devices = $2::jsonb WHERE hostname = $1",
+        "node_delete": """
+            WITH slots_delete AS (DELETE FROM node_slots WHERE hostname = $1)
+            DELETE FROM nodes WHERE hostname = $1
+        """,
+    }
+
+    def __init__(self, conn_params, max_connections=DB_POOL_MAX):
         self.conn_params = conn_params
+        self.max_connections = max(1, max_connections)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises PoolError instead of waiting when it is exhausted,
+        # so callers wait here for a free connection first
+        self._available = threading.BoundedSemaphore(self.max_connections)
+        self._control = ('idle', None, None)
+
+    def _get_pool(self):
+        """Creates the connection pool on first use."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = pg_pool.ThreadedConnectionPool(
+                    1, self.max_connections, connection_factory=_PreparedConnection, **self.conn_params
+                )
+            return self._pool
 
     def _get_conn(self):
-        return psycopg2.connect(**self.conn_params)
+        """
+        Borrows a long-lived connection from the pool, waiting up to DB_POOL_WAIT_SECONDS for one
+        to become free. Connections that were closed underneath us are discarded and replaced.
+        """
+        if not self._available.acquire(timeout=DB_POOL_WAIT_SECONDS):
+            raise pg_pool.PoolError(f"no free connection within {DB_POOL_WAIT_SECONDS} seconds")
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            if conn.closed:
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+            # Heartbeats are single statements, so autocommit saves a COMMIT round trip.
+            conn.autocommit = True
+            return conn
+        except BaseException:
+            self._available.release()
+            raise
+
+    def _put_conn(self, conn, close=False):
+        """Returns a connection to the pool, closing it if it is broken."""
+        try:
+            if self._pool is not None:
+                self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self._available.release()
+
+    def _execute(self, name, params, fetch=False):
+        """
+        Executes a prepared statement on a pooled connection.
+        If the connection has gone bad (DB restart, network blip), it is dropped and
+        the statement is retried once on a fresh connection.
+        """
+        for attempt in range(2):
+            try:
+                conn = self._get_conn()
+            except (psycopg2.OperationalError, pg_pool.PoolError) as e:
+                if attempt:
+                    raise
+                print(f"[{datetime.now()}] Database connection unavailable ({e}). Retrying...")
+                continue
+            try:
+                with conn.cursor() as cur:
+                    if name not in conn.prepared:
+                        cur.execute(f"PREPARE {name} AS {self.PREPARED_STATEMENTS[name]}")
+                        conn.prepared.add(name)
+                    placeholders = ", ".join(["%s"] * len(params))
+                    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+                    result = cur.fetchone() if fetch else None
+                self._put_conn(conn)
+                return result
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self._put_conn(conn, close=True)
+                if attempt:
+                    raise
+                print(f"[{datetime.now()}] Database connection lost ({e}). Reconnecting...")
+            except Exception:
+                self._put_conn(conn)
+                raise
 
-    def update_heartbeat(self, status, current_file=None, progress=None, fps=None, version_mismatch=False, total_duration=None, job_start_time=None):
+    def check_connection(self):
+        """Health check used at startup. Returns True if the database is reachable."""
+        try:
+            conn = self._get_conn()
+        except psycopg2.Error as e:
+            print(f"[{datetime.now()}] Database Error: Could not connect to PostgreSQL. {e}")
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            self._put_conn(conn)
+            return True
+        except psycopg2.Error as e:
+            self._put_conn(conn, close=True)
+            print(f"[{datetime.now()}] Database Error: Health check failed. {e}")
+            return False
+
+    def close(self):
+        """Closes every pooled connection."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def update_heartbeat(self, status, current_file=None, progress=None, fps=None, version_mismatch=False, total_duration=None, job_start_time=None, speed=None):
         """
         Updates the worker's status in the central database.
         Note: session_token is NOT included in this UPDATE because it's set during registration
         and should persist unchanged across heartbeat updates. The ON CONFLICT DO UPDATE clause
         only modifies the explicitly listed columns, leaving session_token untouched.
         """
-        sql = """
-        INSERT INTO nodes (hostname, last_heartbeat, status, version, current_file, progress, fps, version_mismatch, total_duration, job_start_time)
-        VALUES (%s, NOW(), %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (hostname) DO UPDATE SET
-            last_heartbeat = EXCLUDED.last_heartbeat,
-            status = EXCLUDED.status,
-            version = EXCLUDED.version,
-            current_file = EXCLUDED.current_file,
-            progress = EXCLUDED.progress,
-            fps = EXCLUDED.fps,
-            version_mismatch = EXCLUDED.version_mismatch,
-            total_duration = EXCLUDED.total_duration,
-            job_start_time = EXCLUDED.job_start_time;
+        try:
+            self._execute("heartbeat_upsert", (HOSTNAME, status, VERSION, current_file, progress, fps, version_mismatch, total_duration, job_start_time, speed))
+        except Exception as e:
+            print(f"[{datetime.now()}] Heartbeat Error: Could not update status. {e}")
+
+    def touch_heartbeat(self):
+        """Keeps the node's heartbeat alive without changing its reported status or progress."""
+        try:
+            self._execute("heartbeat_touch", (HOSTNAME,))
+        except Exception as e:
+            print(f"[{datetime.now()}] Heartbeat Error: Could not update status. {e}")
+
+    def get_node_control(self, hostname):
+        """
+        Fetches the command for a specific node together with its slot limit and resource profile
+        from the node options. Returns (command, max_slots, resources); max_slots and resources are
+        None when the dashboard has not set them. While the database is unreachable, the last known
+        values are returned.
         """
-        conn = self._get_conn()
-        if conn:
-            try:
-                with conn.cursor() as cur:
-                    cur.execute(sql, (HOSTNAME, status, VERSION, current_file, progress, fps, version_mismatch, total_duration, job_start_time))
-                conn.commit()
-            except Exception as e:
-                print(f"[{datetime.now()}] Heartbeat Error: Could not update status. {e}")
-            finally:
-                conn.close()
+        try:
+            result = self._execute("node_control", (hostname,), fetch=True)
+        except psycopg2.Error as e:
+            print(f"[{datetime.now()}] Database Error: Could not fetch node command. {e}")
+            return self._control
+        self._control = (result[0], result[1], result[2]) if result else ('idle', None, None)
+        return self._control
 
     def get_node_command(self, hostname):
         """Fetches the status for a specific node, which can act as a command."""
-        conn = self._get_conn()
-        if conn:
+        return self.get_node_control(hostname)[0]
+
+    def update_slot_heartbeat(self, slot, status, job_id=None, current_file=None, progress=None, fps=None, speed=None, total_duration=None, job_start_time=None):
+        """Updates the sub-record of one job slot and keeps the node's own heartbeat alive."""
+        try:
+            self._execute("slot_heartbeat_upsert", (HOSTNAME, slot, status, job_id, current_file, progress, fps, speed, total_duration, job_start_time))
+        except Exception as e:
+            print(f"[{datetime.now()}] Heartbeat Error: Could not update slot {slot} status. {e}")
+
+    def reset_slots(self, slot_count):
+        """Removes slot records above slot_count and writes an idle record for each active slot."""
+        try:
+            self._execute("slots_trim", (HOSTNAME, slot_count if slot_count > 1 else 0))
+        except Exception as e:
+            print(f"[{datetime.now()}] Database Error: Could not reset job slots. {e}")
+            return
+        if slot_count > 1:
+            for slot in range(slot_count):
+                self.update_slot_heartbeat(slot, 'idle')
+
+    def consume_hardware_refresh_request(self):
+        """Returns True (and clears the flag) if the dashboard asked this node to re-probe its hardware."""
+        try:
+            return self._execute("node_hw_refresh", (HOSTNAME,), fetch=True) is not None
+        except Exception as e:
+            print(f"[{datetime.now()}] Database Error: Could not check for hardware refresh request. {e}")
+            return False
+
+    def update_capabilities(self, capabilities):
+        """Stores the hardware capability descriptor for this node."""
+        try:
+            self._execute("node_capabilities", (HOSTNAME, json.dumps(capabilities)))
+        except Exception as e:
+            print(f"[{datetime.now()}] Database Error: Could not update hardware capabilities. {e}")
+
+    def update_device_usage(self, devices):
+        """Stores the active sessions and fps of each GPU used by this node."""
+        try:
+            self._execute("node_devices", (HOSTNAME, json.dumps(devices)))
+        except Exception as e:
+            print(f"[{datetime.now()}] Database Error: Could not update device usage. {e}")
+
+    def clear_node(self):
+        self._execute("node_delete", (HOSTNAME,))
+
+class DashboardStateHandler:
+    """
+    Drop-in replacement for DatabaseHandler that needs no database access (WORKER_STATE_BACKEND=api).
+    Node and slot heartbeats are coalesced in memory, keeping only the newest state of the node and
+    of each slot, and a background thread sends them to the dashboard's /api/worker/heartbeat endpoint
+    as one batch per interval. Every response carries the node's command and options.
+    """
+    def __init__(self, interval=HEARTBEAT_BATCH_INTERVAL):
+        self.interval = max(0.5, interval)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._control = ('idle', None, None)
+        self._hardware_refresh_requested = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _fields(**fields):
+        """Makes heartbeat fields JSON-serializable."""
+        return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in fields.items()}
+
+    def _queue(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="heartbeat-batch", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._pending:
+                self.flush()
+
+    def _restore(self, batch):
+        """Puts a batch that could not be sent back in front of everything queued since."""
+        with self._lock:
+            for key in ('node', 'slot_count', 'capabilities', 'devices', 'touch'):
+                if key in batch and key not in self._pending:
+                    self._pending[key] = batch[key]
+            slot_count = self._pending.get('slot_count')
+            slots = self._pending.setdefault('slots', {})
+            for slot, fields in batch.get('slots', {}).items():
+                if slot not in slots and (slot_count is None or (slot_count > 1 and slot < slot_count)):
+                    slots[slot] = fields
+
+    def flush(self):
+        """Sends everything queued so far in one request. Returns the dashboard's response or None."""
+        with self._send_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            payload = {"hostname": HOSTNAME, "session_token": SESSION_TOKEN}
+            payload.update({key: value for key, value in batch.items() if key not in ('slots', 'touch')})
+            if batch.get('slots'):
+                payload['slots'] = [{"slot": slot, **fields} for slot, fields in sorted(batch['slots'].items())]
             try:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT command FROM nodes WHERE hostname = %s", (hostname,))
-                    result = cur.fetchone()
-                    return result[0] if result else 'idle'
-            finally:
-                conn.close()
-        return 'idle'
+                # Not retried here: a failed batch is merged into the next one
+                response = DASHBOARD.request('POST', "/api/worker/heartbeat", name="worker_heartbeat", retries=0, json=payload, timeout=10)
+                response.raise_for_status()
+                control = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"[{datetime.now()}] Heartbeat Error: Could not send heartbeat to the dashboard. {e}")
+                self._restore(batch)
+                return None
+            with self._lock:
+                self._control = (control.get('command') or 'idle', control.get('max_slots'), control.get('resources'))
+                if control.get('hardware_refresh_requested'):
+                    self._hardware_refresh_requested = True
+            return control
+
+    def check_connection(self):
+        """Health check used at startup. Returns True if the dashboard is reachable."""
+        try:
+            DASHBOARD.request('GET', "/api/health", name="health", timeout=10).raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            print(f"[{datetime.now()}] API Error: Could not reach the dashboard at {DASHBOARD_URL}. {e}")
+            return False
+
+    def close(self):
+        """Sends the last queued heartbeats and stops the batching thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self._pending and SESSION_TOKEN:
+            self.flush()
+
+    def update_heartbeat(self, status, current_file=None, progress=None, fps=None, version_mismatch=False, total_duration=None, job_start_time=None, speed=None):
+        self._queue('node', self._fields(status=status, version=VERSION, current_file=current_file, progress=progress, fps=fps,
+                                         version_mismatch=version_mismatch, total_duration=total_duration, job_start_time=job_start_time, speed=speed))
+
+    def touch_heartbeat(self):
+        self._queue('touch', True)
+
+    def get_node_control(self, hostname):
+        """Sends the queued heartbeats and returns (command, max_slots, resources) from the response, or the last known values."""
+        self.flush()
+        with self._lock:
+            return self._control
+
+    def get_node_command(self, hostname):
+        return self.get_node_control(hostname)[0]
+
+    def update_slot_heartbeat(self, slot, status, job_id=None, current_file=None, progress=None, fps=None, speed=None, total_duration=None, job_start_time=None):
+        fields = self._fields(status=status, job_id=job_id, current_file=current_file, progress=progress, fps=fps,
+                              speed=speed, total_duration=total_duration, job_start_time=job_start_time)
+        with self._lock:
+            self._pending.setdefault('slots', {})[slot] = fields
+        self._queue('touch', True)
+
+    def reset_slots(self, slot_count):
+        with self._lock:
+            slots = self._pending.get('slots', {})
+            for slot in [slot for slot in slots if slot_count <= 1 or slot >= slot_count]:
+                del slots[slot]
+        self._queue('slot_count', slot_count)
+        if slot_count > 1:
+            for slot in range(slot_count):
+                self.update_slot_heartbeat(slot, 'idle')
+
+    def consume_hardware_refresh_request(self):
+        """Returns True (once) if a heartbeat response asked this node to re-probe its hardware."""
+        with self._lock:
+            requested, self._hardware_refresh_requested = self._hardware_refresh_requested, False
+            return requested
+
+    def update_capabilities(self, capabilities):
+        self._queue('capabilities', capabilities)
+
+    def update_device_usage(self, devices):
+        self._queue('devices', devices)
 
     def clear_node(self):
-        conn = self._get_conn()
-        if conn:
+        """Removes this node from the dashboard right away; anything still queued is dropped."""
+        self._stop.set()
+        with self._lock:
+            self._pending = {}
+        if not SESSION_TOKEN:
+            return
+        try:
+            DASHBOARD.request('POST', "/api/worker/heartbeat", name="worker_heartbeat", json={"hostname": HOSTNAME, "session_token": SESSION_TOKEN, "clear": True}, timeout=10)
+        except requests.exceptions.RequestException as e:
+            print(f"[{datetime.now()}] API Error: Could not remove this node from the dashboard. {e}")
+
+class SlotDatabaseHandler:
+    """
+    Routes the heartbeats of a job running in one slot of a multi-slot worker to that
+    slot's sub-record. Every other call is passed through to the node's DatabaseHandler.
+    """
+    def __init__(self, db, slot, job_id):
+        self.db = db
+        self.slot = slot
+        self.job_id = job_id
+
+    def update_heartbeat(self, status, current_file=None, progress=None, fps=None, version_mismatch=False, total_duration=None, job_start_time=None, speed=None):
+        self.db.update_slot_heartbeat(self.slot, status, job_id=self.job_id, current_file=current_file, progress=progress,
+                                      fps=fps, speed=speed, total_duration=total_duration, job_start_time=job_start_time)
+
+    def mark_idle(self):
+        self.db.update_slot_heartbeat(self.slot, 'idle')
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+# ===========================
+# Progress Reporting
+# ===========================
+
+class ProgressReporter:
+    """
+    Writes encode progress heartbeats from a background thread.
+    The ffmpeg read loop only drops samples onto a queue and never waits on the database.
+    The reporter keeps the newest sample, writes at most one heartbeat per interval,
+    and always flushes the last state when stopped.
+    """
+    _STOP = object()
+
+    def __init__(self, db, interval=PROGRESS_REPORT_INTERVAL, max_queue=256):
+        self.db = db
+        self.interval = max(0.0, interval)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"submitted": 0, "written": 0, "coalesced": 0, "dropped": 0}
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    @property
+    def stats(self):
+        """Returns a snapshot of the reporter counters."""
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _put(self, item):
+        """Queues an item without blocking. When the queue is full the oldest sample is dropped."""
+        while True:
             try:
-                with conn.cursor() as cur:
-                    cur.execute("DELETE FROM nodes WHERE hostname = %s", (HOSTNAME,))
-                conn.commit()
-            finally:
-                conn.close()
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self._count("dropped")
+                except queue.Empty:
+                    pass
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, status, **fields):
+        """Queues a heartbeat sample. Accepts the same keyword arguments as update_heartbeat."""
+        self._count("submitted")
+        self._put((status, fields))
+
+    def stop(self, timeout=10):
+        """Flushes the last pending sample and stops the reporter thread."""
+        if self._thread is None:
+            return
+        self._put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        stats = self.stats
+        print(f"[{datetime.now()}] Progress reporter: {stats['submitted']} samples, {stats['written']} written, "
+              f"{stats['coalesced']} coalesced, {stats['dropped']} dropped.")
+
+    def _write(self, sample):
+        status, fields = sample
+        self.db.update_heartbeat(status, **fields)
+        self._count("written")
+
+    def _run(self):
+        pending = None
+        last_write = 0.0
+        while True:
+            # With nothing pending we can block until the next sample arrives.
+            # Otherwise only wait until the current interval has elapsed.
+            timeout = None if pending is None else max(0.0, self.interval - (time.monotonic() - last_write))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                if pending is not None:
+                    self._write(pending)
+                return
+            if item is not None:
+                if pending is not None:
+                    self._count("coalesced")
+                pending = item
+
+            if pending is not None and time.monotonic() - last_write >= self.interval:
+                self._write(pending)
+                pending = None
+                last_write = time.monotonic()
+
+# ===========================
+# FFmpeg Output Parsing
+# ===========================
+
+@dataclass
+class FFmpegProgress:
+    """One progress block emitted by `ffmpeg -progress`."""
+    frame: int = 0
+    fps: float = 0.0
+    bitrate_kbps: Optional[float] = None
+    total_size: Optional[int] = None
+    out_time_seconds: Optional[float] = None
+    speed: Optional[float] = None
+    finished: bool = False
+
+def _parse_float(value, suffix=""):
+    """Parses ffmpeg numeric values such as '1.25x' or '2450.3kbits/s'. Returns None for 'N/A'."""
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+class FFmpegProgressParser:
+    """
+    Parses the key=value stream written by `ffmpeg -progress pipe:1 -nostats`.
+    Each block ends with a `progress=continue` or `progress=end` line.
+    """
+    def __init__(self):
+        self._fields = {}
+
+    def feed(self, line):
+        """Consumes one line. Returns an FFmpegProgress when a block is complete, otherwise None."""
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return None
+        if key != "progress":
+            self._fields[key] = value.strip()
+            return None
+
+        fields, self._fields = self._fields, {}
+        out_time_us = _parse_float(fields.get("out_time_us", "N/A"))
+        total_size = _parse_float(fields.get("total_size", "N/A"))
+        return FFmpegProgress(
+            frame=int(_parse_float(fields.get("frame", "0")) or 0),
+            fps=_parse_float(fields.get("fps", "0")) or 0.0,
+            bitrate_kbps=_parse_float(fields.get("bitrate", "N/A"), "kbits/s"),
+            total_size=int(total_size) if total_size is not None else None,
+            out_time_seconds=out_time_us / 1_000_000 if out_time_us is not None and out_time_us >= 0 else None,
+            speed=_parse_float(fields.get("speed", "N/A").strip(), "x"),
+            finished=value.strip() == "end",
+        )
+
+class FFmpegLogCapture:
+    """
+    Reads ffmpeg's human-readable stderr on a background thread into a fixed-size ring buffer.
+    The first `head_lines` lines (input info, stream mapping, early errors) and the last
+    `tail_lines` lines are kept; everything in between is only counted. A SHA-256 checksum and
+    byte count of the full log are tracked, and the full log can optionally be spilled to a
+    gzip file in `spill_dir`.
+    Also picks up the input duration from the log as a fallback when ffprobe could not provide it.
+    """
+    DURATION_PATTERN = re.compile(r'Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)')
+
+    def __init__(self, stream, head_lines=FFMPEG_LOG_HEAD_LINES, tail_lines=FFMPEG_LOG_TAIL_LINES, spill_dir=FFMPEG_LOG_SPILL_DIR, name="ffmpeg"):
+        self.stream = stream
+        self.head_lines = max(0, head_lines)
+        self.head = []
+        self.tail = deque(maxlen=max(1, tail_lines))
+        self.total_lines = 0
+        self.total_bytes = 0
+        self.duration = None
+        self.spill_path = None
+        self._checksum = hashlib.sha256()
+        self._spill = None
+        if spill_dir:
+            try:
+                os.makedirs(spill_dir, exist_ok=True)
+                safe_name = re.sub(r'[^A-Za-z0-9._-]', '_', name)[:100]
+                fd, self.spill_path = tempfile.mkstemp(prefix=f"{safe_name}_", suffix=".log.gz", dir=spill_dir)
+                self._spill = gzip.open(os.fdopen(fd, "wb"), "wt", encoding="utf-8")
+            except OSError as e:
+                print(f"⚠️ Could not create ffmpeg log spill file in {spill_dir}: {e}")
+                self.spill_path = None
+        self._thread = threading.Thread(target=self._run, name="ffmpeg-log", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for line in self.stream:
+                self.total_lines += 1
+                encoded = line.encode("utf-8", errors="replace")
+                self.total_bytes += len(encoded)
+                self._checksum.update(encoded)
+                if self._spill is not None:
+                    self._spill.write(line)
+                if len(self.head) < self.head_lines:
+                    self.head.append(line)
+                else:
+                    self.tail.append(line)
+                if self.duration is None and "Duration:" in line:
+                    match = self.DURATION_PATTERN.search(line)
+                    if match:
+                        h, m, s = match.groups()
+                        self.duration = int(h) * 3600 + int(m) * 60 + float(s)
+        finally:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+    def join(self, timeout=10):
+        self._thread.join(timeout)
+
+    @property
+    def checksum(self):
+        return self._checksum.hexdigest()
+
+    def text(self):
+        """Returns the trimmed log excerpt: the head, an omission marker, and the tail."""
+        omitted = self.total_lines - len(self.head) - len(self.tail)
+        parts = list(self.head)
+        if omitted > 0:
+            parts.append(f"\n... [{omitted} lines omitted] ...\n\n")
+        parts.extend(self.tail)
+        return "".join(parts)
+
+    def details(self):
+        """Returns the log fields sent to the dashboard for a failed job."""
+        details = {"log": self.text(), "log_size": self.total_bytes, "log_checksum": self.checksum}
+        if self.spill_path:
+            details["log_file"] = self.spill_path
+        return details
+
+    def discard_spill(self):
+        """Removes the spilled full log. Called when the encode succeeded and the log is not needed."""
+        if self.spill_path:
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+            self.spill_path = None
+
+# ===========================
+# Scratch Staging
+# ===========================
+
+class StagedJob:
+    """A job's source copied to local scratch space, plus the local path ffmpeg writes to."""
+    def __init__(self, scratch, job_id, source_path, work_dir, reserved_bytes):
+        self.scratch = scratch
+        self.job_id = job_id
+        self.source_path = Path(source_path)
+        self.work_dir = work_dir
+        self.local_source = work_dir / self.source_path.name
+        self.local_output = work_dir / f"tmp_{self.source_path.name}"
+        self.reserved_bytes = reserved_bytes
+
+    def cleanup(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.scratch.release(self.reserved_bytes)
+
+def _copy_sequential(source, destination, progress=None):
+    """Copies a file with large sequential reads and writes. progress(copied_bytes, total_bytes) is called after every chunk."""
+    total = os.path.getsize(source)
+    copied = 0
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        while True:
+            chunk = fsrc.read(SCRATCH_COPY_CHUNK_BYTES)
+            if not chunk:
+                break
+            fdst.write(chunk)
+            copied += len(chunk)
+            if progress:
+                progress(copied, total)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+
+class ScratchSpace:
+    """
+    Local scratch directory for staging network-mounted media. Each staged job reserves room
+    for its source and its encode (at most the size of the source) against the budget.
+    """
+    def __init__(self, directory, budget_bytes=0):
+        self.directory = Path(directory) if directory else None
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._reserved = 0
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def purge(self, keep=()):
+        """Removes job directories left behind by a previous run of this worker, except those in keep."""
+        if not self.enabled or not self.directory.is_dir():
+            return
+        keep = {Path(directory) for directory in keep}
+        for stale in self.directory.glob("job-*"):
+            if stale in keep:
+                print(f"[{datetime.now()}] Keeping scratch directory of an unfinished finalize: {stale}")
+                continue
+            print(f"[{datetime.now()}] Removing stale scratch directory: {stale}")
+            shutil.rmtree(stale, ignore_errors=True)
+
+    def reserve(self, nbytes):
+        with self._lock:
+            if self.budget_bytes and self._reserved + nbytes > self.budget_bytes:
+                return False
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if shutil.disk_usage(self.directory).free - self._reserved < nbytes:
+                return False
+            self._reserved += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self._lock:
+            self._reserved = max(0, self._reserved - nbytes)
+
+    def stage(self, job_id, source_path, progress=None):
+        """
+        Copies a source file to scratch space. Returns a StagedJob, or None if staging is
+        disabled, the budget is exhausted or the copy fails (the job then encodes from the share).
+        progress(copied_bytes, total_bytes) is called during the copy (see staging_progress).
+        """
+        if not self.enabled:
+            return None
+        try:
+            source_size = os.path.getsize(source_path)
+        except OSError:
+            return None
+        reserved_bytes = source_size * 2
+        if not self.reserve(reserved_bytes):
+            print(f"[{datetime.now()}] Not enough scratch space to stage job {job_id}, encoding from the share.")
+            return None
+
+        staged = StagedJob(self, job_id, source_path, self.directory / f"job-{job_id}", reserved_bytes)
+        try:
+            staged.work_dir.mkdir(parents=True, exist_ok=True)
+            print(f"[{datetime.now()}] Staging source to scratch: {staged.local_source}")
+            start = time.monotonic()
+            _copy_sequential(source_path, staged.local_source, progress)
+            elapsed = max(time.monotonic() - start, 0.001)
+            print(f"[{datetime.now()}] Staged {source_size / 1024**2:.0f} MB in {elapsed:.1f}s ({source_size / 1024**2 / elapsed:.0f} MB/s)")
+            return staged
+        except OSError as e:
+            print(f"[{datetime.now()}] ⚠️ Could not stage job {job_id} to scratch, encoding from the share. Error: {e}")
+            staged.cleanup()
+            return None
+
+SCRATCH_SPACE = ScratchSpace(SCRATCH_DIR, int(SCRATCH_BUDGET_GB * 1024**3))
+
+def staging_progress(source_path, db=None):
+    """
+    Returns a progress callback for staging a source: it logs every 10% and, with db, shows the copy
+    as the slot's progress (at most every PROGRESS_REPORT_INTERVAL seconds), so the node is not idle meanwhile.
+    """
+    name = os.path.basename(source_path)
+    logged_step = -1
+    last_report = 0.0
+
+    def report(copied, total):
+        nonlocal logged_step, last_report
+        percent = int(copied * 100 / total) if total else 100
+        if percent // 10 > logged_step:
+            logged_step = percent // 10
+            print(f"[{datetime.now()}]   -> Staging {name}: {percent}%")
+        if db is not None and time.monotonic() - last_report >= PROGRESS_REPORT_INTERVAL:
+            last_report = time.monotonic()
+            db.update_heartbeat('staging', current_file=f"Staging {name}", progress=percent)
+    return report
 
 # ===========================
 # Hardware Configuration
 # ===========================
 
-def get_hw_config(mode, device_path="/dev/dri/renderD128"):
+# Encoder profiles for each codec family and acceleration mode: the ffmpeg encoder, its quality flag,
+# the encoder preset of each speed tier and how the dashboard's CQ settings (on the HEVC scale) map to
+# the encoder's own quality scale: cq * scale + offset, capped at max.
+SPEED_TIERS = ("fast", "balanced", "quality")
+ENCODER_PROFILES = {
+    "hevc": {
+        "nvidia": {"codec": "hevc_nvenc", "cq_flag": "-cq", "presets": {"fast": "p1", "balanced": "p3", "quality": "p6"}, "extra": ["-rc", "vbr"]},
+        "qsv": {"codec": "hevc_qsv", "cq_flag": "-global_quality", "presets": {"fast": "veryfast", "balanced": "medium", "quality": "slower"}},
+        "vaapi": {"codec": "hevc_vaapi", "cq_flag": "-global_quality", "presets": None},
+        "cpu": {"codec": "libx265", "cq_flag": "-crf", "presets": {"fast": "veryfast", "balanced": "medium", "quality": "slow"}},
+    },
+    "av1": {
+        "nvidia": {"codec": "av1_nvenc", "cq_flag": "-cq", "presets": {"fast": "p2", "balanced": "p4", "quality": "p6"}, "extra": ["-rc", "vbr"], "cq_map": (1, 2, 51)},
+        "qsv": {"codec": "av1_qsv", "cq_flag": "-global_quality", "presets": {"fast": "veryfast", "balanced": "medium", "quality": "slower"}, "cq_map": (1, 2, 51)},
+        # VAAPI AV1 has no quality-based rate control, so it runs in constant QP on AV1's 0-255 qindex scale
+        "vaapi": {"codec": "av1_vaapi", "cq_flag": "-qp", "presets": None, "extra": ["-rc_mode", "CQP"], "cq_map": (4, 8, 255)},
+        "cpu": {"codec": "libsvtav1", "cq_flag": "-crf", "presets": {"fast": "10", "balanced": "8", "quality": "5"}, "cq_map": (1, 6, 63)},
+    },
+}
+# The dashboard's CQ settings are named after the encoder family: nvenc_cq_hd, vaapi_cq_hd, cpu_cq_hd
+CQ_SETTINGS = {"nvidia": "nvenc", "qsv": "vaapi", "vaapi": "vaapi", "cpu": "cpu"}
+
+def get_hw_config(mode, device_path="/dev/dri/renderD128", cuda_device=None, family="hevc", tier="balanced"):
+    if mode not in ("nvidia", "qsv", "vaapi"):
+        mode = "cpu"
+    if family not in ENCODER_PROFILES:
+        family = "hevc"
+    if tier not in SPEED_TIERS:
+        tier = "balanced"
+    profile = ENCODER_PROFILES[family][mode]
+    hw_config = {
+        "mode": mode, "family": family, "tier": tier, "codec": profile["codec"],
+        "preset": profile["presets"][tier] if profile["presets"] else None,
+        "cq_flag": profile["cq_flag"], "cq_setting": CQ_SETTINGS[mode], "cq_map": profile.get("cq_map", (1, 0, 51)),
+        "extra": list(profile.get("extra", [])), "device": None,
+    }
     if mode == "nvidia":
-        return {
-            "type": "nvidia", "codec": "hevc_nvenc", "hw_pre_args": ["-hwaccel", "cuda"], 
-            "preset": "p3", "cq_flag": "-cq", "extra": ["-rc", "vbr"]
-        }
+        # Decoded frames stay in GPU memory and go straight to NVENC (see hw_config_for_source)
+        hw_config.update({"type": "nvidia", "hw_pre_args": ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"]})
+        if cuda_device is not None:
+            hw_config["hw_pre_args"] += ["-hwaccel_device", str(cuda_device)]
+            hw_config["extra"] += ["-gpu", str(cuda_device)]
+            hw_config["device"] = f"cuda:{cuda_device}"
     elif mode == "qsv":
-        return {
-            "type": "intel", "codec": "hevc_qsv", 
-            "hw_pre_args": ["-init_hw_device", f"qsv=hw,child_device={device_path}", "-hwaccel", "qsv", "-hwaccel_output_format", "qsv"], 
-            "preset": "medium", "cq_flag": "-global_quality", "extra": [] 
-        }
+        hw_config.update({
+            "type": "intel", "device": device_path,
+            "hw_pre_args": ["-init_hw_device", f"qsv=hw,child_device={device_path}", "-hwaccel", "qsv", "-hwaccel_output_format", "qsv"],
+        })
     elif mode == "vaapi":
-        return {
-            "type": "intel", "codec": "hevc_vaapi", 
-            "hw_pre_args": ["-vaapi_device", device_path, "-hwaccel", "vaapi", "-hwaccel_output_format", "vaapi"], 
-            "preset": None, "cq_flag": "-global_quality", "extra": []
-        }
-    else: 
-        return {"type": "cpu", "codec": "libx265", "hw_pre_args": [], "preset": "medium", "cq_flag": "-crf", "extra": []}
+        hw_config.update({
+            "type": "intel", "device": device_path,
+            "hw_pre_args": ["-vaapi_device", device_path, "-hwaccel", "vaapi", "-hwaccel_output_format", "vaapi"],
+        })
+    else:
+        hw_config.update({"type": "cpu", "hw_pre_args": []})
+    return hw_config
+
+def encoder_works(hw_config):
+    """Encodes a single blank frame to confirm the hardware behind hw_config supports its encoder."""
+    ffmpeg_cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    if hw_config["mode"] == "vaapi":
+        ffmpeg_cmd.extend(["-vaapi_device", hw_config["device"]])
+    ffmpeg_cmd.extend(["-f", "lavfi", "-i", "color=black:size=640x360:duration=0.1"])
+    ffmpeg_cmd.extend(["-vf", "format=nv12,hwupload" if hw_config["mode"] == "vaapi" else "format=nv12"])
+    ffmpeg_cmd.extend(["-frames:v", "1", "-c:v", hw_config["codec"], "-f", "null", "-"])
+    try:
+        return subprocess.run(ffmpeg_cmd, capture_output=True, timeout=60).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+# Pixel formats NVDEC can decode for each codec. H.264 and the older codecs are 8-bit 4:2:0 only.
+NVDEC_PIX_FMTS = {
+    "h264": {"yuv420p", "yuvj420p", "nv12"},
+    "hevc": {"yuv420p", "yuvj420p", "nv12", "yuv420p10le", "p010le", "yuv420p12le"},
+    "vp9": {"yuv420p", "yuvj420p", "yuv420p10le", "yuv420p12le"},
+    "av1": {"yuv420p", "yuv420p10le"},
+}
+NVDEC_DEFAULT_PIX_FMTS = {"yuv420p", "yuvj420p"}
 
-def detect_hardware_settings(accel_mode):
-    if accel_mode == "nvidia": return get_hw_config("nvidia")
-    if accel_mode == "qsv": return get_hw_config("qsv")
-    if accel_mode == "vaapi": return get_hw_config("vaapi")
-    if accel_mode == "cpu": return get_hw_config("cpu")
+def hw_config_for_source(hw_config, descriptor):
+    """
+    Adapts the decode side of hw_config to the probed source. NVIDIA encodes keep the frames on
+    the GPU from NVDEC to NVENC, which only works when NVDEC can decode the source; other sources
+    are decoded into system memory and uploaded by hevc_nvenc itself.
+    """
+    if hw_config["type"] != "nvidia":
+        return hw_config
+    codec = (descriptor or {}).get('codec')
+    pix_fmt = (descriptor or {}).get('pix_fmt')
+    if codec in NVDEC_CODECS and (not pix_fmt or pix_fmt in NVDEC_PIX_FMTS.get(codec, NVDEC_DEFAULT_PIX_FMTS)):
+        return hw_config
+    print(f"[{datetime.now()}] ℹ️ NVDEC cannot decode {codec or 'unknown codec'} ({pix_fmt or 'unknown pixel format'}), decoding on the CPU.")
+    return {**hw_config, "hw_pre_args": []}
 
+# Hardware probing spawns several ffmpeg processes, so the results are cached for the
+# lifetime of the worker and only refreshed when the acceleration mode changes or on request.
+_hw_lock = threading.Lock()
+_hw_capabilities = None
+_hw_capabilities_mode = None
+
+def probe_hardware_capabilities():
+    """
+    Probes ffmpeg and the host for hardware encoding support.
+    Returns a capability descriptor: the hwaccels and video encoders ffmpeg was built with,
+    and the GPU devices visible to this worker.
+    """
     print("🔍 Probing Hardware...", end=" ", flush=True)
+    capabilities = {
+        "ffmpeg": False,
+        "hwaccels": [],
+        "encoders": [],
+        "devices": {
+            "render_nodes": sorted(glob.glob("/dev/dri/renderD*")),
+            # The presence of nvidia-smi is a strong indicator of an actual NVIDIA GPU.
+            "nvidia": shutil.which("nvidia-smi") is not None,
+            "cuda": [],
+        },
+        "probed_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+    if capabilities["devices"]["nvidia"]:
+        # One name per CUDA device, in device index order (CUDA_DEVICE_ORDER=PCI_BUS_ID is set at the
+        # top of this module, so ffmpeg numbers the devices the same way nvidia-smi does)
+        try:
+            gpu_out = subprocess.check_output(["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"], text=True, stderr=subprocess.STDOUT, timeout=30)
+            capabilities["devices"]["cuda"] = [line.strip() for line in gpu_out.splitlines() if line.strip()]
+        except (OSError, subprocess.SubprocessError):
+            pass
 
     # --- Universal FFmpeg Capability Check ---
     try:
-        # Run these once to avoid multiple subprocess calls
         hw_out = subprocess.check_output(["ffmpeg", "-hide_banner", "-hwaccels"], text=True, stderr=subprocess.STDOUT)
         enc_out = subprocess.check_output(["ffmpeg", "-hide_banner", "-encoders"], text=True, stderr=subprocess.STDOUT)
     except (FileNotFoundError, subprocess.CalledProcessError):
         # If ffmpeg isn't found or fails, we can only use CPU
         print("⚠️ FFmpeg not found or failed, falling back to CPU.")
-        return get_hw_config("cpu")
+        return capabilities
+
+    capabilities["ffmpeg"] = True
+    # The first line of `-hwaccels` is a "Hardware acceleration methods:" header.
+    capabilities["hwaccels"] = [line.strip() for line in hw_out.splitlines()[1:] if line.strip()]
+    # Encoder lines look like " V....D libx265  libx265 H.265 / HEVC"; keep the video encoders.
+    for line in enc_out.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0].startswith("V") and parts[1] != "=":
+            capabilities["encoders"].append(parts[1])
+    # Hardware AV1 encoding depends on the GPU generation, not just on the ffmpeg build, so the
+    # listed hardware AV1 encoders are only used once a test encode succeeds
+    capabilities["av1_encoders"] = [ENCODER_PROFILES["av1"]["cpu"]["codec"]] if ENCODER_PROFILES["av1"]["cpu"]["codec"] in capabilities["encoders"] else []
+    render_node = (capabilities["devices"]["render_nodes"] or ["/dev/dri/renderD128"])[0]
+    for mode in ("nvidia", "qsv", "vaapi"):
+        hw_config = get_hw_config(mode, render_node, family="av1")
+        if hw_config["codec"] in capabilities["encoders"] and encoder_works(hw_config):
+            capabilities["av1_encoders"].append(hw_config["codec"])
+
+    print(f"✅ {len(capabilities['hwaccels'])} hwaccels, {len(capabilities['encoders'])} video encoders, "
+          f"{len(capabilities['devices']['render_nodes'])} render nodes, NVIDIA: {len(capabilities['devices']['cuda']) if capabilities['devices']['nvidia'] else 'no'}")
+    return capabilities
+
+def get_hardware_capabilities(refresh=False):
+    """Returns the cached capability descriptor, probing the hardware on first use or when refresh is True."""
+    global _hw_capabilities
+    with _hw_lock:
+        if _hw_capabilities is None or refresh:
+            _hw_capabilities = probe_hardware_capabilities()
+        return _hw_capabilities
+
+def detect_hardware_settings(accel_mode, refresh=False, db=None, family="hevc", tier="balanced"):
+    """
+    Returns the hw_config for the requested acceleration mode, codec family and speed tier.
+    In 'auto' mode the choice is made from the cached capability descriptor. The hardware is
+    re-probed when the mode changes (or refresh is True), and the new descriptor is reported
+    to the dashboard if a db handler is given.
+    """
+    global _hw_capabilities_mode
+    with _hw_lock:
+        mode_changed = _hw_capabilities_mode is not None and _hw_capabilities_mode != accel_mode
+        _hw_capabilities_mode = accel_mode
+
+    if accel_mode in ("nvidia", "qsv", "vaapi", "cpu"):
+        return get_hw_config(accel_mode, family=family, tier=tier)
+
+    refresh = refresh or mode_changed
+    capabilities = get_hardware_capabilities(refresh)
+    if refresh and db is not None:
+        db.update_capabilities(capabilities)
+    hwaccels = capabilities["hwaccels"]
+    # AV1 encoders are only used once a test encode succeeded (see probe_hardware_capabilities)
+    encoders = capabilities.get("av1_encoders", []) if family == "av1" else capabilities["encoders"]
 
     # --- Check 1: NVIDIA (Priority) ---
     # This is the most reliable check for Linux, Docker, and WSL with NVIDIA drivers.
-    # It checks if ffmpeg was compiled with CUDA support and can see the nvenc encoder.
-    # We also check for `nvidia-smi` to confirm that hardware is actually present.
-    if "cuda" in hw_out and "hevc_nvenc" in enc_out:
-        try:
-            # The presence of nvidia-smi is a strong indicator of an actual NVIDIA GPU.
-            subprocess.check_output(["which", "nvidia-smi"], stderr=subprocess.STDOUT)
-            print("✅ Found NVIDIA")
-            return get_hw_config("nvidia")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            # nvidia-smi not found, so it's not a real NVIDIA system.
-            pass
+    # It checks if ffmpeg was compiled with CUDA support and can see the nvenc encoder,
+    # and that nvidia-smi is present to confirm that hardware is actually present.
+    if "cuda" in hwaccels and get_hw_config("nvidia", family=family)["codec"] in encoders and capabilities["devices"]["nvidia"]:
+        return get_hw_config("nvidia", family=family, tier=tier)
 
     # --- Check 2: VAAPI (Intel/AMD on Linux) ---
-    if "vaapi" in hw_out and "hevc_vaapi" in enc_out and sys.platform.startswith('linux'):
-        print("✅ Found VAAPI")
-        return get_hw_config("vaapi")
-        
-    return get_hw_config("cpu")
+    if "vaapi" in hwaccels and get_hw_config("vaapi", family=family)["codec"] in encoders and sys.platform.startswith('linux'):
+        return get_hw_config("vaapi", family=family, tier=tier)
+
+    if family == "av1" and get_hw_config("cpu", family=family)["codec"] not in encoders:
+        print(f"[{datetime.now()}] ⚠️ No AV1 encoder available on this node, encoding HEVC instead.")
+        return get_hw_config("cpu", tier=tier)
+    return get_hw_config("cpu", family=family, tier=tier)
+
+def encoder_settings(settings, db=None):
+    """Returns the hw_config selected by the dashboard's acceleration, codec family and speed tier settings."""
+    return detect_hardware_settings(
+        settings.get('hardware_acceleration', 'auto'), db=db,
+        family=settings.get('codec_family', 'hevc'), tier=settings.get('speed_tier', 'balanced')
+    )
+
+class GpuDevices:
+    """
+    Spreads the encodes of all job slots over the GPUs of this node. Each encode leases the device
+    with the fewest active sessions: a CUDA device for NVENC, a DRM render node for QSV and VAAPI.
+    Leases are keyed by the slot thread that runs the encode, and carry the encode's current fps
+    so the per-device usage can be reported to the dashboard.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._names = {}
+
+    @staticmethod
+    def _devices(mode):
+        """Returns (device, name) for every device this node has for the acceleration mode."""
+        devices = get_hardware_capabilities()["devices"]
+        if mode == "nvidia":
+            return [(f"cuda:{index}", f"GPU {index} ({name})") for index, name in enumerate(devices.get("cuda", []))]
+        if mode in ("qsv", "vaapi"):
+            return [(path, os.path.basename(path)) for path in devices.get("render_nodes", [])]
+        return []
+
+    def acquire(self, hw_config):
+        """
+        Leases the least-loaded device for the calling slot's encode and returns hw_config bound
+        to it. hw_config is returned unchanged for CPU encodes or if no device was enumerated.
+        """
+        self.release()
+        devices = self._devices(hw_config.get("mode"))
+        if not devices:
+            return hw_config
+        with self._lock:
+            sessions = Counter(device for device, _ in self._leases.values())
+            device, name = min(devices, key=lambda candidate: sessions[candidate[0]])
+            self._leases[threading.get_ident()] = [device, 0.0]
+            self._names[device] = name
+        if hw_config["mode"] == "nvidia":
+            return get_hw_config("nvidia", cuda_device=int(device.split(":")[1]), family=hw_config["family"], tier=hw_config["tier"])
+        return get_hw_config(hw_config["mode"], device, family=hw_config["family"], tier=hw_config["tier"])
+
+    def update_fps(self, fps):
+        with self._lock:
+            lease = self._leases.get(threading.get_ident())
+            if lease:
+                lease[1] = fps or 0.0
+
+    def release(self):
+        with self._lock:
+            self._leases.pop(threading.get_ident(), None)
+
+    def usage(self):
+        """Returns the active sessions and total fps of every device leased so far."""
+        with self._lock:
+            usage = {device: {"device": device, "name": name, "sessions": 0, "fps": 0.0} for device, name in self._names.items()}
+            for device, fps in self._leases.values():
+                usage[device]["sessions"] += 1
+                usage[device]["fps"] += fps
+        return [{**entry, "fps": round(entry["fps"], 1)} for entry in usage.values()]
+
+GPU_DEVICES = GpuDevices()
 
 # ===========================
 # Worker Logic
@@ -237,18 +1338,20 @@ def register_with_dashboard():
         SESSION_TOKEN = generate_session_token()
     
     try:
-        headers = {'X-API-Key': API_KEY} if API_KEY else {}
         payload = {
             "hostname": HOSTNAME,
             "session_token": SESSION_TOKEN,
-            "version": VERSION
+            "version": VERSION,
+            "capabilities": get_hardware_capabilities(),
+            # Jobs whose results are still in the local spool finished here and must not be re-queued
+            "pending_results": RESULT_SPOOL.pending_jobs() + FINALIZE_JOURNAL.pending_jobs()
         }
         
         print(f"[{datetime.now()}] Registering with dashboard as '{HOSTNAME}'...")
-        response = requests.post(
-            f"{DASHBOARD_URL}/api/register_worker",
+        response = DASHBOARD.request(
+            'POST', "/api/register_worker",
+            name="register_worker",
             json=payload,
-            headers=headers,
             timeout=10
         )
         
@@ -280,16 +1383,40 @@ def register_with_dashboard():
             print("    Example: DASHBOARD_URL=http://<dashboard_ip>:5000")
         return False
 
+# The last settings snapshot received from the dashboard. It is revalidated with its ETag,
+# and not fetched at all when a job arrives with the same settings version.
+_settings_lock = threading.Lock()
+_settings_snapshot = {"etag": None, "version": None, "settings": {}, "dashboard_version": None}
+
+def settings_snapshot_is_current(settings_version):
+    """Returns True if the local settings snapshot has the given settings version."""
+    with _settings_lock:
+        return settings_version is not None and _settings_snapshot['version'] == settings_version
+
 def get_dashboard_settings():
     """Fetches all worker settings from the dashboard's API."""
     try:
-        headers = {'X-API-Key': API_KEY} if API_KEY else {}
+        headers = {}
+        with _settings_lock:
+            if _settings_snapshot['etag']:
+                headers['If-None-Match'] = _settings_snapshot['etag']
         params = {"hostname": HOSTNAME, "session_token": SESSION_TOKEN} if SESSION_TOKEN else {}
-        response = requests.get(f"{DASHBOARD_URL}/api/settings", headers=headers, params=params, timeout=10)
+        response = DASHBOARD.request('GET', "/api/settings", name="settings", headers=headers, params=params, timeout=10)
+        if response.status_code == 304:
+            # Nothing changed since the last fetch
+            with _settings_lock:
+                return dict(_settings_snapshot['settings']), _settings_snapshot['dashboard_version']
         response.raise_for_status()
         data = response.json()
         settings_data = data.get('settings', {})
         dashboard_version = data.get('dashboard_version')
+        with _settings_lock:
+            _settings_snapshot.update({
+                "etag": response.headers.get('ETag'),
+                "version": data.get('settings_version'),
+                "settings": dict(settings_data),
+                "dashboard_version": dashboard_version,
+            })
         # The /api/settings endpoint now returns a flattened dictionary,
         # so we can return it directly.
         return settings_data, dashboard_version
@@ -300,21 +1427,33 @@ def get_dashboard_settings():
             print("    If running the worker on a different machine, set the DASHBOARD_URL environment variable. Example: DASHBOARD_URL=http://<dashboard_ip>:5000 ./transcode.py")
         return {}, None
 
-def request_job_from_dashboard():
-    """Requests a new job from the dashboard's API."""
+def request_job_from_dashboard(leased_job_id=None, lease_seconds=0, wait_seconds=0):
+    """
+    Requests a new job from the dashboard's API.
+    With lease_seconds, the job is only reserved for this worker; passing its id back as
+    leased_job_id starts it (or claims the next pending job if the lease has expired).
+    With wait_seconds, the dashboard holds the request open until a job arrives (long-poll).
+    """
     if not SESSION_TOKEN:
         print(f"[{datetime.now()}] ERROR: Cannot request job - worker is not registered")
         return None
     
     try:
-        print(f"[{datetime.now()}] Requesting a new job...")
-        headers = {'X-API-Key': API_KEY} if API_KEY else {}
+        print(f"[{datetime.now()}] {'Leasing the next' if lease_seconds else 'Requesting a new'} job...")
         payload = {"hostname": HOSTNAME, "session_token": SESSION_TOKEN}
-        response = requests.post(f"{DASHBOARD_URL}/api/request_job", json=payload, headers=headers, timeout=10)
+        if leased_job_id:
+            payload["leased_job_id"] = leased_job_id
+        if lease_seconds:
+            payload["lease_seconds"] = lease_seconds
+        if wait_seconds:
+            payload["wait"] = wait_seconds
+        # Claiming a job is not idempotent: a retried request could claim a second one
+        response = DASHBOARD.request('POST', "/api/request_job", name="request_job", idempotent=False, json=payload, timeout=10 + wait_seconds)
         response.raise_for_status()
         job_data = response.json()
         if job_data and job_data.get('job_id'):
-            print(f"[{datetime.now()}] Received job {job_data['job_id']} for file: {job_data['filepath']}")
+            action = "Leased" if job_data.get('lease_seconds') else "Received"
+            print(f"[{datetime.now()}] {action} job {job_data['job_id']} for file: {job_data['filepath']}")
             return job_data
         else:
             print(f"[{datetime.now()}] No pending jobs available.")
@@ -323,40 +1462,269 @@ def request_job_from_dashboard():
         print(f"[{datetime.now()}] API Error: Could not request job. {e}")
         return None
 
-def update_job_status(job_id, status, details=None):
-    """Updates the job's status via the dashboard's API."""
+def request_node_command(since=None, wait_seconds=0):
+    """
+    Reads the node's command from the dashboard's command stream. With 'since' set to the token of
+    the last response, the dashboard holds the request open until the command or the node options
+    change, or wait_seconds pass. Returns the control dict (command, max_slots, token) or None.
+    The dict carries 'retry_after' (seconds) when the dashboard could not hold the request open.
+    """
+    if not SESSION_TOKEN:
+        return None
+    try:
+        params = {"hostname": HOSTNAME, "session_token": SESSION_TOKEN, "wait": wait_seconds}
+        if since:
+            params["since"] = since
+        response = DASHBOARD.request('GET', f"/api/nodes/{HOSTNAME}/command", name="node_command", retries=0, params=params, timeout=10 + wait_seconds)
+        response.raise_for_status()
+        return response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[{datetime.now()}] API Error: Could not read the node command stream. {e}")
+        return None
+
+class JobUpdateRejected(Exception):
+    """The dashboard refused a job update for good (a 4xx other than 408 and 429), so sending it again cannot help."""
+
+def update_job_status(job_id, status, details=None, idempotency_key=None):
+    """
+    Updates the job's status via the dashboard's API. Returns True if the dashboard handled the
+    update (including a job that no longer exists), False if it should be sent again later.
+    Raises JobUpdateRejected if the dashboard refused the update for good.
+    The update carries an idempotency key, so it is retried safely: the dashboard applies
+    each key only once, even if an earlier attempt went through but its response was lost.
+    """
     if not SESSION_TOKEN:
         print(f"[{datetime.now()}] ERROR: Cannot update job status - worker is not registered")
-        return
+        return False
     
     payload = {"status": status, "hostname": HOSTNAME, "session_token": SESSION_TOKEN}
     if details:
         payload.update(details)
+    headers = {'Idempotency-Key': idempotency_key or uuid.uuid4().hex}
     
     try:
-        headers = {'X-API-Key': API_KEY} if API_KEY else {}
-        response = requests.post(f"{DASHBOARD_URL}/api/update_job/{job_id}", json=payload, headers=headers, timeout=10)
+        response = DASHBOARD.request('POST', f"/api/update_job/{job_id}", name="update_job", retries=JOB_UPDATE_RETRIES, json=payload, headers=headers, timeout=10)
+        if response.status_code == 404:
+            print(f"[{datetime.now()}] Job {job_id} no longer exists on the dashboard. Dropping its '{status}' update.")
+            return True
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise JobUpdateRejected(f"HTTP {response.status_code}: {response.text[:200]}")
         response.raise_for_status()
         print(f"[{datetime.now()}] Successfully updated job {job_id} to status '{status}'.")
+        return True
     except requests.exceptions.RequestException as e:
         print(f"[{datetime.now()}] API Error: Could not update job {job_id}. {e}")
+        return False
 
-def validate_filepath(filepath):
+class ResultSpool:
     """
-    Validates that a filepath doesn't contain path traversal attempts.
-    Prevents security vulnerabilities from malicious paths like '../../../etc/passwd'.
-    Returns True if the path is safe, False otherwise.
+    Append-only journal of job results (one fsynced JSON line each). Every result is written here
+    before it is sent to the dashboard, and an acknowledgement line is appended once the dashboard
+    has accepted it. Results that could not be delivered (dashboard restarting, network outage,
+    worker restart) are replayed in order with their original idempotency key, so the dashboard
+    applies each one exactly once. The journal is removed when nothing is pending any more.
     """
-    try:
-        # Resolve the absolute path and normalize it
-        resolved_path = os.path.realpath(os.path.abspath(filepath))
-        
-        # Use configurable allowed base directories from environment
-        # Normalize all base paths once to avoid redundant computation
-        allowed_bases_raw = list(MEDIA_PATHS) + [os.path.abspath('.')]
-        allowed_bases_normalized = []
-        for base in allowed_bases_raw:
-            try:
+    def __init__(self, path):
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def has_pending(self):
+        return self.enabled and self.path.exists()
+
+    def _append(self, entry):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a+b') as f:
+            line = json.dumps(entry).encode() + b"\n"
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    line = b"\n" + line # Don't glue onto a line torn by a crash
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pending(self):
+        """Returns the results that were not acknowledged yet, oldest first."""
+        if not self.enabled:
+            return []
+        with self._lock:
+            return self._read_pending()
+
+    def _read_pending(self):
+        try:
+            lines = self.path.read_text().splitlines()
+        except FileNotFoundError:
+            return []
+        records, acknowledged = {}, set()
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue # A line torn by a crash was never acknowledged by anyone
+            if 'ack' in entry:
+                acknowledged.add(entry['ack'])
+            elif 'key' in entry:
+                records[entry['key']] = entry
+        return [entry for key, entry in records.items() if key not in acknowledged]
+
+    def submit(self, job_id, status, details=None, key=None):
+        """
+        Journals a job result, then sends it to the dashboard together with anything still pending.
+        key is the result's idempotency key; a result submitted again with the same key is applied only once.
+        """
+        entry = {"key": key or uuid.uuid4().hex, "job_id": job_id, "status": status, "details": details, "spooled_at": datetime.now(timezone.utc).isoformat()}
+        if not self.enabled:
+            self._deliver(entry)
+            return
+        try:
+            with self._lock:
+                self._append(entry)
+        except OSError as e:
+            print(f"[{datetime.now()}] Result Spool Error: Could not journal the result of job {job_id}. {e}")
+            self._deliver(entry)
+            return
+        self.replay()
+
+    @property
+    def rejected_path(self):
+        """Dead-letter file for results the dashboard refused for good, kept for inspection."""
+        return self.path.with_name(f"{self.path.stem}.rejected{self.path.suffix}")
+
+    def _deliver(self, entry):
+        """
+        Sends one result. Returns True if it needs no further delivery attempts: it was accepted,
+        or it was refused for good and moved to the dead-letter file.
+        """
+        try:
+            return update_job_status(entry['job_id'], entry['status'], entry.get('details'), idempotency_key=entry['key'])
+        except JobUpdateRejected as e:
+            print(f"[{datetime.now()}] Result Spool Error: The dashboard rejected the '{entry['status']}' result of job {entry['job_id']} ({e}). Not sending it again.")
+            if self.enabled:
+                try:
+                    with self._lock:
+                        with open(self.rejected_path, 'a') as f:
+                            f.write(json.dumps({**entry, "rejected": str(e)}) + "\n")
+                except OSError as write_error:
+                    print(f"[{datetime.now()}] Result Spool Error: Could not record the rejected result in {self.rejected_path}. {write_error}")
+            return True
+
+    def replay(self):
+        """
+        Sends the pending results in order and stops at the first one that could not be delivered
+        (dashboard unreachable or failing), so results always reach the dashboard in the order they
+        were produced. Results the dashboard refuses for good are moved to the dead-letter file
+        instead of blocking the ones behind them. Returns the number of results still pending.
+        """
+        if not self.enabled:
+            return 0
+        with self._replay_lock:
+            pending = self.pending()
+            for delivered, entry in enumerate(pending):
+                if not self._deliver(entry):
+                    remaining = len(pending) - delivered
+                    print(f"[{datetime.now()}] {remaining} job result(s) kept in {self.path} until the dashboard is reachable.")
+                    return remaining
+                with self._lock:
+                    self._append({"ack": entry['key']})
+            with self._lock:
+                # Only remove the journal if no new result was written to it in the meantime
+                if self.path.exists() and not self._read_pending():
+                    self.path.unlink()
+            return 0
+
+    def pending_jobs(self):
+        """Returns the jobs (and segments) with undelivered results, for the dashboard to leave alone on registration."""
+        return [
+            {"job_id": entry['job_id'], "segment_index": (entry.get('details') or {}).get('segment_index')}
+            for entry in self.pending()
+        ]
+
+RESULT_SPOOL = ResultSpool(RESULT_SPOOL_PATH)
+
+class FinalizeJournal:
+    """
+    Intent records of the finalize stage, one JSON file per finished job. A record is written
+    before the job's file operations start and rewritten after every completed step, each time
+    through a synced temp file that is renamed into place, so a crash never leaves a torn record.
+    It is removed once the job's result is in the result spool. Records left behind by a crash
+    are finished by the finalize stage when the worker starts again.
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory) if directory else None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def _path(self, key):
+        return self.directory / f"{key}.json"
+
+    def write(self, record):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._path(record['key'])
+            temp_path = path.with_suffix(".tmp")
+            with open(temp_path, 'w') as f:
+                json.dump(record, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+
+    def remove(self, key):
+        if not self.enabled:
+            return
+        with self._lock:
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def records(self):
+        """Returns the journaled intents, oldest first."""
+        if not self.enabled or not self.directory.is_dir():
+            return []
+        records = []
+        for path in self.directory.glob("*.json"):
+            try:
+                records.append(json.loads(path.read_text()))
+            except (OSError, ValueError) as e:
+                print(f"[{datetime.now()}] Finalize Journal Error: Skipping unreadable intent record {path}. {e}")
+        return sorted(records, key=lambda record: record.get('created_at', ''))
+
+    def pending_jobs(self):
+        """Returns the jobs whose file operations are unfinished, for the dashboard to leave alone on registration."""
+        return [{"job_id": record['job_id'], "segment_index": None} for record in self.records()]
+
+    def work_dirs(self):
+        """Returns the scratch directories still needed by journaled intents."""
+        return [directory for record in self.records() for directory in record['intent'].get('cleanup_dirs', [])]
+
+FINALIZE_JOURNAL = FinalizeJournal(FINALIZE_JOURNAL_DIR)
+
+def validate_filepath(filepath):
+    """
+    Validates that a filepath doesn't contain path traversal attempts.
+    Prevents security vulnerabilities from malicious paths like '../../../etc/passwd'.
+    Returns True if the path is safe, False otherwise.
+    """
+    try:
+        # Resolve the absolute path and normalize it
+        resolved_path = os.path.realpath(os.path.abspath(filepath))
+        
+        # Use configurable allowed base directories from environment
+        # Normalize all base paths once to avoid redundant computation
+        allowed_bases_raw = list(MEDIA_PATHS) + [os.path.abspath('.')]
+        allowed_bases_normalized = []
+        for base in allowed_bases_raw:
+            try:
                 base_real = os.path.realpath(os.path.abspath(base))
                 allowed_bases_normalized.append(base_real)
             except (ValueError, TypeError):
@@ -451,35 +1819,591 @@ def translate_path_for_worker(filepath, settings):
         # if the worker's root path isn't the project directory.
         return filepath.replace(path_to, path_from, 1)
     return filepath
-def process_file(filepath, db, settings):
-    """Handles the full transcoding process for a given file using ffmpeg."""
+def move_file(source, destination, progress=None):
+    """
+    Moves a file without ever leaving a truncated file at the destination. Within one filesystem
+    this is a rename. Across filesystems the file is copied to a .partial file next to the
+    destination, synced and renamed into place, and only then is the source removed.
+    """
+    try:
+        os.rename(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    partial_path = destination.with_name(f"{destination.name}.partial")
+    try:
+        _copy_sequential(source, partial_path, progress)
+        shutil.copystat(source, partial_path)
+        os.rename(partial_path, destination)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partial_path)
+        raise
+    os.remove(source)
+
+def finalize_transcode(original_path, temp_output_path, final_output_path, settings, progress=None):
+    """
+    Replaces the original file with the finished encode, keeping a backup if configured.
+    progress(copied_bytes, total_bytes) reports a backup move that has to copy the file.
+    """
+    # Check if original file still exists (it might have been moved/deleted by external process)
+    original_exists = os.path.exists(original_path)
+    
+    if not original_exists:
+        print(f"⚠️ WARNING: Original file disappeared during transcode: {original_path}")
+        print(f"  -> This may have been moved/deleted by Plex, Sonarr, or another process")
+        print(f"  -> Skipping original file cleanup, proceeding with temp file rename")
+    elif settings.get('keep_original') == 'true':
+        backup_dir_str = settings.get('backup_directory', '')
+        if backup_dir_str:
+            try:
+                backup_path = Path(backup_dir_str) / original_path.name
+                print(f"  -> Moving original to backup: {backup_path}")
+                backup_path.parent.mkdir(parents=True, exist_ok=True)
+                move_file(original_path, backup_path, progress)
+            except FileNotFoundError:
+                print(f"  -> [WARNING] Original file disappeared before backup could be made, skipping")
+        else:
+            print("  -> Keeping original file (no backup directory specified).")
+    else:
+        try:
+            print(f"  -> Deleting original file: {original_path}")
+            os.remove(original_path)
+        except FileNotFoundError:
+            print(f"  -> [WARNING] Original file was already deleted by another process, skipping")
+    
+    print(f"  -> Renaming temporary file to final output: {final_output_path}")
+    os.rename(temp_output_path, final_output_path)
+
+class FinalizeIntent:
+    """
+    The file operations that complete a finished encode, run by the finalize stage: copying a
+    scratch-staged encode back to the share, backing up or deleting the original, renaming the
+    temp file to the final output and removing leftover work directories. The intent is plain
+    data, so it can be journaled and finished by a restarted worker, and every step can be
+    repeated after a crash. stage is the next step to run: 'copy', 'replace' or 'cleanup'.
+    """
+    def __init__(self, original_path, temp_output_path, final_output_path, keep_original=False, backup_directory='',
+                 staged_output=None, cleanup_dirs=(), stage=None, on_cleanup=None):
+        self.original_path = Path(original_path)
+        self.temp_output_path = Path(temp_output_path)
+        self.final_output_path = Path(final_output_path)
+        self.keep_original = keep_original
+        self.backup_directory = backup_directory
+        self.staged_output = str(staged_output) if staged_output else None
+        self.cleanup_dirs = [str(directory) for directory in cleanup_dirs]
+        self.stage = stage or ('copy' if staged_output else 'replace')
+        # Releases in-memory resources (the scratch reservation); not journaled
+        self.on_cleanup = on_cleanup
+
+    @classmethod
+    def for_job(cls, original_path, temp_output_path, final_output_path, settings, staged=None, cleanup_dirs=()):
+        """Builds the intent of a finished encode from the job's settings and optional scratch staging."""
+        if staged:
+            cleanup_dirs = [*cleanup_dirs, staged.work_dir]
+        return cls(
+            original_path, temp_output_path, final_output_path,
+            keep_original=settings.get('keep_original') == 'true',
+            backup_directory=settings.get('backup_directory', ''),
+            staged_output=staged.local_output if staged else None,
+            cleanup_dirs=cleanup_dirs,
+            on_cleanup=staged.cleanup if staged else None,
+        )
+
+    def to_record(self):
+        return {
+            "original_path": str(self.original_path), "temp_output_path": str(self.temp_output_path),
+            "final_output_path": str(self.final_output_path), "keep_original": self.keep_original,
+            "backup_directory": self.backup_directory, "staged_output": self.staged_output,
+            "cleanup_dirs": self.cleanup_dirs, "stage": self.stage,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(**record)
+
+    @property
+    def name(self):
+        return self.original_path.name
+
+    def encode_lost(self):
+        """True if a journaled intent can no longer be finished because its encode is gone."""
+        if self.stage == 'copy':
+            return not os.path.exists(self.staged_output)
+        if self.stage == 'replace':
+            return not self.temp_output_path.exists() and not self.final_output_path.exists()
+        return False
+
+    def run(self, progress=None, checkpoint=None):
+        """
+        Runs the remaining steps. progress(step, copied_bytes, total_bytes) reports the copy steps,
+        and checkpoint() is called after each completed step so the caller can journal it.
+        A step that raises leaves the staged encode and work directories in place, so the intent can be run again.
+        """
+        def report(step):
+            return (lambda done, total: progress(step, done, total)) if progress else None
+
+        if self.stage == 'copy':
+            print(f"  -> Copying encode from scratch to: {self.temp_output_path}")
+            try:
+                _copy_sequential(self.staged_output, self.temp_output_path, report('copy'))
+            except OSError:
+                with contextlib.suppress(OSError):
+                    os.remove(self.temp_output_path)
+                raise
+            self._advance('replace', checkpoint)
+        if self.stage == 'replace':
+            if self.temp_output_path.exists() or not self.final_output_path.exists():
+                settings = {"keep_original": 'true' if self.keep_original else 'false', "backup_directory": self.backup_directory}
+                finalize_transcode(self.original_path, self.temp_output_path, self.final_output_path, settings, report('backup'))
+            else:
+                print(f"  -> Encode already renamed to final output: {self.final_output_path}")
+            self._advance('cleanup', checkpoint)
+        self.cleanup()
+
+    def _advance(self, stage, checkpoint):
+        self.stage = stage
+        if checkpoint:
+            checkpoint()
+
+    def cleanup(self):
+        """Removes the work directories and releases the scratch reservation, once the intent is done or abandoned."""
+        for directory in self.cleanup_dirs:
+            shutil.rmtree(directory, ignore_errors=True)
+        if self.on_cleanup:
+            self.on_cleanup()
+            self.on_cleanup = None
+
+def process_file(filepath, db, settings, on_finishing=None, job_id=None, staged=None, media_info=None):
+    """
+    Handles the full transcoding process for a given file using ffmpeg.
+    Returns a tuple: (success, details_dict, finalize). On success, finalize is a FinalizeIntent that
+    replaces the original file with the encode; the caller runs it (possibly in the background)
+    before reporting the job as completed. on_finishing is called once, shortly before the encode ends.
+    With a scratch directory configured, the source is staged locally (or was already staged
+    by the prefetcher) and ffmpeg reads and writes only local files.
+    """
     # Translate the dashboard path to the worker's local path
     local_filepath = translate_path_for_worker(filepath, settings)
     if local_filepath is None:
-        return False, {"reason": "Invalid or malicious filepath detected", "log": f"Filepath validation failed for: {filepath}"}
-    
-    print(f"[{datetime.now()}] Starting transcode for: {local_filepath}")
-    job_start_time = datetime.now(timezone.utc)
-    db.update_heartbeat('encoding', current_file=os.path.basename(local_filepath), progress=0, fps=0, job_start_time=job_start_time)
+        if staged:
+            staged.cleanup()
+        return False, {"reason": "Invalid or malicious filepath detected", "log": f"Filepath validation failed for: {filepath}"}, None
 
-    # --- Get settings from the dashboard ---
-    hw_mode = settings.get('hardware_acceleration', 'auto')
-    hw_config = detect_hardware_settings(hw_mode)
-    
-    # Determine which CQ value to use based on video width
+    if staged is None and job_id is not None:
+        staged = SCRATCH_SPACE.stage(job_id, local_filepath, staging_progress(local_filepath, db))
+    try:
+        success, details, finalize = _transcode(local_filepath, db, settings, on_finishing, staged, media_info)
+    except BaseException:
+        if staged:
+            staged.cleanup()
+        raise
+    if staged and not success:
+        staged.cleanup()
+    return success, details, finalize
+
+def describe_media(probe):
+    """
+    Has the dashboard turn the JSON output of 'ffprobe -show_streams -show_format' into a media
+    descriptor, so workers and the scanner share one parser.
+    """
+    payload = {"hostname": HOSTNAME, "session_token": SESSION_TOKEN, "probe": probe}
+    response = DASHBOARD.request('POST', "/api/media_descriptor", name="media_descriptor", json=payload, timeout=10)
+    response.raise_for_status()
+    return response.json()['media_info']
+
+def get_media_descriptor(probe_path, media_info=None):
+    """
+    Returns the media descriptor of a file. The descriptor the dashboard computed at scan time
+    is used when it has everything the worker needs; otherwise the file is probed once and the
+    dashboard parses the probe.
+    """
+    if media_info and media_info.get('width') and media_info.get('duration'):
+        return media_info
+    ffprobe_cmd = ["ffprobe", "-v", "error", "-show_streams", "-show_format", "-of", "json", str(probe_path)]
+    return describe_media(json.loads(subprocess.check_output(ffprobe_cmd, text=True)))
+
+def probe_media_info(probe_path, media_info=None):
+    """Like get_media_descriptor, but returns the given media_info unchanged if the file cannot be probed."""
+    try:
+        return get_media_descriptor(probe_path, media_info)
+    except (subprocess.CalledProcessError, OSError, ValueError, requests.exceptions.RequestException) as e:
+        print(f"[{datetime.now()}] ⚠️ Could not probe {probe_path}: {e}")
+        return media_info
+
+def probe_quality(probe_path, settings, hw_config, media_info=None):
+    """
+    Determines which CQ value to use based on the video width.
+    The same descriptor also gives us the duration needed to turn ffmpeg's out_time into a percentage.
+    Returns a tuple: (cq_value, duration_seconds).
+    """
+    total_duration_seconds = 0
     try:
-        ffprobe_cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width", "-of", "csv=s=x:p=0", local_filepath]
-        width_str = subprocess.check_output(ffprobe_cmd, text=True).strip()
-        video_width = int(width_str)
+        descriptor = get_media_descriptor(probe_path, media_info)
+        total_duration_seconds = descriptor.get('duration') or 0
+        video_width = int(descriptor['width'])
         cq_width_threshold = int(settings.get('cq_width_threshold', '1900'))
         
         if video_width >= cq_width_threshold:
-            cq_value = settings.get(f"{hw_config['type']}_cq_hd", '28')
+            cq_value = settings.get(f"{hw_config['cq_setting']}_cq_hd", '28')
         else:
-            cq_value = settings.get(f"{hw_config['type']}_cq_sd", '24')
+            cq_value = settings.get(f"{hw_config['cq_setting']}_cq_sd", '24')
     except Exception as e:
         print(f"⚠️ Could not determine video width, falling back to SD quality. Error: {e}")
-        cq_value = settings.get(f"{hw_config['type']}_cq_sd", '24')
+        cq_value = settings.get(f"{hw_config['cq_setting']}_cq_sd", '24')
+    return cq_value, total_duration_seconds
+
+# Sample encodes used to predict the savings of a full encode (see predict_encoded_size)
+SAMPLE_COUNT = 3
+SAMPLE_SECONDS = 10
+
+def predict_encoded_size(input_path, original_size, total_duration_seconds, hw_config, cq_value):
+    """
+    Predicts the size of the full encode from a few short samples, evenly spaced through the file.
+    Each sample is encoded with the configured encoder and CQ, and the same time range is also
+    stream-copied to measure the source's video bitrate there. A full encode only re-encodes the
+    video stream, so the measured ratio is applied to the source's estimated video share.
+    Returns the predicted output size in bytes, or None if the file is too short or a sample failed.
+    """
+    if total_duration_seconds < 2 * SAMPLE_COUNT * SAMPLE_SECONDS or original_size <= 0:
+        return None
+    sizes = {"source": 0, "encoded": 0}
+    with tempfile.TemporaryDirectory(prefix="librarrarian_sample_", dir=SCRATCH_DIR or None) as work_dir:
+        for index in range(SAMPLE_COUNT):
+            start = total_duration_seconds * (index + 1) / (SAMPLE_COUNT + 1) - SAMPLE_SECONDS / 2
+            for label in sizes:
+                output_path = Path(work_dir) / f"sample{index}_{label}.mkv"
+                ffmpeg_cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+                if label == "encoded":
+                    ffmpeg_cmd.extend(hw_config["hw_pre_args"])
+                ffmpeg_cmd.extend(["-ss", f"{start:.3f}", "-i", str(input_path), "-t", str(SAMPLE_SECONDS), "-map", "0:v:0", "-an", "-sn"])
+                ffmpeg_cmd.extend(video_encode_args(hw_config, cq_value, stream="-c:v") if label == "encoded" else ["-c:v", "copy"])
+                ffmpeg_cmd.append(str(output_path))
+                result = subprocess.run(NODE_RESOURCES.wrap(ffmpeg_cmd), capture_output=True, text=True, errors='replace')
+                if result.returncode != 0 or not output_path.exists():
+                    print(f"[{datetime.now()}] ⚠️ Sample encode {index + 1} failed, encoding without a prediction. {result.stderr.strip()[-500:]}")
+                    return None
+                sizes[label] += output_path.stat().st_size
+    if sizes["source"] <= 0:
+        return None
+    video_size = min(original_size, sizes["source"] / (SAMPLE_COUNT * SAMPLE_SECONDS) * total_duration_seconds)
+    return round(original_size - video_size * (1 - sizes["encoded"] / sizes["source"]))
+
+def map_cq(hw_config, cq_value):
+    """Maps a CQ value from the dashboard's settings onto the quality scale of the hw_config's encoder."""
+    scale, offset, maximum = hw_config.get("cq_map", (1, 0, 51))
+    try:
+        return max(0, min(maximum, round(float(cq_value) * scale + offset)))
+    except (TypeError, ValueError):
+        return cq_value
+
+def video_encode_args(hw_config, cq_value, stream="-c:v:0"):
+    """Returns the ffmpeg encoder arguments for the detected hardware."""
+    args = [stream, hw_config["codec"], hw_config["cq_flag"], str(map_cq(hw_config, cq_value))]
+    if hw_config["preset"]:
+        args.extend(["-preset", hw_config["preset"]])
+    args.extend(hw_config["extra"])
+    args.extend(NODE_RESOURCES.encoder_args(hw_config))
+    return args
+
+class NodeResources:
+    """
+    The CPU resource profile this node's encodes run under, set from the node options in the dashboard:
+    encoder thread counts (ffmpeg threads, x265 pools and frame-threads), CPU affinity, nice and ionice
+    class, and an optional cgroup v2 cpu.max limit shared by all encodes of the node.
+    """
+    IONICE_CLASSES = {"best-effort": "2", "idle": "3"}
+    CGROUP_CPU_PERIOD = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profile = {}
+        self._cgroup = None
+        self._warned = set()
+
+    def _warn_once(self, key, message):
+        if key not in self._warned:
+            self._warned.add(key)
+            print(f"[{datetime.now()}] ⚠️ {message}")
+
+    def update(self, profile):
+        """Applies a new profile from the node options. Running encodes keep the profile they started with."""
+        profile = profile or {}
+        with self._lock:
+            if profile == self.profile:
+                return
+            self.profile = profile
+            self._warned.clear()
+        print(f"[{datetime.now()}] Resource profile: {json.dumps(profile, sort_keys=True) if profile else 'none'}")
+        self._configure_cgroup(profile.get('cpu_limit'))
+
+    def encoder_args(self, hw_config):
+        """Returns the thread arguments for a software encoder. Hardware encoders are left alone."""
+        profile = self.profile
+        if hw_config["mode"] != "cpu":
+            return []
+        args = ["-threads", str(profile['threads'])] if profile.get('threads') else []
+        if hw_config["codec"] == "libx265":
+            params = []
+            if profile.get('pools'):
+                params.append(f"pools={profile['pools']}")
+            if profile.get('frame_threads'):
+                params.append(f"frame-threads={profile['frame_threads']}")
+            if params:
+                args.extend(["-x265-params", ":".join(params)])
+        elif hw_config["codec"] == "libsvtav1" and profile.get('threads'):
+            args.extend(["-svtav1-params", f"lp={profile['threads']}"])
+        return args
+
+    def wrap(self, ffmpeg_cmd):
+        """
+        Prefixes an ffmpeg command with nice, ionice and taskset as the profile requires. The tools
+        exec each other, so ffmpeg keeps the pid of the spawned process and starts with every
+        thread already niced and pinned.
+        """
+        profile = self.profile
+        prefix = []
+        if profile.get('nice'):
+            prefix.extend(["nice", "-n", str(profile['nice'])])
+        if profile.get('ionice') in self.IONICE_CLASSES:
+            prefix.extend(["ionice", "-c", self.IONICE_CLASSES[profile['ionice']]])
+        if profile.get('cpuset'):
+            prefix.extend(["taskset", "-c", profile['cpuset']])
+        missing = sorted({tool for tool in ("nice", "ionice", "taskset") if tool in prefix and shutil.which(tool) is None})
+        if missing:
+            self._warn_once("tools", f"Resource profile ignored: {', '.join(missing)} not found.")
+            return ffmpeg_cmd
+        return prefix + ffmpeg_cmd
+
+    def attach(self, pid):
+        """Moves a spawned encode into the node's cpu.max cgroup, if a CPU limit is set."""
+        cgroup = self._cgroup
+        if cgroup is None or pid == os.getpid():
+            return # The worker's own threads (heartbeats, command stream, finalize) are never limited
+        try:
+            (cgroup / "cgroup.procs").write_text(str(pid))
+        except OSError as e:
+            self._warn_once("attach", f"Could not apply the CPU limit to an encode: {e}")
+
+    def _configure_cgroup(self, cpu_limit):
+        try:
+            if not cpu_limit:
+                if self._cgroup is not None:
+                    (self._cgroup / "cpu.max").write_text(f"max {self.CGROUP_CPU_PERIOD}")
+                return
+            cgroup = self._cgroup or self._create_cgroup()
+            (cgroup / "cpu.max").write_text(f"{int(float(cpu_limit) * self.CGROUP_CPU_PERIOD)} {self.CGROUP_CPU_PERIOD}")
+            self._cgroup = cgroup
+        except OSError as e:
+            self._warn_once("cgroup", f"CPU limit unavailable (needs a writable cgroup v2 hierarchy): {e}")
+
+    def _create_cgroup(self):
+        """
+        Creates the cgroup for encodes next to the worker's own cgroup and delegates the cpu controller to it.
+        cgroup v2 only delegates controllers from a group without processes of its own, so everything in the
+        worker's group (the worker and any other process of its container) first moves into a sibling
+        'librarrarian-worker' group, which has no CPU limit. Only ffmpeg processes are attached to the
+        limited 'librarrarian-encodes' group, so the limit never slows down the worker's own threads.
+        """
+        own = next((line[3:] for line in Path("/proc/self/cgroup").read_text().splitlines() if line.startswith("0::")), None)
+        if own is None:
+            raise OSError("cgroup v2 is not mounted")
+        base = Path("/sys/fs/cgroup") / own.strip().lstrip("/")
+        if base.name in ("librarrarian-worker", "librarrarian-encodes"):
+            # Set up by an earlier run of the worker in the same container
+            base = base.parent
+        if not (base / "cgroup.controllers").exists():
+            raise OSError("cgroup v2 is not mounted at /sys/fs/cgroup")
+        cgroup = base / "librarrarian-encodes"
+        cgroup.mkdir(exist_ok=True)
+        worker_group = base / "librarrarian-worker"
+        if "cpu" not in (base / "cgroup.subtree_control").read_text().split():
+            worker_group.mkdir(exist_ok=True)
+            for pid in (base / "cgroup.procs").read_text().split():
+                with contextlib.suppress(OSError):
+                    (worker_group / "cgroup.procs").write_text(pid)
+            (base / "cgroup.subtree_control").write_text("+cpu")
+        if own.strip().endswith("/librarrarian-encodes") and worker_group.is_dir():
+            # Never leave the worker itself behind the encode limit
+            (worker_group / "cgroup.procs").write_text(str(os.getpid()))
+        return cgroup
+
+NODE_RESOURCES = NodeResources()
+
+class ActiveEncodes:
+    """
+    Tracks the running ffmpeg processes of all slots so node commands reach them mid-encode:
+    'paused' suspends them, 'idle' (stop) and 'quit' terminate them so their jobs return to the
+    queue, and any other command resumes them. Processes are keyed by the slot thread that runs them.
+    """
+    STOP_COMMANDS = ('idle', 'quit')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = {}
+        self._interrupted = set()
+        self._paused = False
+        self._stopping = False
+
+    def register(self, process):
+        with self._lock:
+            self._processes[threading.get_ident()] = process
+            if self._stopping:
+                self._interrupt(threading.get_ident(), process)
+            elif self._paused:
+                process.send_signal(signal.SIGSTOP)
+
+    def unregister(self):
+        with self._lock:
+            self._processes.pop(threading.get_ident(), None)
+
+    def _interrupt(self, ident, process):
+        self._interrupted.add(ident)
+        if self._paused:
+            process.send_signal(signal.SIGCONT)
+        process.terminate()
+
+    def apply(self, command):
+        """Applies a node command to all running encodes."""
+        with self._lock:
+            stopping = command in self.STOP_COMMANDS
+            if stopping and not self._stopping:
+                if self._processes:
+                    print(f"[{datetime.now()}] Stopping {len(self._processes)} active encode(s).")
+                for ident, process in self._processes.items():
+                    self._interrupt(ident, process)
+            elif command == 'paused' and not self._paused:
+                if self._processes:
+                    print(f"[{datetime.now()}] Pausing {len(self._processes)} active encode(s).")
+                for process in self._processes.values():
+                    process.send_signal(signal.SIGSTOP)
+            elif command != 'paused' and not stopping and self._paused:
+                if self._processes:
+                    print(f"[{datetime.now()}] Resuming {len(self._processes)} active encode(s).")
+                for process in self._processes.values():
+                    process.send_signal(signal.SIGCONT)
+            self._stopping = stopping
+            self._paused = command == 'paused'
+
+    def consume_interrupted(self):
+        """Returns True once if the calling slot's encode was terminated by an 'idle' (stop) or 'quit' command."""
+        with self._lock:
+            if threading.get_ident() in self._interrupted:
+                self._interrupted.discard(threading.get_ident())
+                return True
+            return False
+
+ACTIVE_ENCODES = ActiveEncodes()
+
+class SizeGuard:
+    """
+    Projects the final output size of an encode from ffmpeg's total_size and the elapsed media time.
+    Once `check_fraction` of the file is encoded, the guard trips as soon as the projection no longer
+    beats the original by `min_savings_percent`, so the encode can be abandoned early.
+    """
+    def __init__(self, original_size, total_duration_seconds, check_fraction, min_savings_percent):
+        self.original_size = original_size
+        self.total_duration_seconds = total_duration_seconds
+        self.check_fraction = check_fraction
+        self.max_size = original_size * (1 - min_savings_percent / 100)
+        self.projected_size = None
+        self.tripped = False
+
+    @classmethod
+    def from_settings(cls, settings, original_size, total_duration_seconds):
+        """Returns a guard for the encode, or None if the size guard is disabled or the duration is unknown."""
+        try:
+            check_percent = float(settings.get('size_guard_percent') or 0)
+            min_savings = float(settings.get('min_savings_percent') or 0)
+        except (TypeError, ValueError):
+            return None
+        if check_percent <= 0 or total_duration_seconds <= 0 or original_size <= 0:
+            return None
+        return cls(original_size, total_duration_seconds, min(check_percent, 100) / 100, min_savings)
+
+    def check(self, sample):
+        """Updates the projection from a progress sample. Returns True if the encode should be aborted."""
+        if sample.total_size is None or not sample.out_time_seconds:
+            return False
+        fraction = sample.out_time_seconds / self.total_duration_seconds
+        if fraction < self.check_fraction:
+            return False
+        self.projected_size = round(sample.total_size / min(fraction, 1))
+        self.tripped = self.projected_size > self.max_size
+        return self.tripped
+
+    def savings_percent(self, size):
+        return (1 - size / self.original_size) * 100
+
+def run_ffmpeg(ffmpeg_cmd, db, current_file, total_duration_seconds, job_start_time, log_name, on_finishing=None, time_offset=0, size_guard=None):
+    """
+    Runs an ffmpeg command built with '-progress pipe:1' and reports its progress.
+    time_offset is added to ffmpeg's out_time when the command encodes only a part of the file.
+    If a SizeGuard is given, ffmpeg is terminated as soon as the guard trips.
+    Returns a tuple: (returncode, log_capture).
+    """
+    print(f"🔩 FFmpeg command: {' '.join(ffmpeg_cmd)}")
+
+    # Machine-readable progress goes to stdout, the human-readable log to stderr.
+    process = subprocess.Popen(NODE_RESOURCES.wrap(ffmpeg_cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace')
+    NODE_RESOURCES.attach(process.pid)
+    ACTIVE_ENCODES.register(process)
+    log_capture = FFmpegLogCapture(process.stderr, name=log_name).start()
+    parser = FFmpegProgressParser()
+    reporter = ProgressReporter(db).start()
+
+    try:
+        if total_duration_seconds > 0:
+            # Send total duration to dashboard once we know it
+            reporter.submit('encoding', current_file=current_file, progress=round((time_offset / total_duration_seconds) * 100), fps=0, total_duration=total_duration_seconds, job_start_time=job_start_time)
+
+        for line in process.stdout:
+            sample = parser.feed(line)
+            if sample is None:
+                continue
+            duration = total_duration_seconds or log_capture.duration or 0
+            if duration > 0 and sample.out_time_seconds is not None:
+                position = time_offset + sample.out_time_seconds
+                progress = min(100, round((position / duration) * 100))
+                reporter.submit('encoding', current_file=current_file, progress=progress, fps=sample.fps, speed=sample.speed, total_duration=duration, job_start_time=job_start_time)
+                GPU_DEVICES.update_fps(sample.fps)
+                if on_finishing and sample.speed:
+                    remaining_seconds = (duration - position) / sample.speed
+                    if remaining_seconds <= PIPELINE_PREFETCH_SECONDS:
+                        on_finishing()
+                        on_finishing = None
+            if size_guard and size_guard.check(sample):
+                print(f"[{datetime.now()}] ✋ Output of {current_file} is projected at {size_guard.projected_size / (1024**3):.2f} GB ({size_guard.savings_percent(size_guard.projected_size):.1f}% saving), aborting the encode.")
+                process.terminate()
+                break
+
+        process.wait()
+        log_capture.join()
+    finally:
+        ACTIVE_ENCODES.unregister()
+        reporter.stop()
+    return process.returncode, log_capture
+
+def size_guard_outcome(size_guard, new_size):
+    """Job details for an encode abandoned because its output would not be small enough."""
+    return {
+        "outcome": "aborted_low_gain", "original_size": size_guard.original_size, "predicted_size": new_size,
+        "reason": f"Output was projected at a {size_guard.savings_percent(new_size):.1f}% saving, below the required margin",
+    }
+
+def _transcode(local_filepath, db, settings, on_finishing, staged, media_info=None):
+    """Runs ffmpeg for process_file, reading and writing scratch space if the job was staged."""
+    print(f"[{datetime.now()}] Starting transcode for: {local_filepath}")
+    job_start_time = datetime.now(timezone.utc)
+    db.update_heartbeat('encoding', current_file=os.path.basename(local_filepath), progress=0, fps=0, job_start_time=job_start_time)
+
+    # --- Get settings from the dashboard ---
+    probe_path = staged.local_source if staged else local_filepath
+    media_info = probe_media_info(probe_path, media_info)
+    # The device lease is released by the slot once the job is done
+    hw_config = hw_config_for_source(GPU_DEVICES.acquire(encoder_settings(settings, db)), media_info)
+    cq_value, total_duration_seconds = probe_quality(probe_path, settings, hw_config, media_info)
 
     # --- Prepare file paths ---
     original_path = Path(local_filepath)
@@ -493,98 +2417,327 @@ def process_file(filepath, db, settings):
         original_size = os.path.getsize(original_path)
     except FileNotFoundError:
         print(f"[{datetime.now()}] FAILED: Original file not found before transcode: {original_path}")
-        return False, {"reason": "Original file not found", "log": f"File disappeared before transcoding could start: {original_path}"}
+        return False, {"reason": "Original file not found", "log": f"File disappeared before transcoding could start: {original_path}"}, None
 
-    # --- Build FFmpeg Command ---
-    ffmpeg_cmd = ["ffmpeg", "-y", "-hide_banner"]
-    ffmpeg_cmd.extend(hw_config["hw_pre_args"])
-    ffmpeg_cmd.extend(["-i", str(original_path)])
-    ffmpeg_cmd.extend([
-        "-map", "0", "-c", "copy", "-c:v:0", hw_config["codec"],
-        hw_config["cq_flag"], str(cq_value)
-    ])
-    if hw_config["preset"]:
-        ffmpeg_cmd.extend(["-preset", hw_config["preset"]])
-    ffmpeg_cmd.extend(hw_config["extra"])
-    ffmpeg_cmd.append(str(temp_output_path))
+    input_path = staged.local_source if staged else original_path
+    encode_output_path = staged.local_output if staged else temp_output_path
 
-    print(f"🔩 FFmpeg command: {' '.join(ffmpeg_cmd)}")
+    if settings.get('sample_encode_enabled') == 'true':
+        # Skip sources that are already encoded efficiently, based on a few sample encodes
+        predicted_size = predict_encoded_size(input_path, original_size, total_duration_seconds, hw_config, cq_value)
+        min_savings = float(settings.get('min_savings_percent') or 0)
+        if predicted_size is not None:
+            predicted_savings = (1 - predicted_size / original_size) * 100
+            print(f"[{datetime.now()}] Sample encodes predict {predicted_size / (1024**3):.2f} GB ({predicted_savings:.1f}% saving) for: {local_filepath}")
+            if predicted_savings < min_savings:
+                print(f"[{datetime.now()}] Skipping {local_filepath}: the predicted saving is below {min_savings:g}%.")
+                return False, {
+                    "outcome": "skipped_low_gain", "original_size": original_size, "predicted_size": predicted_size,
+                    "reason": f"Predicted saving of {predicted_savings:.1f}% is below the {min_savings:g}% minimum",
+                }, None
 
-    # --- Execute FFmpeg and Capture Output ---
-    process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, universal_newlines=True, errors='replace')
-    
-    total_duration_seconds = 0
-    log_buffer = []
-
-    for line in process.stdout:
-        log_buffer.append(line)
-        if "Duration:" in line:
-            match = re.search(r'Duration: (\d{2}):(\d{2}):(\d{2})\.(\d{2})', line)
-            if match:
-                h, m, s, ms = map(int, match.groups())
-                total_duration_seconds = h * 3600 + m * 60 + s + ms / 100.0
-                # Send total duration to dashboard once we know it
-                db.update_heartbeat('encoding', current_file=os.path.basename(local_filepath), progress=0, fps=0, total_duration=total_duration_seconds, job_start_time=job_start_time)
-
-        if "frame=" in line and total_duration_seconds > 0:
-            time_match = re.search(r'time=(\d{2}):(\d{2}):(\d{2})\.(\d{2})', line)
-            fps_match = re.search(r'fps=\s*([\d\.]+)', line)
-            if time_match:
-                h, m, s, ms = map(int, time_match.groups())
-                current_seconds = h * 3600 + m * 60 + s + ms / 100.0
-                progress = round((current_seconds / total_duration_seconds) * 100)
-                fps = float(fps_match.group(1)) if fps_match else 0
-                db.update_heartbeat('encoding', current_file=os.path.basename(local_filepath), progress=progress, fps=fps, total_duration=total_duration_seconds, job_start_time=job_start_time)
-
-    process.wait()
+    size_guard = SizeGuard.from_settings(settings, original_size, total_duration_seconds)
+    segment_seconds = checkpoint_segment_seconds(settings)
+    if segment_seconds and total_duration_seconds > 2 * segment_seconds:
+        # Long encodes run in checkpointed segments so a restarted worker can resume them
+        returncode, log_capture = encode_checkpointed(
+            input_path, original_path, encode_output_path, total_duration_seconds, segment_seconds,
+            hw_config, cq_value, db, job_start_time, on_finishing
+        )
+    else:
+        # --- Build FFmpeg Command ---
+        ffmpeg_cmd = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-progress", "pipe:1"]
+        ffmpeg_cmd.extend(hw_config["hw_pre_args"])
+        ffmpeg_cmd.extend(["-i", str(input_path)])
+        ffmpeg_cmd.extend(["-map", "0", "-c", "copy"])
+        ffmpeg_cmd.extend(video_encode_args(hw_config, cq_value))
+        ffmpeg_cmd.append(str(encode_output_path))
+
+        # --- Execute FFmpeg and Capture Output ---
+        returncode, log_capture = run_ffmpeg(ffmpeg_cmd, db, os.path.basename(local_filepath), total_duration_seconds, job_start_time, original_path.stem, on_finishing, size_guard=size_guard)
 
     # --- Process Results ---
-    if process.returncode == 0:
+    if size_guard and size_guard.tripped:
+        # The output would not beat the original by the required margin: keep the original untouched
+        if os.path.exists(encode_output_path):
+            os.remove(encode_output_path)
+        return False, size_guard_outcome(size_guard, size_guard.projected_size), None
+
+    if returncode == 0:
         print(f"[{datetime.now()}] Finished transcode for: {local_filepath}")
         
         # Check if temp file was created successfully
-        if not os.path.exists(temp_output_path):
-            print(f"[{datetime.now()}] FAILED: Temporary output file not created: {temp_output_path}")
-            return False, {"reason": "FFmpeg did not create output file", "log": "".join(log_buffer)}
-        
-        new_size = os.path.getsize(temp_output_path)
-
-        # Handle file replacement
-        # Check if original file still exists (it might have been moved/deleted by external process)
-        original_exists = os.path.exists(original_path)
-        
-        if not original_exists:
-            print(f"⚠️ WARNING: Original file disappeared during transcode: {original_path}")
-            print(f"  -> This may have been moved/deleted by Plex, Sonarr, or another process")
-            print(f"  -> Skipping original file cleanup, proceeding with temp file rename")
-        elif settings.get('keep_original') == 'true':
-            backup_dir_str = settings.get('backup_directory', '')
-            if backup_dir_str:
-                try:
-                    backup_path = Path(backup_dir_str) / original_path.name
-                    print(f"  -> Moving original to backup: {backup_path}")
-                    backup_path.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.move(original_path, backup_path)
-                except FileNotFoundError:
-                    print(f"  -> [WARNING] Original file disappeared before backup could be made, skipping")
-            else:
-                print("  -> Keeping original file (no backup directory specified).")
-        else:
-            try:
-                print(f"  -> Deleting original file: {original_path}")
-                os.remove(original_path)
-            except FileNotFoundError:
-                print(f"  -> [WARNING] Original file was already deleted by another process, skipping")
+        if not os.path.exists(encode_output_path):
+            print(f"[{datetime.now()}] FAILED: Temporary output file not created: {encode_output_path}")
+            return False, {"reason": "FFmpeg did not create output file", **log_capture.details()}, None
         
-        print(f"  -> Renaming temporary file to final output: {final_output_path}")
-        os.rename(temp_output_path, final_output_path)
+        new_size = os.path.getsize(encode_output_path)
+        log_capture.discard_spill()
+        if size_guard and new_size > size_guard.max_size:
+            # Checkpointed encodes are only measured once they are finished
+            print(f"[{datetime.now()}] ✋ Output of {local_filepath} is {size_guard.savings_percent(new_size):.1f}% smaller than the original, keeping the original.")
+            os.remove(encode_output_path)
+            return False, size_guard_outcome(size_guard, new_size), None
 
-        return True, {"original_size": original_size, "new_size": new_size}
+        # File replacement is handed back to the caller so the slot can move on to its next encode
+        finalize = FinalizeIntent.for_job(original_path, temp_output_path, final_output_path, settings, staged=staged)
+        return True, {"original_size": original_size, "new_size": new_size}, finalize
     else:
-        print(f"[{datetime.now()}] FAILED transcode for: {local_filepath}. FFmpeg exited with code {process.returncode}")
-        if os.path.exists(temp_output_path):
-            os.remove(temp_output_path)
-        return False, {"reason": f"FFmpeg failed with code {process.returncode}", "log": "".join(log_buffer)}
+        print(f"[{datetime.now()}] FAILED transcode for: {local_filepath}. FFmpeg exited with code {returncode}")
+        if os.path.exists(encode_output_path):
+            os.remove(encode_output_path)
+        return False, {"reason": f"FFmpeg failed with code {returncode}", **log_capture.details()}, None
+
+# --- Segmented Encoding ---
+# Long files can be split into keyframe-aligned time ranges that several nodes encode at the same time.
+# Segment files live in a hidden directory next to the source so every node can reach them, and use
+# the '.seg' extension so the media scanners never pick them up.
+
+def segment_directory(local_filepath, job_id):
+    return Path(local_filepath).parent / f".librarrarian_segments_{job_id}"
+
+SEGMENT_DIR_PATTERN = re.compile(r"\.librarrarian_segments_\d+")
+
+def segment_path(segment_dir, index):
+    return segment_dir / f"segment_{index:05d}.seg"
+
+def segment_encode_command(hw_config, cq_value, input_path, start, length, output_path):
+    """Builds the ffmpeg command that encodes the video stream of one time range of a file."""
+    # Seeking before the input is frame-accurate when re-encoding
+    ffmpeg_cmd = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-progress", "pipe:1"]
+    ffmpeg_cmd.extend(hw_config["hw_pre_args"])
+    ffmpeg_cmd.extend(["-ss", f"{start:.3f}", "-i", str(input_path)])
+    if length is not None:
+        ffmpeg_cmd.extend(["-t", f"{length:.3f}"])
+    ffmpeg_cmd.extend(["-map", "0:v:0", "-an", "-sn", "-dn"])
+    ffmpeg_cmd.extend(video_encode_args(hw_config, cq_value, stream="-c:v"))
+    ffmpeg_cmd.extend(["-f", "matroska", str(output_path)])
+    return ffmpeg_cmd
+
+def join_segments_command(segment_dir, indexes, original_path, output_path):
+    """
+    Writes the concat list for the given segments and builds the ffmpeg command that joins them,
+    copying the audio, subtitle and attachment streams from the original file.
+    """
+    concat_list = segment_dir / "segments.txt"
+    concat_list.write_text("".join(f"file '{segment_path(segment_dir, index).name}'\n" for index in indexes))
+    return [
+        "ffmpeg", "-y", "-hide_banner", "-nostats", "-progress", "pipe:1",
+        "-f", "concat", "-safe", "0", "-i", str(concat_list),
+        "-i", str(original_path),
+        "-map", "0:v:0", "-map", "1:a?", "-map", "1:s?", "-map", "1:t?",
+        "-map_metadata", "1", "-map_chapters", "1", "-c", "copy",
+        str(output_path)
+    ]
+
+def checkpoint_segment_seconds(settings):
+    """Returns the checkpoint segment length in seconds, or 0 if checkpointed encoding is disabled."""
+    try:
+        return max(0.0, float(settings.get('checkpoint_segment_minutes', '0')) * 60)
+    except (TypeError, ValueError):
+        return 0.0
+
+class EncodeCheckpoint:
+    """
+    Manifest of the finished segments of a checkpointed encode. It is kept in a work directory next
+    to the source, so a restarted worker (or another node with access to the same share) resumes the
+    encode from the last finished segment. The manifest is only reused while the source file and
+    the encoder settings are unchanged.
+    """
+    def __init__(self, original_path, segment_seconds, encoder):
+        name_hash = hashlib.sha1(original_path.name.encode()).hexdigest()[:12]
+        self.work_dir = original_path.parent / f".librarrarian_resume_{name_hash}"
+        self.path = self.work_dir / "manifest.json"
+        stat = os.stat(original_path)
+        self.identity = {
+            "source": original_path.name,
+            "source_size": stat.st_size,
+            "source_mtime": int(stat.st_mtime),
+            "segment_seconds": segment_seconds,
+            "encoder": encoder,
+        }
+        self.completed = {}
+
+    def load(self):
+        """Loads the segments finished by an earlier run. Returns how many can be reused."""
+        try:
+            manifest = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return 0
+        if manifest.get('identity') != self.identity:
+            print(f"[{datetime.now()}] Discarding checkpoint in {self.work_dir}: the source or the encoder settings changed.")
+            self.discard()
+            return 0
+        for index, size in manifest.get('completed', {}).items():
+            path = segment_path(self.work_dir, int(index))
+            if path.exists() and path.stat().st_size == size:
+                self.completed[int(index)] = size
+        return len(self.completed)
+
+    def mark_completed(self, index):
+        self.completed[index] = segment_path(self.work_dir, index).stat().st_size
+        manifest = {"identity": self.identity, "completed": {str(i): size for i, size in sorted(self.completed.items())}}
+        temp_path = self.path.with_suffix('.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def discard(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+def encode_checkpointed(input_path, original_path, output_path, total_duration_seconds, segment_seconds, hw_config, cq_value, db, job_start_time, on_finishing=None):
+    """
+    Encodes the video stream in fixed-length segments, recording each finished segment in an
+    EncodeCheckpoint, then joins the segments with the original's other streams into output_path.
+    Returns a tuple: (returncode, log_capture) like run_ffmpeg.
+    """
+    checkpoint = EncodeCheckpoint(original_path, segment_seconds, {"codec": hw_config["codec"], "cq": str(cq_value), "preset": hw_config["preset"]})
+    checkpoint.work_dir.mkdir(exist_ok=True)
+    resumed = checkpoint.load()
+    segment_count = int(total_duration_seconds // segment_seconds) + (1 if total_duration_seconds % segment_seconds else 0)
+    if resumed:
+        print(f"[{datetime.now()}] Resuming encode of {original_path.name}: {resumed} of {segment_count} segments already finished.")
+
+    for index in range(segment_count):
+        if index in checkpoint.completed:
+            continue
+        start = index * segment_seconds
+        is_last = index == segment_count - 1
+        partial_path = segment_path(checkpoint.work_dir, index).with_suffix('.part')
+        ffmpeg_cmd = segment_encode_command(hw_config, cq_value, input_path, start, None if is_last else segment_seconds, partial_path)
+        returncode, log_capture = run_ffmpeg(
+            ffmpeg_cmd, db, original_path.name, total_duration_seconds, job_start_time,
+            f"{original_path.stem}.segment{index}", on_finishing if is_last else None, time_offset=start
+        )
+        if returncode != 0 or not partial_path.exists():
+            if partial_path.exists():
+                partial_path.unlink()
+            return returncode or 1, log_capture
+        log_capture.discard_spill()
+        os.replace(partial_path, segment_path(checkpoint.work_dir, index))
+        checkpoint.mark_completed(index)
+
+    ffmpeg_cmd = join_segments_command(checkpoint.work_dir, range(segment_count), original_path, output_path)
+    returncode, log_capture = run_ffmpeg(ffmpeg_cmd, db, original_path.name, total_duration_seconds, job_start_time, original_path.stem)
+    if returncode == 0:
+        checkpoint.discard()
+    return returncode, log_capture
+
+def plan_segmented_job(job, db, settings):
+    """
+    First phase of a 'transcode_segmented' job: lists the keyframes of the source so the
+    dashboard can split it into segments that start on a keyframe.
+    """
+    local_filepath = translate_path_for_worker(job['filepath'], settings)
+    if local_filepath is None:
+        return False, {"reason": "Invalid or malicious filepath detected", "log": f"Filepath validation failed for: {job['filepath']}"}
+
+    print(f"[{datetime.now()}] Listing keyframes for segmented encode: {local_filepath}")
+    db.update_heartbeat('segmenting', current_file=os.path.basename(local_filepath))
+    # A job planned again (re-queued after it failed) starts over, so segments of its earlier run are of no use
+    shutil.rmtree(segment_directory(local_filepath, job['job_id']), ignore_errors=True)
+    try:
+        # Reading packet flags only demuxes the file, which is much faster than decoding keyframes
+        packets = subprocess.check_output(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=print_section=0", local_filepath],
+            text=True
+        )
+        duration = float(get_media_descriptor(local_filepath, job.get('media_info'))['duration'])
+    except (subprocess.CalledProcessError, ValueError, TypeError, requests.exceptions.RequestException) as e:
+        return False, {"reason": "Could not list keyframes for segmented encode", "log": str(e)}
+
+    keyframes = []
+    for line in packets.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(round(float(pts_time), 3))
+    print(f"[{datetime.now()}] Found {len(keyframes)} keyframes in {duration:.0f}s of video.")
+    return True, {"keyframes": sorted(set(keyframes)), "duration": duration}
+
+def encode_segment(job, db, settings):
+    """Encodes the video stream of one time range of a 'transcode_segmented' job."""
+    segment = job['segment']
+    local_filepath = translate_path_for_worker(job['filepath'], settings)
+    if local_filepath is None:
+        return False, {"segment_index": segment['index'], "reason": "Invalid or malicious filepath detected", "log": f"Filepath validation failed for: {job['filepath']}"}
+
+    segment_dir = segment_directory(local_filepath, job['job_id'])
+    output_path = segment_path(segment_dir, segment['index'])
+    partial_path = output_path.with_suffix('.part')
+    segment_length = None if segment.get('is_last') else segment['end'] - segment['start']
+    current_file = f"{os.path.basename(local_filepath)} (segment {segment['index'] + 1})"
+
+    print(f"[{datetime.now()}] Starting segment {segment['index']} ({segment['start']:.1f}s - {segment['end']:.1f}s) of: {local_filepath}")
+    job_start_time = datetime.now(timezone.utc)
+    db.update_heartbeat('encoding', current_file=current_file, progress=0, fps=0, job_start_time=job_start_time)
+
+    media_info = probe_media_info(local_filepath, job.get('media_info'))
+    hw_config = hw_config_for_source(GPU_DEVICES.acquire(encoder_settings(settings, db)), media_info)
+    cq_value, _ = probe_quality(local_filepath, settings, hw_config, media_info)
+    try:
+        segment_dir.mkdir(exist_ok=True)
+    except OSError as e:
+        return False, {"segment_index": segment['index'], "reason": "Could not create segment directory", "log": str(e)}
+
+    ffmpeg_cmd = segment_encode_command(hw_config, cq_value, local_filepath, segment['start'], segment_length, partial_path)
+
+    returncode, log_capture = run_ffmpeg(ffmpeg_cmd, db, current_file, segment['end'] - segment['start'], job_start_time, f"{Path(local_filepath).stem}.segment{segment['index']}")
+    if returncode != 0 or not partial_path.exists():
+        print(f"[{datetime.now()}] FAILED segment {segment['index']} of: {local_filepath}. FFmpeg exited with code {returncode}")
+        if partial_path.exists():
+            partial_path.unlink()
+        return False, {"segment_index": segment['index'], "reason": f"FFmpeg failed with code {returncode} on segment {segment['index']}", **log_capture.details()}
+
+    log_capture.discard_spill()
+    os.replace(partial_path, output_path)
+    print(f"[{datetime.now()}] Finished segment {segment['index']} of: {local_filepath}")
+    return True, {"segment_index": segment['index'], "output_size": os.path.getsize(output_path)}
+
+def concat_segments(job, db, settings):
+    """
+    Final phase of a 'transcode_segmented' job: joins the encoded segments and copies the audio,
+    subtitle and attachment streams from the original file.
+    """
+    local_filepath = translate_path_for_worker(job['filepath'], settings)
+    if local_filepath is None:
+        return False, {"reason": "Invalid or malicious filepath detected", "log": f"Filepath validation failed for: {job['filepath']}"}, None
+
+    original_path = Path(local_filepath)
+    segment_dir = segment_directory(local_filepath, job['job_id'])
+    segments = sorted(job.get('segments', []), key=lambda s: s['index'])
+    missing = [s['index'] for s in segments if not segment_path(segment_dir, s['index']).exists()]
+    if not segments or missing:
+        # The dashboard queues the missing segments again
+        return False, {"reason": "Segment files are missing", "log": f"Missing segments: {missing}", "missing_segments": missing}, None
+
+    try:
+        original_size = os.path.getsize(original_path)
+    except FileNotFoundError:
+        return False, {"reason": "Original file not found", "log": f"File disappeared before the segments could be joined: {original_path}"}, None
+
+    print(f"[{datetime.now()}] Joining {len(segments)} segments for: {local_filepath}")
+    job_start_time = datetime.now(timezone.utc)
+    db.update_heartbeat('encoding', current_file=original_path.name, progress=0, fps=0, job_start_time=job_start_time)
+
+    temp_output_path = original_path.parent / f"tmp_{original_path.name}"
+    final_output_path = original_path.with_suffix('.mkv') # Always output to MKV
+
+    ffmpeg_cmd = join_segments_command(segment_dir, [s['index'] for s in segments], original_path, temp_output_path)
+    total_duration_seconds = max(s['end'] for s in segments)
+    returncode, log_capture = run_ffmpeg(ffmpeg_cmd, db, original_path.name, total_duration_seconds, job_start_time, original_path.stem)
+    if returncode != 0 or not temp_output_path.exists():
+        print(f"[{datetime.now()}] FAILED joining segments for: {local_filepath}. FFmpeg exited with code {returncode}")
+        if temp_output_path.exists():
+            temp_output_path.unlink()
+        return False, {"reason": f"FFmpeg failed with code {returncode} while joining segments", **log_capture.details()}, None
+
+    new_size = os.path.getsize(temp_output_path)
+    log_capture.discard_spill()
+
+    finalize = FinalizeIntent.for_job(original_path, temp_output_path, final_output_path, settings, cleanup_dirs=[segment_dir])
+    return True, {"original_size": original_size, "new_size": new_size}, finalize
 
 def cleanup_file(filepath, db, settings):
     """
@@ -609,6 +2762,29 @@ def cleanup_file(filepath, db, settings):
         print(f"[{datetime.now()}] FAILED cleanup for: {local_filepath}. Reason: {e}")
         return False, {"reason": "File deletion error on worker", "log": str(e)}
 
+def cleanup_segments(dirpath, db, settings):
+    """
+    Removes the segment directory of a segmented job that failed or was deleted on the dashboard.
+    Returns a tuple: (success, details_dict).
+    """
+    local_dirpath = translate_path_for_worker(dirpath, settings)
+    if local_dirpath is None:
+        return False, {"reason": "Invalid or malicious filepath detected", "log": f"Filepath validation failed for: {dirpath}"}
+    if not SEGMENT_DIR_PATTERN.fullmatch(os.path.basename(local_dirpath)):
+        return False, {"reason": "Not a segment directory", "log": f"Refusing to remove: {local_dirpath}"}
+
+    db.update_heartbeat('cleaning', current_file=os.path.basename(local_dirpath))
+    if not os.path.isdir(local_dirpath):
+        print(f"[{datetime.now()}] Segment directory not found (already removed?): {local_dirpath}")
+        return True, {"reason": "Directory not found on worker"}
+    try:
+        shutil.rmtree(local_dirpath)
+        print(f"[{datetime.now()}] Removed segment directory: {local_dirpath}")
+        return True, {}
+    except OSError as e:
+        print(f"[{datetime.now()}] FAILED to remove segment directory: {local_dirpath}. Reason: {e}")
+        return False, {"reason": "Segment directory removal error on worker", "log": str(e)}
+
 def rename_file(filepath, db, settings, metadata):
     """
     Renames a file based on metadata from Sonarr/Radarr.
@@ -645,14 +2821,348 @@ def rename_file(filepath, db, settings, metadata):
     except Exception as e:
         return False, {"reason": "File rename operation failed on worker.", "log": str(e)}
 
+def run_job(job, db, settings, on_finishing=None, staged=None):
+    """
+    Runs a single job of any type. Returns a tuple: (success, details_dict, finalize),
+    where finalize is None or a FinalizeIntent that completes the job's file operations.
+    """
+    if job.get('job_type') == 'cleanup':
+        return (*cleanup_file(job['filepath'], db, settings), None)
+    elif job.get('job_type') == 'segment_cleanup':
+        return (*cleanup_segments(job['filepath'], db, settings), None)
+    elif job.get('job_type') == 'Rename Job':
+        return (*rename_file(job['filepath'], db, settings, job.get('metadata')), None)
+    elif job.get('job_type') == 'transcode_segment':
+        return (*encode_segment(job, db, settings), None)
+    elif job.get('job_type') == 'transcode_segmented':
+        if job.get('phase') == 'concat':
+            return concat_segments(job, db, settings)
+        return (*plan_segmented_job(job, db, settings), None)
+    else: # Default to 'transcode'
+        return process_file(job['filepath'], db, settings, on_finishing=on_finishing, job_id=job['job_id'], staged=staged, media_info=job.get('media_info'))
+
+class FinalizeStage:
+    """
+    Finishes jobs in the background: runs each job's FinalizeIntent (scratch copy-back, original
+    deletion or backup move, temp file rename) and then reports its result to the dashboard, in order.
+    Intents are journaled before they are queued, so a slot never waits on backup I/O, and intents
+    left unfinished by a crash are completed when the stage starts. An intent that fails keeps its
+    staged encode and journal record and is retried with backoff, outside the queue, before the job
+    is given up. Results go through the result spool, and spooled results are retried while the
+    stage is idle. The queue is bounded, so slots wait here instead of piling up unfinished jobs.
+    """
+    STEP_LABELS = {"copy": "copying encode back", "backup": "backing up original"}
+
+    def __init__(self, max_pending=FINALIZE_QUEUE_SIZE, journal=FINALIZE_JOURNAL):
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._thread = None
+        self.journal = journal
+        self._progress_lock = threading.Lock()
+        # (file name, step, percent) of the intent being run
+        self._current = None
+        # (due time, queue item) of intents waiting for another attempt; only touched by the stage thread
+        self._retries = []
+        # Set once stop() was called; jobs submitted later are finished by the submitting thread
+        self._stopped = False
+        self._stop_lock = threading.Lock()
+
+    def start(self):
+        # Read before any slot can journal a new intent, so no intent is run twice
+        recovered = self.journal.records()
+        self._thread = threading.Thread(target=self._run, args=(recovered,), name="finalize", daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, job_id, success, details, finalize=None, status=None):
+        """
+        Queues a finished job. status overrides the 'completed'/'failed' status derived from success.
+        Once the stage has been stopped, the job is finished right away in the calling thread, so a
+        slot that outlives the stage on shutdown still gets its result journaled and spooled.
+        """
+        record = None
+        if finalize is not None:
+            record = {
+                "key": uuid.uuid4().hex, "job_id": job_id, "status": status, "details": details,
+                "created_at": datetime.now(timezone.utc).isoformat(), "intent": finalize.to_record(),
+            }
+            self._journal(record)
+        item = (job_id, success, details, finalize, status, record)
+        with self._stop_lock:
+            if not self._stopped:
+                self._queue.put(item)
+                return
+        # A failed intent is not retried here; its journal record is finished on the next start
+        self._finish(*item)
+
+    def stop(self, timeout=None):
+        """Finishes all queued jobs, then stops the stage. Jobs waiting for a retry stay in the journal for the next start."""
+        with self._stop_lock:
+            self._stopped = True
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def status(self):
+        """Returns a short description of the running finalize and the queue depth, or None while idle."""
+        with self._progress_lock:
+            current = self._current
+        waiting = self._queue.qsize()
+        parts = []
+        if current:
+            name, step, percent = current
+            parts.append(f"Finalizing {name} ({self.STEP_LABELS[step]} {percent}%)" if step else f"Finalizing {name}")
+        if waiting:
+            parts.append(f"{waiting} waiting to finalize")
+        retrying = len(self._retries)
+        if retrying:
+            parts.append(f"{retrying} retrying")
+        return ", ".join(parts) or None
+
+    def _journal(self, record):
+        try:
+            self.journal.write(record)
+        except OSError as e:
+            print(f"[{datetime.now()}] Finalize Journal Error: Could not record the file operations of job {record['job_id']}. {e}")
+
+    def _progress(self, name, step, done, total):
+        percent = int(done * 100 / total) if total else 100
+        with self._progress_lock:
+            previous = self._current
+            self._current = (name, step, percent)
+        if not previous or previous[1] != step or percent // 10 > previous[2] // 10:
+            print(f"[{datetime.now()}]   -> {self.STEP_LABELS[step].capitalize()}: {name} {percent}%")
+
+    def _recover(self, records):
+        """Finishes the intents journaled by a previous run of this worker."""
+        for record in records:
+            intent = FinalizeIntent.from_record(record['intent'])
+            print(f"[{datetime.now()}] Finishing the interrupted file operations of job {record['job_id']} ({intent.name}) from step '{intent.stage}'.")
+            if intent.encode_lost():
+                # The original was not touched yet, so the job can simply run again
+                print(f"  -> The encode is gone, returning the job to the queue.")
+                intent.cleanup()
+                RESULT_SPOOL.submit(record['job_id'], 'interrupted', None, key=record['key'])
+                self.journal.remove(record['key'])
+                continue
+            self._finish(record['job_id'], True, record['details'], intent, record['status'], record)
+
+    def _finish(self, job_id, success, details, finalize, status, record):
+        if finalize is not None:
+            with self._progress_lock:
+                self._current = (finalize.name, None, 0)
+            def checkpoint():
+                record['intent'] = finalize.to_record()
+                self._journal(record)
+            try:
+                finalize.run(progress=lambda step, done, total: self._progress(finalize.name, step, done, total),
+                             checkpoint=checkpoint if record else None)
+            except Exception as e:
+                attempts = record.get('attempts', 0) + 1
+                if finalize.encode_lost():
+                    # Nothing left to retry with; the job runs again from its source
+                    print(f"[{datetime.now()}] FAILED to finalize job {job_id}, the encode is gone: {e}")
+                    finalize.cleanup()
+                    success, details, status = False, None, 'interrupted'
+                elif attempts <= FINALIZE_RETRY_ATTEMPTS:
+                    delay = min(FINALIZE_RETRY_SECONDS * 2 ** (attempts - 1), FINALIZE_RETRY_MAX_SECONDS)
+                    print(f"[{datetime.now()}] FAILED to finalize job {job_id} (attempt {attempts}): {e}. Retrying in {delay} seconds.")
+                    record['attempts'] = attempts
+                    record['intent'] = finalize.to_record()
+                    self._journal(record)
+                    self._retries.append((time.monotonic() + delay, (job_id, success, details, finalize, status, record)))
+                    return
+                else:
+                    print(f"[{datetime.now()}] FAILED to finalize job {job_id}, giving up after {attempts} attempts: {e}")
+                    finalize.cleanup()
+                    success, details = False, {"reason": "Could not replace the original file", "log": str(e)}
+            finally:
+                with self._progress_lock:
+                    self._current = None
+        RESULT_SPOOL.submit(job_id, status or ('completed' if success else 'failed'), details, key=record['key'] if record else None)
+        if record:
+            self.journal.remove(record['key'])
+
+    def _run_due_retries(self):
+        now = time.monotonic()
+        due = [item for due_at, item in self._retries if due_at <= now]
+        self._retries = [(due_at, item) for due_at, item in self._retries if due_at > now]
+        for item in due:
+            self._finish(*item)
+
+    def _run(self, recovered):
+        self._recover(recovered)
+        while True:
+            self._run_due_retries()
+            timeout = RESULT_REPLAY_INTERVAL
+            if self._retries:
+                timeout = max(0.0, min(timeout, min(due_at for due_at, _ in self._retries) - time.monotonic()))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # Deliver results that were spooled while the dashboard was unreachable
+                if RESULT_SPOOL.has_pending():
+                    RESULT_SPOOL.replay()
+                continue
+            if item is None:
+                return
+            self._finish(*item)
+
+class JobPrefetcher:
+    """
+    Leases a slot's next job and refreshes the settings in the background while an encode finishes.
+    With scratch staging enabled, the leased job's source is copied to scratch space as well.
+    """
+    def __init__(self, state, slot):
+        self.state = state
+        self.slot = slot
+        self._thread = None
+        self._job = None
+        self._settings = None
+        self._staged = None
+
+    def trigger(self):
+        if PIPELINE_PREFETCH_SECONDS <= 0 or self._thread is not None or self.state.command != 'running':
+            return
+        self._thread = threading.Thread(target=self._run, name=f"prefetch-{self.slot}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        self._job = request_job_from_dashboard(lease_seconds=JOB_LEASE_SECONDS)
+        self._settings, _ = get_dashboard_settings()
+        job = self._job
+        if job and SCRATCH_PREFETCH and SCRATCH_SPACE.enabled and job.get('job_type', 'transcode') == 'transcode':
+            local_filepath = translate_path_for_worker(job['filepath'], self._settings or self.state.settings)
+            if local_filepath:
+                # The slot's heartbeat belongs to the running encode, so the prefetch copy is only logged
+                self._staged = SCRATCH_SPACE.stage(job['job_id'], local_filepath, staging_progress(local_filepath))
+
+    def take(self):
+        """Returns (leased_job, settings, staged) from the last prefetch, or (None, None, None) if there was none."""
+        if self._thread is None:
+            return None, None, None
+        self._thread.join()
+        result = (self._job, self._settings, self._staged)
+        self._thread, self._job, self._settings, self._staged = None, None, None, None
+        return result
+
+class NodeState:
+    """State shared between the supervisor loop and the job slot threads."""
+    def __init__(self, settings, version_mismatch):
+        self.lock = threading.Lock()
+        self.command = 'idle'
+        self.settings = settings
+        self.version_mismatch = version_mismatch
+        self.slot_limit = 1
+        self.busy_slots = set()
+        self.finalizer = FinalizeStage().start()
+        # Set by the command stream when the node's command or options change
+        self.control_changed = threading.Event()
+
+    def busy_count(self):
+        with self.lock:
+            return len(self.busy_slots)
+
+def slot_loop(db, state, slot):
+    """
+    Claims, processes and reports jobs for one job slot until the worker stops.
+    Jobs are pipelined: the next job is leased shortly before the current encode ends,
+    and the finished job is handed to the finalize stage so the next encode starts right away.
+    """
+    prefetcher = JobPrefetcher(state, slot)
+    while not STOP_EVENT.is_set() and state.command != 'quit':
+        if state.command != 'running' or slot >= state.slot_limit:
+            # Wait for the supervisor to start this slot (or the worker).
+            # A job leased in the meantime is returned to the queue when its lease expires.
+            STOP_EVENT.wait(1)
+            continue
+
+        leased_job, settings, staged = prefetcher.take()
+        requested_at = time.monotonic()
+        job = request_job_from_dashboard(leased_job_id=leased_job['job_id'] if leased_job else None, wait_seconds=JOB_LONG_POLL_SECONDS)
+        if staged and (not job or job['job_id'] != staged.job_id):
+            # The lease expired and another job was handed out instead
+            staged.cleanup()
+            staged = None
+        if not job:
+            if JOB_LONG_POLL_SECONDS > 0 and time.monotonic() - requested_at >= JOB_LONG_POLL_SECONDS - 1:
+                # The dashboard already waited for a job on our behalf, so ask again right away
+                continue
+            # No jobs were available (or the queue is paused), wait before asking again
+            poll_interval = int(state.settings.get('worker_poll_interval', 30))
+            print(f"[{datetime.now()}] [Slot {slot}] No jobs. Waiting for {poll_interval} seconds...")
+            STOP_EVENT.wait(poll_interval)
+            continue
+
+        if state.command == 'quit':
+            # The quit command arrived while this slot was waiting for a job
+            state.finalizer.submit(job['job_id'], False, {"segment_index": job['segment']['index']} if job.get('segment') else None, status='interrupted')
+            if staged:
+                staged.cleanup()
+            break
+
+        if not settings and not settings_snapshot_is_current(job.get('settings_version')):
+            settings, _ = get_dashboard_settings() # Refresh settings before each job unless they are unchanged
+        if settings:
+            state.settings = settings
+        # A single-slot worker reports progress on the node itself, exactly as before.
+        # With several slots, each job reports into its own slot sub-record.
+        multi_slot = state.slot_limit > 1
+        job_db = SlotDatabaseHandler(db, slot, job['job_id']) if multi_slot else db
+        with state.lock:
+            state.busy_slots.add(slot)
+        try:
+            success, details, finalize = run_job(job, job_db, state.settings, on_finishing=prefetcher.trigger, staged=staged)
+        except Exception as e:
+            print(f"[{datetime.now()}] [Slot {slot}] Unexpected error while processing job {job['job_id']}: {e}")
+            success, details, finalize = False, {"reason": "Unexpected worker error", "log": str(e)}, None
+        finally:
+            GPU_DEVICES.release()
+            with state.lock:
+                state.busy_slots.discard(slot)
+            if multi_slot:
+                job_db.mark_idle()
+        if ACTIVE_ENCODES.consume_interrupted():
+            # Stopped by a stop or quit command: the dashboard puts the job back in the queue
+            state.finalizer.submit(job['job_id'], False, {"segment_index": details['segment_index']} if 'segment_index' in details else None, status='interrupted')
+            continue
+        state.finalizer.submit(job['job_id'], success, details, finalize, status=details.get('outcome'))
+        if not multi_slot:
+            db.update_heartbeat('running', version_mismatch=state.version_mismatch)
+
+def command_stream_loop(state):
+    """
+    Keeps a long-poll request open on the dashboard's command stream and wakes up the supervisor
+    as soon as the node's command or options change. While the dashboard is unreachable, the
+    supervisor's regular polling still picks up commands.
+    """
+    token = None
+    while not STOP_EVENT.is_set() and state.command != 'quit':
+        control = request_node_command(token, COMMAND_STREAM_WAIT_SECONDS)
+        if control is None:
+            STOP_EVENT.wait(10)
+            continue
+        if control.get('token') != token:
+            token = control.get('token')
+            state.control_changed.set()
+        if control.get('retry_after'):
+            # The dashboard has no room for another waiting request right now
+            STOP_EVENT.wait(control['retry_after'])
+
 def main_loop(db):
-    """The main worker loop."""
+    """
+    The main worker loop. It acts as a supervisor: it reads the node command and slot limit
+    from the database and starts one slot thread per concurrent job.
+    """
     print(f"[{datetime.now()}] Worker '{HOSTNAME}' starting up. Version: {VERSION}")
     
     # Register with the dashboard to get a session token and ensure uniqueness
     if not register_with_dashboard():
         print(f"[{datetime.now()}] ❌ Failed to register with dashboard. Exiting.")
         sys.exit(1)
+    if RESULT_SPOOL.has_pending():
+        print(f"[{datetime.now()}] Delivering job results spooled before the last shutdown...")
+        RESULT_SPOOL.replay()
     
     db.update_heartbeat('booting', version_mismatch=False)
     time.sleep(2) # Stagger startup
@@ -673,62 +3183,243 @@ def main_loop(db):
 
     # Determine initial state
     autostart = os.environ.get('AUTOSTART', 'false').lower() == 'true'
-    current_command = 'running' if autostart else 'idle'
     if autostart:
         print(f"[{datetime.now()}] AUTOSTART is enabled. Worker will start processing jobs immediately.")
 
-    first_loop = True
+    state = NodeState(settings, version_mismatch)
+    slot_threads = []
+    if COMMAND_STREAM_WAIT_SECONDS > 0:
+        threading.Thread(target=command_stream_loop, args=(state,), name="command-stream", daemon=True).start()
+    next_metrics_log = time.monotonic() + API_METRICS_LOG_SECONDS
+    device_usage = []
+
     while not STOP_EVENT.is_set():
-        # On the first loop with autostart, force the command to 'running'
-        # to override the default 'idle' state from the database.
-        # For subsequent loops, if the command is 'idle', an autostarted worker
-        # should treat it as 'running' unless explicitly stopped.
-        current_command = db.get_node_command(HOSTNAME)
+        # If the command is 'idle', an autostarted worker should treat it
+        # as 'running' unless explicitly stopped.
+        current_command, max_slots, resources = db.get_node_control(HOSTNAME)
+        NODE_RESOURCES.update(resources)
+
+        if db.consume_hardware_refresh_request():
+            print(f"[{datetime.now()}] Hardware re-detection requested by the dashboard.")
+            db.update_capabilities(get_hardware_capabilities(refresh=True))
 
         if autostart and current_command == 'idle':
             current_command = 'running'
 
+        slot_limit = max(1, min(MAX_WORKER_SLOTS, max_slots or WORKER_SLOTS))
+        if slot_limit != state.slot_limit or not slot_threads:
+            print(f"[{datetime.now()}] Running with {slot_limit} job slot(s).")
+            db.reset_slots(slot_limit)
+        state.slot_limit = slot_limit
+        state.command = current_command
+        ACTIVE_ENCODES.apply(current_command)
+
         if current_command == 'quit':
-            print(f"[{datetime.now()}] Quit command received. Shutting down.")
+            print(f"[{datetime.now()}] Quit command received. Stopping active jobs and shutting down.")
+            # Interrupted jobs are returned to the queue by their slots. A slot still waiting on a
+            # job request is not waited for; a job it claims late is re-queued when the worker registers again.
+            # A slot that is still stopping its encode or staging files is waited for, and a slot that
+            # reports its job after the finalize stage has stopped finishes it inline.
+            for slot, thread in enumerate(slot_threads):
+                thread.join(timeout=5)
+                while thread.is_alive() and slot in state.busy_slots:
+                    thread.join(timeout=1)
+            state.finalizer.stop()
             db.update_heartbeat('offline', version_mismatch=version_mismatch)
             break
-        
-        if current_command in ['idle', 'paused', 'finishing']:
-            print(f"[{datetime.now()}] In '{current_command}' state. Standing by...")
-            db.update_heartbeat(current_command, version_mismatch=version_mismatch)
-            time.sleep(30) # Check for new commands every 30 seconds
-            continue
 
-        # If we've reached here, the command is 'running'.
-        db.update_heartbeat('running', version_mismatch=version_mismatch)
-
-        job = request_job_from_dashboard()
-        if job:
-            settings, _ = get_dashboard_settings() # Refresh settings before each job
-            if job.get('job_type') == 'cleanup':
-                success, details = cleanup_file(job['filepath'], db, settings)
-            elif job.get('job_type') == 'Rename Job':
-                success, details = rename_file(job['filepath'], db, settings, job.get('metadata'))
-            else: # Default to 'transcode'
-                success, details = process_file(job['filepath'], db, settings)
-            update_job_status(job['job_id'], 'completed' if success else 'failed', details)
+        while len(slot_threads) < slot_limit:
+            thread = threading.Thread(target=slot_loop, args=(db, state, len(slot_threads)), name=f"slot-{len(slot_threads)}", daemon=True)
+            thread.start()
+            slot_threads.append(thread)
+
+        busy = state.busy_count()
+        if current_command in ['idle', 'paused', 'finishing']:
+            if not busy:
+                print(f"[{datetime.now()}] In '{current_command}' state. Standing by...")
+            status = current_command
         else:
-            # No jobs were available, wait before asking again
-            poll_interval = int(settings.get('worker_poll_interval', 30))
-            print(f"[{datetime.now()}] No jobs. Waiting for {poll_interval} seconds...")
-            time.sleep(poll_interval)
-        
-        first_loop = False
+            status = 'encoding' if busy else 'running'
+        # While a single-slot worker is busy, the job itself owns the node's heartbeat.
+        if slot_limit > 1 or not busy:
+            current_file = f"{busy} of {slot_limit} slots busy" if slot_limit > 1 and busy else None
+            finalizing = state.finalizer.status()
+            if finalizing:
+                current_file = f"{current_file}, {finalizing}" if current_file else finalizing
+            db.update_heartbeat(status, current_file=current_file, version_mismatch=version_mismatch)
+        elif current_command == 'paused':
+            # A suspended encode sends no progress, so keep the node's heartbeat alive here
+            db.touch_heartbeat()
+
+        if GPU_DEVICES.usage() != device_usage:
+            device_usage = GPU_DEVICES.usage()
+            db.update_device_usage(device_usage)
+
+        if time.monotonic() >= next_metrics_log:
+            DASHBOARD.log_metrics()
+            next_metrics_log = time.monotonic() + API_METRICS_LOG_SECONDS
+
+        # Sleep until the next poll, unless the command stream reports a change first
+        wait_until = time.monotonic() + (30 if status in ['idle', 'paused', 'finishing'] else 10)
+        while not STOP_EVENT.is_set() and time.monotonic() < wait_until:
+            if state.control_changed.wait(1):
+                break
+        state.control_changed.clear()
+
+    for thread in slot_threads:
+        thread.join(timeout=30)
+    state.finalizer.stop(timeout=60)
+
+# ===========================
+# Encoder Benchmark
+# ===========================
+
+BENCHMARK_RESOLUTIONS = {"1080p": "1920x1080", "2160p": "3840x2160"}
+BENCHMARK_CPU_PRESETS = ["ultrafast", "veryfast", "fast", "medium", "slow"]
+BENCHMARK_FRAME_RATE = 30
+BENCHMARK_CQ = 24
+
+def benchmark_encoders(capabilities):
+    """Returns (name, hw_config) for every encoder configuration this node can run, built with get_hw_config."""
+    candidates = [(f"libx265/{preset}", {**get_hw_config("cpu"), "preset": preset}) for preset in BENCHMARK_CPU_PRESETS]
+    encoders = capabilities["encoders"]
+    devices = capabilities["devices"]
+    if "hevc_nvenc" in encoders and devices["nvidia"]:
+        hw_config = get_hw_config("nvidia")
+        candidates.append((f"hevc_nvenc/{hw_config['preset']}", hw_config))
+    for render_node in devices["render_nodes"][:1]:
+        if "hevc_qsv" in encoders:
+            hw_config = get_hw_config("qsv", render_node)
+            candidates.append((f"hevc_qsv/{hw_config['preset']}", hw_config))
+        if "hevc_vaapi" in encoders:
+            candidates.append(("hevc_vaapi", get_hw_config("vaapi", render_node)))
+    # AV1 encoders that passed the capability probe's test encode, at every speed tier
+    for mode in ("cpu", "nvidia", "qsv", "vaapi"):
+        for tier in SPEED_TIERS:
+            hw_config = get_hw_config(mode, (devices["render_nodes"] or ["/dev/dri/renderD128"])[0], family="av1", tier=tier)
+            if hw_config["codec"] in capabilities.get("av1_encoders", []) and (hw_config["preset"] or tier == "balanced"):
+                candidates.append((f"{hw_config['codec']}/{hw_config['preset'] or tier}", hw_config))
+    return candidates
+
+def generate_benchmark_clip(work_dir, label, size, seconds, encoders):
+    """
+    Renders a synthetic test clip from ffmpeg's lavfi test source, with a little temporal noise so the
+    encoders have real detail to work on. The clip is stored as high-quality H.264 (which every
+    hardware decoder can read), or MPEG-2 if libx264 is missing. Returns the clip path.
+    """
+    clip_path = Path(work_dir) / f"benchmark_{label}.mkv"
+    codec_args = ["-c:v", "libx264", "-preset", "ultrafast", "-crf", "12"] if "libx264" in encoders else ["-c:v", "mpeg2video", "-q:v", "2"]
+    subprocess.run([
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={BENCHMARK_FRAME_RATE}:duration={seconds}",
+        "-vf", "noise=alls=6:allf=t+u", "-pix_fmt", "yuv420p", *codec_args, str(clip_path)
+    ], check=True, capture_output=True, text=True)
+    return clip_path
+
+def benchmark_encode(clip_path, seconds, hw_config, output_path):
+    """Encodes one clip with one encoder configuration. Returns the measured fps, speed and bitrate."""
+    ffmpeg_cmd = ["ffmpeg", "-y", "-hide_banner", "-nostats", *hw_config["hw_pre_args"], "-i", str(clip_path), "-map", "0:v:0"]
+    ffmpeg_cmd.extend(video_encode_args(hw_config, BENCHMARK_CQ, stream="-c:v"))
+    ffmpeg_cmd.append(str(output_path))
+    started = time.monotonic()
+    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, errors='replace')
+    elapsed = time.monotonic() - started
+    if result.returncode != 0 or not output_path.exists():
+        return {"error": f"FFmpeg failed with code {result.returncode}", "log": "\n".join(result.stderr.splitlines()[-20:])}
+    output_size = output_path.stat().st_size
+    output_path.unlink()
+    return {
+        "fps": round(seconds * BENCHMARK_FRAME_RATE / elapsed, 2),
+        "speed": round(seconds / elapsed, 3),
+        "bitrate_kbps": round(output_size * 8 / seconds / 1000),
+        "elapsed_seconds": round(elapsed, 2),
+    }
+
+def run_benchmark(seconds=5, output=None, post=False):
+    """
+    Benchmarks every encoder this node can run on synthetic 1080p and 2160p clips and prints a JSON
+    report. Runs fully offline; with post=True the report is also sent to the dashboard, which
+    stores it with the node's options. Returns the process exit code.
+    """
+    # Progress goes to stderr so stdout carries nothing but the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        capabilities = get_hardware_capabilities()
+        report = {
+            "hostname": HOSTNAME,
+            "version": VERSION,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "clip_seconds": seconds,
+            "frame_rate": BENCHMARK_FRAME_RATE,
+            "cq": BENCHMARK_CQ,
+            "capabilities": capabilities,
+            "results": [],
+        }
+        if not capabilities["ffmpeg"]:
+            print("❌ FFmpeg is required for the benchmark.")
+            return 1
+        candidates = benchmark_encoders(capabilities)
+        with tempfile.TemporaryDirectory(prefix="librarrarian_benchmark_") as work_dir:
+            for label, size in BENCHMARK_RESOLUTIONS.items():
+                print(f"[{datetime.now()}] Generating {seconds:g}s {label} test clip...")
+                try:
+                    clip_path = generate_benchmark_clip(work_dir, label, size, seconds, capabilities["encoders"])
+                except subprocess.CalledProcessError as e:
+                    print(f"[{datetime.now()}] FAILED to generate the {label} test clip: {e.stderr.strip()}")
+                    return 1
+                for name, hw_config in candidates:
+                    print(f"[{datetime.now()}] Benchmarking {name} at {label}...")
+                    result = benchmark_encode(clip_path, seconds, hw_config, Path(work_dir) / "benchmark_output.mkv")
+                    report["results"].append({"encoder": name, "codec": hw_config["codec"], "preset": hw_config["preset"], "resolution": label, **result})
+                    if "error" in result:
+                        print(f"   ⚠️ {result['error']}")
+                    else:
+                        print(f"   {result['fps']} fps, {result['speed']}x, {result['bitrate_kbps']} kbps")
+                clip_path.unlink()
+
+        if output:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"[{datetime.now()}] Benchmark report written to {output}")
+        if post:
+            try:
+                response = DASHBOARD.request('POST', f"/api/nodes/{HOSTNAME}/benchmark", name="benchmark", json=report, timeout=30)
+                response.raise_for_status()
+                print(f"[{datetime.now()}] ✅ Benchmark report stored on the dashboard.")
+            except requests.exceptions.RequestException as e:
+                print(f"[{datetime.now()}] API Error: Could not send the benchmark report to the dashboard. {e}")
+    print(json.dumps(report, indent=2))
+    return 0
 
 # ===========================
 # Main Execution
 # ===========================
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Librarrarian transcode worker.")
+    parser.add_argument("--benchmark", action="store_true", help="Benchmark the encoders available on this node and print a JSON report, then exit.")
+    parser.add_argument("--benchmark-seconds", type=float, default=5, help="Length of each synthetic test clip in seconds (default: 5).")
+    parser.add_argument("--benchmark-output", help="Also write the benchmark report to this file.")
+    parser.add_argument("--benchmark-post", action="store_true", help="Send the benchmark report to the dashboard, which stores it for this node.")
+    return parser.parse_args()
+
 def main():
-    # Connect to DB using centralized config
-    db = DatabaseHandler(DB_CONFIG) # This is now just for heartbeats and commands
-    if not db._get_conn():
+    args = parse_args()
+    if args.benchmark:
+        sys.exit(run_benchmark(args.benchmark_seconds, args.benchmark_output, args.benchmark_post))
+
+    # Node state goes to the database directly, or through the dashboard in 'api' mode
+    if WORKER_STATE_BACKEND == 'api':
+        print(f"[{datetime.now()}] Node state is sent through the dashboard API. No database access is needed.")
+        db = DashboardStateHandler()
+    elif psycopg2 is None:
+        print("❌ Error: Missing PostgreSQL driver.")
+        print("   Please run: pip3 install psycopg2-binary, or set WORKER_STATE_BACKEND=api")
+        sys.exit(1)
+    else:
+        db = DatabaseHandler(DB_CONFIG) # This is now just for heartbeats and commands
+    if not db.check_connection():
         sys.exit(1)
+    SCRATCH_SPACE.purge(keep=FINALIZE_JOURNAL.work_dirs())
 
     # --- Worker Thread Setup ---
     worker_thread = threading.Thread(target=main_loop, args=(db,))
@@ -743,6 +3434,8 @@ def main():
         worker_thread.join() # Wait for the thread to exit
     finally:
         db.clear_node()
+        db.close()
+        DASHBOARD.log_metrics()
         print("Node offline.")
 
 if __name__ == "__main__":